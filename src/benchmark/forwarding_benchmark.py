@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import threading
+import collections
+import websockets
+import paho.mqtt.client as mqtt
+
+from benchmark.local_mqtt_broker import LocalMQTTBroker
+from benchmark.virtual_serial_port import VirtualSerialPort
+from common.benchmark_enum import BenchmarkEnum
+from common.message_codec import MessageCodec
+from common.modbus_enum import ModbusSerialEnum
+from core_services.controller import Controller
+from core_services.modbus_channel import ModBusChannel
+from core_services.mqtt_subscriber import get_downlink_topic
+from core_services.mqtt_subscriber import get_uplink_topic
+from core_services.routing_table import RoutingTable
+from core_services.websocket_channel import WebSocketChannel
+from util.logger_manager_ment import Logger
+from util.logger_manager_ment import LogWriter
+from util.tracing import MessageTracer
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def calculate_percentile(sorted_value_list, percentile):
+    if not sorted_value_list:
+        return None
+    index = max(math.ceil(percentile * len(sorted_value_list)) - 1, 0)
+    return sorted_value_list[index]
+
+
+class ForwardingBenchmark:
+    def __init__(self, device_number=BenchmarkEnum.DEVICE_NUMBER.value, message_rate=BenchmarkEnum.MESSAGE_RATE.value,
+                 duration=BenchmarkEnum.DURATION.value, ingress_protocol="Modbus", egress_protocol="Modbus",
+                 warmup_time=BenchmarkEnum.WARMUP_TIME.value):
+        '''
+        转发压测：在进程内拉起MQTT服务器替身、WebSocket服务器和基于pty的虚拟串口，
+        用N个模拟设备按固定速率通过ingress_protocol向控制器发送消息，控制器按路由表通过egress_protocol转发回设备，
+        统计端到端的吞吐量和转发延迟
+        :return:
+        '''
+        self.device_id_list = ["bench-" + str(index) for index in range(device_number)]
+        self.message_rate = message_rate
+        self.duration = duration
+        self.ingress_protocol = ingress_protocol
+        self.egress_protocol = egress_protocol
+        self.warmup_time = warmup_time
+        self.logger = Logger("ForwardingBenchmark")
+        self.message_codec = MessageCodec.get_default_codec()
+        self.mqtt_broker = LocalMQTTBroker()
+        self.mqtt_port = None
+        self.websocket_port = get_free_port()
+        self.serial_port_dict = {}
+        self.mqtt_client = None
+        # 模拟设备的WebSocket连接运行在独立线程的事件循环中
+        self.websocket_loop = None
+        self.websocket_client_dict = {}
+        self.controller = None
+        # 每个设备已发送但还没有收到转发的消息的发送时间，转发按顺序到达，先进先出匹配
+        self.pending_send_time_dict = {device_id: collections.deque() for device_id in self.device_id_list}
+        self.latency_list = []
+        self.sent_count = 0
+        self.received_count = 0
+        self.measure_start_time = None
+        self.running = True
+
+    def start_stand_ins(self):
+        '''
+        拉起MQTT服务器替身、WebSocket服务器和虚拟串口
+        :return:
+        '''
+        self.mqtt_port = self.mqtt_broker.start_broker()
+        websocket_server = WebSocketChannel("127.0.0.1", self.websocket_port)
+        threading.Thread(target=lambda: asyncio.run(websocket_server.start_websocket_server()),
+                         name="benchmark-websocket-server", daemon=True).start()
+        for device_id in self.device_id_list:
+            self.serial_port_dict[device_id] = VirtualSerialPort()
+        ModBusChannel.serial_file_location_dict = {device_id: serial_port.serial_file_location
+                                                   for device_id, serial_port in self.serial_port_dict.items()}
+
+    def start_controller(self):
+        '''
+        拉起连接到替身服务器的控制器，所有模拟设备的压测命令都按egress_protocol转发回设备自身
+        :return:
+        '''
+        self.controller = Controller()
+        self.controller.device_id_list = list(self.device_id_list)
+        channel = self.controller.channel
+        channel.protocol_type_dict["MQTT"].update({"host": "127.0.0.1", "port": self.mqtt_port})
+        channel.protocol_type_dict["WebSocket"].update({"host": "127.0.0.1", "port": self.websocket_port})
+        routes = {"*": {BenchmarkEnum.BENCHMARK_COMMAND.value: {
+            "protocol": self.egress_protocol, "next_command": BenchmarkEnum.BENCHMARK_REPLY_COMMAND.value}}}
+        self.controller.apply_routing_table(RoutingTable.compile_routing_table(self.device_id_list, routes))
+        threading.Thread(target=self.controller.start_monitor_channel_message, name="benchmark-controller",
+                         daemon=True).start()
+
+    def start_simulated_devices(self):
+        '''
+        模拟设备侧：MQTT客户端用于收发MQTT消息，串口读取线程用于接收控制器写入串口的消息
+        :return:
+        '''
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_message = lambda client, userdata, msg: self.receive_forwarded_message(msg.payload)
+        self.mqtt_client.connect("127.0.0.1", self.mqtt_port)
+        if self.egress_protocol == "MQTT":
+            self.mqtt_client.subscribe([(get_downlink_topic(device_id), 0) for device_id in self.device_id_list])
+        self.mqtt_client.loop_start()
+        if "WebSocket" in (self.ingress_protocol, self.egress_protocol):
+            self.websocket_loop = asyncio.new_event_loop()
+            threading.Thread(target=self.websocket_loop.run_forever, name="benchmark-websocket-devices",
+                             daemon=True).start()
+            for device_id in self.device_id_list:
+                asyncio.run_coroutine_threadsafe(self.connect_websocket_device(device_id), self.websocket_loop).result()
+        if self.egress_protocol == "Modbus":
+            for serial_port in self.serial_port_dict.values():
+                threading.Thread(target=self.read_serial_port, args=(serial_port,), daemon=True).start()
+
+    async def connect_websocket_device(self, device_id):
+        '''
+        模拟设备连接WebSocket服务器并登记自身，之后持续接收服务器推送的消息
+        :return:
+        '''
+        websocket = await websockets.connect("ws://127.0.0.1:" + str(self.websocket_port))
+        await websocket.send("register: " + device_id)
+        await websocket.recv()
+        self.websocket_client_dict[device_id] = websocket
+        asyncio.ensure_future(self.read_websocket_device(websocket))
+
+    async def read_websocket_device(self, websocket):
+        async for message in websocket:
+            self.receive_forwarded_message(message)
+
+    def read_serial_port(self, serial_port):
+        while self.running:
+            for frame in serial_port.read_frames_from_controller(0.5):
+                self.receive_forwarded_message(frame)
+
+    def receive_forwarded_message(self, message):
+        receive_time = time.perf_counter()
+        device_message = self.message_codec.decode_message(message)
+        # 只统计控制器转发回来的压测回复
+        if device_message.header is not None or device_message.command != BenchmarkEnum.BENCHMARK_REPLY_COMMAND.value:
+            return
+        pending_send_time_deque = self.pending_send_time_dict.get(device_message.receiver)
+        if not pending_send_time_deque:
+            return
+        send_time = pending_send_time_deque.popleft()
+        self.received_count += 1
+        if self.measure_start_time is not None and send_time >= self.measure_start_time:
+            self.latency_list.append(receive_time - send_time)
+
+    def send_device_message(self, device_id):
+        message = self.message_codec.encode_message(BenchmarkEnum.BENCHMARK_COMMAND.value, self.ingress_protocol,
+                                                    device_id, header=device_id)
+        self.pending_send_time_dict[device_id].append(time.perf_counter())
+        if self.ingress_protocol == "MQTT":
+            self.mqtt_client.publish(get_uplink_topic(device_id), message)
+        elif self.ingress_protocol == "WebSocket":
+            self.websocket_loop.call_soon_threadsafe(asyncio.ensure_future,
+                                                     self.websocket_client_dict[device_id].send(message))
+        else:
+            self.serial_port_dict[device_id].write_to_controller(
+                message.encode() + ModbusSerialEnum.TEXT_FRAME_DELIMITER.value)
+        self.sent_count += 1
+
+    def drive_load(self):
+        '''
+        按固定速率轮流让各个模拟设备发送消息
+        :return: (测量阶段发送的消息数, 测量阶段时长)
+        '''
+        start_time = time.perf_counter()
+        self.measure_start_time = start_time + self.warmup_time
+        end_time = self.measure_start_time + self.duration
+        message_index = 0
+        measured_sent_count = 0
+        while True:
+            send_time = start_time + message_index / self.message_rate
+            if send_time >= end_time:
+                break
+            delay = send_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_device_message(self.device_id_list[message_index % len(self.device_id_list)])
+            if send_time >= self.measure_start_time:
+                measured_sent_count += 1
+            message_index += 1
+        return measured_sent_count, time.perf_counter() - self.measure_start_time
+
+    def wait_for_drain(self):
+        deadline = time.perf_counter() + BenchmarkEnum.DRAIN_TIMEOUT.value
+        while self.received_count < self.sent_count and time.perf_counter() < deadline:
+            time.sleep(0.05)
+
+    def run_benchmark(self):
+        '''
+        执行压测并返回结果
+        :return: 结果字典
+        '''
+        self.start_stand_ins()
+        self.start_controller()
+        time.sleep(BenchmarkEnum.STARTUP_TIME.value)
+        self.start_simulated_devices()
+        measured_sent_count, measured_duration = self.drive_load()
+        self.wait_for_drain()
+        self.running = False
+        return self.build_result(measured_sent_count, measured_duration)
+
+    def build_result(self, measured_sent_count, measured_duration):
+        sorted_latency_list = sorted(self.latency_list)
+        latency_ms = {"p50": calculate_percentile(sorted_latency_list, 0.5),
+                      "p99": calculate_percentile(sorted_latency_list, 0.99),
+                      "p999": calculate_percentile(sorted_latency_list, 0.999),
+                      "max": sorted_latency_list[-1] if sorted_latency_list else None,
+                      "mean": sum(sorted_latency_list) / len(sorted_latency_list) if sorted_latency_list else None}
+        return {"config": {"device_number": len(self.device_id_list), "message_rate": self.message_rate,
+                           "duration": self.duration, "warmup_time": self.warmup_time,
+                           "ingress_protocol": self.ingress_protocol, "egress_protocol": self.egress_protocol},
+                "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                "cpu_count": os.cpu_count()},
+                "sent": self.sent_count,
+                "received": self.received_count,
+                "lost": self.sent_count - self.received_count,
+                "measured_sent": measured_sent_count,
+                "measured_received": len(sorted_latency_list),
+                "throughput_msgs_per_s": len(sorted_latency_list) / measured_duration if measured_duration else 0,
+                "latency_ms": {key: None if value is None else round(value * 1000, 3)
+                               for key, value in latency_ms.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="controller forwarding throughput and latency benchmark")
+    parser.add_argument("--devices", type=int, default=BenchmarkEnum.DEVICE_NUMBER.value)
+    parser.add_argument("--rate", type=float, default=BenchmarkEnum.MESSAGE_RATE.value,
+                        help="messages per second over all devices")
+    parser.add_argument("--duration", type=float, default=BenchmarkEnum.DURATION.value)
+    parser.add_argument("--warmup", type=float, default=BenchmarkEnum.WARMUP_TIME.value)
+    parser.add_argument("--ingress", choices=["Modbus", "MQTT", "WebSocket"], default="Modbus")
+    parser.add_argument("--egress", choices=["Modbus", "MQTT", "WebSocket"], default="Modbus")
+    parser.add_argument("--log-level", default=BenchmarkEnum.LOG_LEVEL.value)
+    parser.add_argument("--output", help="write the json result to this file instead of stdout")
+    parser.add_argument("--trace-output", help="dump the sampled message traces to this file, "
+                                               "summarize them with python -m util.tracing")
+    parser.add_argument("--trace-sample-interval", type=int, help="trace one of every N received messages")
+    args = parser.parse_args()
+    Logger.set_log_level(args.log_level)
+    message_tracer = MessageTracer.get_default_tracer()
+    if args.trace_sample_interval:
+        message_tracer.sample_interval = args.trace_sample_interval
+    benchmark = ForwardingBenchmark(args.devices, args.rate, args.duration, args.ingress, args.egress, args.warmup)
+    result_text = json.dumps(benchmark.run_benchmark(), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(result_text + "\n")
+    else:
+        print(result_text)
+    if args.trace_output:
+        message_tracer.dump_traces(args.trace_output)
+    sys.stdout.flush()
+    # 控制器的监听线程不会退出，写出剩余日志后直接结束进程
+    LogWriter.get_writer().close_writer()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import struct
+import asyncio
+import threading
+
+from util.logger_manager_ment import Logger
+
+# MQTT 3.1.1控制报文类型
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+PUBREL = 6
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + encode_remaining_length(len(body)) + body
+
+
+def read_utf8_string(body, offset):
+    length = struct.unpack_from(">H", body, offset)[0]
+    return body[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+def match_topic(topic_filter, topic):
+    '''
+    判断topic是否匹配订阅的topic_filter，支持+和#通配符
+    :return:
+    '''
+    filter_level_list = topic_filter.split("/")
+    topic_level_list = topic.split("/")
+    for index, filter_level in enumerate(filter_level_list):
+        if filter_level == "#":
+            return True
+        if index >= len(topic_level_list):
+            return False
+        if filter_level != "+" and filter_level != topic_level_list[index]:
+            return False
+    return len(filter_level_list) == len(topic_level_list)
+
+
+class LocalMQTTBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        '''
+        用于压测的进程内MQTT服务器替身，只实现MQTT 3.1.1中收发消息所需的部分：
+        连接、订阅（支持通配符）、QoS 0/1/2发布、心跳和断开，不校验用户名密码，统一按QoS 0投递给订阅者
+        在独立线程的事件循环中运行，port为0时由系统分配端口
+        :return:
+        '''
+        self.host = host
+        self.port = port
+        self.logger = Logger("LocalMQTTBroker")
+        self.loop = None
+        self.server = None
+        self.broker_thread = None
+        self.started_event = threading.Event()
+        # writer -> {topic_filter, ...}
+        self.subscription_dict = {}
+
+    def start_broker(self):
+        '''
+        拉起服务器线程，返回实际监听的端口
+        :return: port
+        '''
+        self.broker_thread = threading.Thread(target=self.run_broker, name="local-mqtt-broker", daemon=True)
+        self.broker_thread.start()
+        self.started_event.wait()
+        return self.port
+
+    def stop_broker(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.broker_thread is not None:
+            self.broker_thread.join()
+
+    def run_broker(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_client, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info("local mqtt broker listening on " + self.host + ":" + str(self.port))
+        self.started_event.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def read_packet(self, reader):
+        first_byte = (await reader.readexactly(1))[0]
+        remaining_length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            remaining_length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(remaining_length) if remaining_length else b""
+        return first_byte >> 4, first_byte & 0x0F, body
+
+    async def handle_client(self, reader, writer):
+        self.subscription_dict[writer] = set()
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(encode_packet(2, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    self.handle_publish(writer, flags, body)
+                elif packet_type == PUBREL:
+                    writer.write(encode_packet(7, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(writer, body)
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = read_utf8_string(body, offset)
+                        self.subscription_dict[writer].discard(topic_filter)
+                    writer.write(encode_packet(11, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(13, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscription_dict.pop(writer, None)
+            writer.close()
+
+    def handle_publish(self, writer, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic, offset = read_utf8_string(body, 0)
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            # QoS 1回复PUBACK，QoS 2回复PUBREC
+            writer.write(encode_packet(4 if qos == 1 else 5, 0, packet_id))
+        payload = body[offset:]
+        publish_packet = encode_packet(PUBLISH, 0, struct.pack(">H", len(topic.encode())) + topic.encode() + payload)
+        for subscriber_writer, topic_filter_set in list(self.subscription_dict.items()):
+            if any(match_topic(topic_filter, topic) for topic_filter in topic_filter_set):
+                subscriber_writer.write(publish_packet)
+
+    def handle_subscribe(self, writer, body):
+        packet_id = body[:2]
+        offset = 2
+        granted_qos = bytearray()
+        while offset < len(body):
+            topic_filter, offset = read_utf8_string(body, offset)
+            offset += 1
+            self.subscription_dict[writer].add(topic_filter)
+            granted_qos.append(0)
+        writer.write(encode_packet(9, 0, packet_id + bytes(granted_qos)))
@@ -0,0 +1,41 @@
+import os
+import tty
+import select
+
+from core_services.serial_frame_parser import SerialFrameParser
+
+
+class VirtualSerialPort:
+    def __init__(self):
+        '''
+        基于pty的虚拟串口，slave端的路径交给ModBusChannel作为设备串口打开，模拟的设备在master端收发数据
+        :return:
+        '''
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.serial_file_location = os.ttyname(self.slave_fd)
+        self.frame_parser = SerialFrameParser()
+
+    def write_to_controller(self, data):
+        '''
+        模拟设备向串口写入数据
+        :return:
+        '''
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self.master_fd, view):]
+
+    def read_frames_from_controller(self, timeout):
+        '''
+        读取控制器写入串口的数据，返回其中完整的帧
+        :return: 帧列表
+        '''
+        readable_list, _, _ = select.select([self.master_fd], [], [], timeout)
+        if not readable_list:
+            return []
+        return self.frame_parser.feed(os.read(self.master_fd, 65536))
+
+    def close_port(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
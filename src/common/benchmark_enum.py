@@ -0,0 +1,24 @@
+from enum import Enum
+
+
+class BenchmarkEnum(Enum):
+    '''
+    转发压测相关常量
+    '''
+    # 模拟设备数量
+    DEVICE_NUMBER = 10
+    # 所有模拟设备合计每秒发送的消息数量
+    MESSAGE_RATE = 200
+    # 压测持续时间（秒），不包括预热时间
+    DURATION = 10
+    # 预热时间（秒），预热期间的消息不计入结果
+    WARMUP_TIME = 2
+    # 发送结束后等待剩余转发消息到达的时间（秒）
+    DRAIN_TIMEOUT = 5
+    # 控制器拉起监听后等待其就绪的时间（秒）
+    STARTUP_TIME = 2
+    # 压测时设备发送的命令以及控制器转发的命令
+    BENCHMARK_COMMAND = "bench"
+    BENCHMARK_REPLY_COMMAND = "bench_reply"
+    # 压测期间控制器的日志级别，避免控制台输出影响结果
+    LOG_LEVEL = "error"
@@ -0,0 +1,80 @@
+from enum import Enum
+
+
+class ChannelPoolEnum(Enum):
+    '''
+    channel连接池相关常量
+    '''
+    # 连接池中最多同时保留的channel实例数量，超出后按最久未使用的顺序淘汰
+    MAX_POOL_SIZE = 64
+    # channel空闲超过该时间（秒）后被回收并关闭连接
+    IDLE_TIMEOUT = 300
+    # 对池中channel进行健康检查的间隔（秒）
+    HEALTH_CHECK_INTERVAL = 30
+    # 发送失败后重建channel并重试的次数
+    RECONNECT_RETRY_TIMES = 1
+
+
+class ChannelProtocolEnum(Enum):
+    '''
+    控制器启用的协议
+    '''
+    # 拉起监听的协议，如["MQTT", "WebSocket"]，只接入部分协议的部署不需要为其他协议拉起监听；为None时启用所有注册的协议
+    ENABLED_PROTOCOLS = None
+
+
+class MessageQueueEnum(Enum):
+    '''
+    消息队列相关常量
+    '''
+    # 各协议channel内部消息队列的最大长度，队列满时channel的接收线程会阻塞，从而停止读取上游数据
+    CHANNEL_QUEUE_SIZE = 1000
+    # 从channel队列搬运消息到汇总队列时，检查channel接收线程是否存活的间隔（秒）
+    CHANNEL_QUEUE_POLL_INTERVAL = 1
+    # 单个设备在汇总队列中的最大消息数量，超出后丢弃该设备的新消息
+    MAX_DEVICE_QUEUE_SIZE = 1000
+    # 汇总队列中所有设备的最大消息总数
+    MAX_TOTAL_QUEUE_SIZE = 100000
+    # 单个设备排队消息达到高水位时暂停读取该设备的消息，降到低水位时恢复
+    HIGH_WATERMARK = 800
+    LOW_WATERMARK = 200
+    # 差额轮询调度每轮给每个设备增加的额度（字节）
+    DRR_QUANTUM = 4096
+
+
+class MessageJournalEnum(Enum):
+    '''
+    消息预写日志相关常量
+    '''
+    # 开启后汇总队列接收的消息先写入日志，转发完成后确认，进程重启时重放未确认的消息
+    JOURNAL_ENABLED = False
+    # 日志目录，位于log目录下
+    JOURNAL_DIR_NAME = "journal"
+    # 分片控制器的每个工作进程使用日志目录下单独的子目录，子目录名为该前缀加分片编号；指标快照等文件名也带上该标识
+    SHARD_DIR_PREFIX = "shard-"
+    # 单个日志段文件的大小上限（字节），写满后新建日志段
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    # 组提交：写线程最多等待该时间（秒）凑够一批后再写入并fsync
+    GROUP_COMMIT_INTERVAL = 0.002
+    GROUP_COMMIT_SIZE = 512
+    # 压缩旧日志段的间隔（秒）
+    COMPACT_INTERVAL = 30
+    # 最旧的日志段中未确认的消息不超过该数量时，将其改写到当前日志段后删除旧日志段
+    COMPACT_MAX_REWRITE_ENTRIES = 1000
+
+
+class TrafficCaptureEnum(Enum):
+    '''
+    流量录制相关常量
+    开启后各channel放入汇总队列的消息和控制器对每条消息的路由结果写入录制文件，用于之后回放
+    '''
+    CAPTURE_ENABLED = False
+    # 录制文件目录，位于log目录下
+    CAPTURE_DIR_NAME = "capture"
+    CAPTURE_FILE_PREFIX = "capture-"
+    CAPTURE_FILE_SUFFIX = ".cap"
+    # 每隔该数量的记录写一条索引，回放时按时间定位
+    INDEX_INTERVAL = 1024
+    # 写缓冲大小（字节），以及后台把缓冲写入文件的间隔（秒）
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    FLUSH_INTERVAL = 1
@@ -0,0 +1,169 @@
+from enum import Enum
+
+
+class AsyncControllerEnum(Enum):
+    '''
+    单事件循环控制器相关常量
+    '''
+    # 执行阻塞操作（串口写入、MQTT发布等）的线程池大小
+    MAX_EXECUTOR_WORKERS = 16
+    # 并发处理消息的协程数量
+    PROCESS_WORKER_NUMBER = 8
+    # 事件循环内消息队列的最大长度
+    MESSAGE_QUEUE_SIZE = 10000
+    # MQTT断开后重新连接的等待时间（秒）
+    MQTT_RECONNECT_INTERVAL = 5
+    # WebSocket监听连接失败后重新连接的等待时间（秒）
+    WEBSOCKET_RECONNECT_INTERVAL = 5
+    # 串口打开失败后重新打开的等待时间（秒）
+    SERIAL_REOPEN_INTERVAL = 5
+
+
+class ShardedControllerEnum(Enum):
+    '''
+    多进程分片控制器相关常量
+    '''
+    # 分片（工作进程）数量，为0时使用CPU核数
+    SHARD_NUMBER = 0
+    # 一致性哈希环上每个分片的虚拟节点数量
+    VIRTUAL_NODE_NUMBER = 160
+    # 监督进程检查工作进程存活状态的间隔（秒）
+    SUPERVISE_INTERVAL = 1
+    # 工作进程崩溃后首次重启的等待时间（秒），连续崩溃时翻倍
+    RESTART_INTERVAL = 1
+    # 工作进程重启等待时间的上限（秒）
+    MAX_RESTART_INTERVAL = 60
+    # 工作进程持续运行超过该时间（秒）后，重启等待时间恢复为初始值
+    STABLE_RUNNING_TIME = 60
+
+
+class RoutingTableEnum(Enum):
+    '''
+    路由表相关常量
+    '''
+    # 路由表文件路径，相对于src目录
+    ROUTING_TABLE_FILE_PATH = "config/routing_table.json"
+    # 检查路由表文件是否被修改的间隔（秒）
+    RELOAD_CHECK_INTERVAL = 2
+    # 路由规则中匹配任意设备或任意命令的通配符
+    WILDCARD = "*"
+
+
+class MessageDedupEnum(Enum):
+    '''
+    重复消息过滤相关常量
+    '''
+    DEDUP_ENABLED = True
+    # 携带message_id的消息按（发送者, message_id）去重，有效期内最多记录的消息数量及有效期（秒）
+    MAX_MESSAGE_ID_NUMBER = 100000
+    MESSAGE_ID_TTL = 60
+    # 没有message_id的消息是否按内容去重；节点会重复发送相同的命令，因此默认关闭，开启时只在很短的时间内去重
+    DEDUP_BY_CONTENT = False
+    MAX_CONTENT_HASH_NUMBER = 10000
+    CONTENT_TTL = 1
+
+
+class SupervisorEnum(Enum):
+    '''
+    监听线程监督相关常量
+    '''
+    # 监听线程异常退出后首次重启的等待时间（秒），连续失败时按倍数增加，实际等待时间在[一半, 全部]之间随机
+    RESTART_MIN_DELAY = 0.5
+    RESTART_MAX_DELAY = 30
+    RESTART_BACKOFF_MULTIPLIER = 2
+    # 监听线程持续运行超过该时间（秒）后，重启等待时间恢复为初始值
+    STABLE_RUNNING_TIME = 60
+    # 监听线程的状态
+    STARTING_STATE = "starting"
+    RUNNING_STATE = "running"
+    BACKOFF_STATE = "backoff"
+    CIRCUIT_OPEN_STATE = "circuit_open"
+    STOPPED_STATE = "stopped"
+
+
+class CircuitBreakerEnum(Enum):
+    '''
+    按endpoint熔断相关常量
+    '''
+    CIRCUIT_BREAKER_ENABLED = True
+    # 连续失败达到该次数后断开，断开期间发往该endpoint的消息直接丢弃，监听线程暂停重启
+    FAILURE_THRESHOLD = 5
+    # 断开后经过该时间（秒）进入半开状态，只放行一次试探；试探失败时断开时间翻倍，实际时间带随机抖动
+    OPEN_TIME = 5
+    MAX_OPEN_TIME = 60
+    # 熔断器的状态，指标中分别输出为0、1、2
+    CLOSED_STATE = "closed"
+    HALF_OPEN_STATE = "half_open"
+    OPEN_STATE = "open"
+
+
+class TestFlowEnum(Enum):
+    '''
+    多设备测试流程调度相关常量
+    '''
+    # 同时执行的流程数量上限（所有设备合计）
+    MAX_CONCURRENT_FLOWS = 256
+    # 每个设备同时执行的流程数量，大于1时同一设备的多个流程流水线执行，回复按发送顺序匹配
+    PIPELINE_DEPTH = 1
+    # 每一步发送命令后等待设备回复的时间（秒）
+    STEP_TIMEOUT = 10
+    # 各协议每秒最多发送的命令数量，未配置或为0时不限制；允许的突发数量
+    PROTOCOL_RATE_LIMIT = {}
+    RATE_LIMIT_BURST = 10
+    # 沿路由表展开命令链时的最大步数
+    MAX_STEP_NUMBER = 100
+    # 执行发送的线程数量
+    SEND_WORKER_NUMBER = 32
+    # 拉起监听后等待连接建立的时间（秒）
+    STARTUP_DELAY = 1
+    # 步骤和流程的结果
+    PASSED_STATUS = "passed"
+    FAILED_STATUS = "failed"
+    TIMEOUT_STATUS = "timeout"
+    SEND_FAILED_STATUS = "send_failed"
+
+
+class ClusterEnum(Enum):
+    '''
+    多节点集群相关常量
+    各节点定期向其他节点通告自己拥有的设备（本机的串口、连接到本机WebSocket服务器的设备），
+    发往其他节点设备的命令通过到该节点的持久化连接批量转发
+    '''
+    CLUSTER_ENABLED = False
+    # 节点ID，为空时使用"主机名:监听端口"
+    NODE_ID = ""
+    # 节点间连接的监听地址，以及通告给其他节点的连接地址
+    LISTEN_HOST = "0.0.0.0"
+    LISTEN_PORT = 9200
+    ADVERTISE_HOST = "127.0.0.1"
+    # 启动时连接的其他节点"host:port"，其余节点通过通告中的成员表发现
+    PEER_ADDRESS_LIST = ()
+    # 通告间隔（秒），同时作为心跳；超过NODE_EXPIRE_TIME没有收到通告的节点及其设备从成员表中移除
+    ANNOUNCE_INTERVAL = 1
+    NODE_EXPIRE_TIME = 5
+    # 每个节点连接上待发送的最大消息数量，满时丢弃新消息；每帧最多合并的消息数量
+    MAX_PENDING_MESSAGES = 100000
+    MAX_BATCH_SIZE = 500
+    # 建立连接的超时时间，以及断开后重连的最小、最大等待时间（秒）
+    CONNECT_TIMEOUT = 3
+    RECONNECT_MIN_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 10
+    # 集群模式下各节点以该共享订阅组订阅MQTT上行消息，每条消息只由一个节点处理
+    MQTT_SHARE_GROUP = "controller"
+    # 同一台机器上运行多个节点时，各节点的消息日志子目录、指标快照等文件名带上该前缀加节点间连接的监听端口
+    NODE_TAG_PREFIX = "node-"
+    # 帧类型
+    ANNOUNCE_FRAME = "announce"
+    FORWARD_FRAME = "forward"
+
+
+class TrafficReplayEnum(Enum):
+    '''
+    流量回放相关常量
+    回放按录制时的时间间隔把消息放入汇总队列，SPEED为时间压缩倍数，0表示不等待、按控制器的最大速度回放
+    '''
+    SPEED = 1.0
+    # 所有消息放入队列后，超过该时间（秒）没有新的路由结果时结束回放
+    IDLE_TIMEOUT = 5
+    # 报告中最多列出的路由不一致的消息数量
+    MAX_MISMATCH_EXAMPLES = 20
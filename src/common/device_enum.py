@@ -0,0 +1,23 @@
+from enum import Enum
+
+
+class DevicePresenceEnum(Enum):
+    '''
+    设备在线状态相关常量
+    '''
+    # 后台扫描串口设备的间隔（秒）
+    POLL_INTERVAL = 1
+    # 执行hdc查询开发板序列号的间隔（秒），hdc较慢，两次查询之间沿用上次的结果
+    HDC_POLL_INTERVAL = 10
+    HDC_COMMAND = "hdc_std list targets"
+    HDC_TIMEOUT = 5
+    # hdc没有设备连接时的输出
+    HDC_EMPTY_OUTPUT = "[Empty]"
+    # 设备最后一次被扫描到之后，在该时间（秒）内都视为在线，避免偶发的扫描遗漏导致状态抖动
+    PRESENCE_TTL = 5
+    # 通过sysfs读取USB串口序列号时扫描的串口设备
+    SERIAL_DEVICE_PATTERN = "/dev/ttyUSB*"
+    SYSFS_TTY_PATH = "/sys/class/tty"
+    # 在线状态变化事件
+    CONNECT_EVENT = "connect"
+    DISCONNECT_EVENT = "disconnect"
@@ -36,3 +36,9 @@ class DeviceCommandError(Exception):
 
     def __str__(self):
         return str(self.error_msg)
+
+
+class CircuitOpenError(CommonError):
+    '''
+    endpoint处于熔断状态，消息未发送
+    '''
@@ -0,0 +1,31 @@
+from enum import Enum
+
+
+class LogEnum(Enum):
+    '''
+    日志相关常量
+    '''
+    # 日志级别，低于该级别的日志在调用处直接丢弃，不会拼接消息
+    LOG_LEVEL = "info"
+    # 是否同时写入源码根目录下的log目录，找不到log目录时只输出到控制台
+    LOG_TO_FILE = True
+    # 日志队列的最大长度
+    QUEUE_SIZE = 10000
+    # 队列满时的丢弃策略：drop_new丢弃新日志，drop_old丢弃最旧的日志
+    DROP_POLICY = "drop_new"
+    # 后台线程单次最多写出的日志条数
+    BATCH_SIZE = 512
+    # 队列为空时后台线程的轮询间隔（秒）
+    FLUSH_INTERVAL = 0.05
+    # 单个日志文件的最大大小（字节），超出后切换到新文件；日志文件同时按天切换
+    MAX_FILE_SIZE = 50 * 1024 * 1024
+
+
+class LogLevelEnum(Enum):
+    '''
+    日志级别及其优先级
+    '''
+    debug = 10
+    info = 20
+    warning = 30
+    error = 40
@@ -0,0 +1,313 @@
+import zlib
+import struct
+import threading
+import collections
+
+from common.exception import DeviceCommandError
+from common.message_format import MessageWireFormatEnum
+
+DeviceMessage = collections.namedtuple("DeviceMessage", ["header", "command", "protocol", "receiver", "wire_format"],
+                                       defaults=(None,))
+SymbolTable = collections.namedtuple("SymbolTable", ["symbol_list", "symbol_id_dict", "table_id"])
+
+BINARY_HEADER_STRUCT = struct.Struct(">BBBHH")
+SYMBOL_ID_STRUCT = struct.Struct(">H")
+SYMBOL_ID_STRUCT_DICT = {3: struct.Struct(">HHH"), 4: struct.Struct(">HHHH")}
+# 编解码在每条消息的热路径上，枚举取值较慢，预先取出
+BINARY_MAGIC = MessageWireFormatEnum.BINARY_MAGIC.value
+BINARY_VERSION = MessageWireFormatEnum.BINARY_VERSION.value
+BINARY_HEADER_LENGTH = MessageWireFormatEnum.BINARY_HEADER_LENGTH.value
+BINARY_FLAG_HAS_HEADER = MessageWireFormatEnum.BINARY_FLAG_HAS_HEADER.value
+BINARY_FLAG_HAS_MESSAGE_ID = MessageWireFormatEnum.BINARY_FLAG_HAS_MESSAGE_ID.value
+LITERAL_SYMBOL_ID = MessageWireFormatEnum.LITERAL_SYMBOL_ID.value
+BINARY_FORMAT = MessageWireFormatEnum.BINARY_FORMAT.value
+TEXT_FORMAT = MessageWireFormatEnum.TEXT_FORMAT.value
+FORMAT_FIELD_NAME = MessageWireFormatEnum.FORMAT_FIELD_NAME.value
+MESSAGE_ID_FIELD_NAME = MessageWireFormatEnum.MESSAGE_ID_FIELD_NAME.value
+MESSAGE_ID_FIELD_TEXT = MESSAGE_ID_FIELD_NAME + ":"
+MESSAGE_ID_FIELD_BYTES = MESSAGE_ID_FIELD_TEXT.encode()
+# 所有部署都会用到的协议名，预先放入符号表
+DEFAULT_SYMBOL_LIST = ["MQTT", "WebSocket", "Modbus"]
+
+
+class MessageCodec(object):
+    default_codec = None
+    default_codec_lock = threading.Lock()
+
+    def __init__(self, symbol_list=()):
+        '''
+        消息编解码器，支持原有的"key: value\r\n"文本格式和带长度前缀的二进制格式
+        二进制格式中command、protocol和设备ID使用符号表中的编号表示，符号表不一致时退回文本格式
+        解码时根据首字节自动识别格式，编码时按与对端协商的结果选择格式，未协商的对端使用文本格式
+        :param symbol_list: 需要编号的command和设备ID
+        '''
+        self.symbol_table = SymbolTable([], {}, 0)
+        # 对端设备ID -> 协商后的编码格式
+        self.peer_format_dict = {}
+        self.register_symbols(DEFAULT_SYMBOL_LIST + list(symbol_list))
+
+    @classmethod
+    def get_default_codec(cls):
+        '''
+        获取进程内共享的编解码器，各channel和控制器使用同一份符号表
+        :return: codec
+        '''
+        with cls.default_codec_lock:
+            if cls.default_codec is None:
+                cls.default_codec = cls()
+            return cls.default_codec
+
+    def register_symbols(self, symbol_list):
+        '''
+        将command和设备ID加入符号表，符号表按字典序排列，两端注册相同的符号即可得到相同的编号
+        :return:
+        '''
+        symbol_set = set(self.symbol_table.symbol_list)
+        symbol_set.update(str(symbol) for symbol in symbol_list)
+        if len(symbol_set) == len(self.symbol_table.symbol_list):
+            return
+        if len(symbol_set) >= LITERAL_SYMBOL_ID:
+            raise DeviceCommandError("Too many symbols for binary message format!")
+        new_symbol_list = sorted(symbol_set)
+        # 整体替换符号表，其他线程编解码时不会取到不一致的编号
+        self.symbol_table = SymbolTable(new_symbol_list,
+                                        {symbol: symbol_id for symbol_id, symbol in enumerate(new_symbol_list)},
+                                        zlib.crc32("\n".join(new_symbol_list).encode()) & 0xFFFF)
+        # 符号表变化后原来的协商结果失效，对端需要重新声明格式
+        self.peer_format_dict = {}
+
+    def get_supported_formats(self):
+        '''
+        本端支持的编码格式，按优先级排列
+        :return: 如"binary/1;table=1234,text"
+        '''
+        return BINARY_FORMAT + ";table=" + str(self.symbol_table.table_id) + "," + \
+            TEXT_FORMAT
+
+    def negotiate_format(self, peer_id, peer_format_text):
+        '''
+        根据对端声明的格式列表选择双方都支持的格式，符号表不一致时不能使用二进制格式
+        :return: 协商后的格式
+        '''
+        wire_format = TEXT_FORMAT
+        for peer_format in peer_format_text.split(","):
+            format_name, _, format_option = peer_format.strip().partition(";")
+            if format_name != BINARY_FORMAT:
+                continue
+            if format_option == "table=" + str(self.symbol_table.table_id):
+                wire_format = BINARY_FORMAT
+                break
+        self.peer_format_dict[peer_id] = wire_format
+        return wire_format
+
+    def get_peer_format(self, peer_id):
+        return self.peer_format_dict.get(peer_id, TEXT_FORMAT)
+
+    def encode_message(self, command, protocol, receiver_device_id, header=None, wire_format=None):
+        '''
+        编码发送给节点的消息，未指定格式时按接收者协商的格式编码
+        :return: 文本格式返回str，二进制格式返回bytes
+        '''
+        if wire_format is None:
+            wire_format = self.get_peer_format(receiver_device_id)
+        if wire_format == BINARY_FORMAT:
+            return self.encode_binary_message(command, protocol, receiver_device_id, header)
+        message = f"command: {command}\r\nprotocol: {protocol}\r\nreceiver: {receiver_device_id}"
+        if header is not None:
+            message = f"header: {header}\r\n" + message
+        return message
+
+    def encode_binary_message(self, command, protocol, receiver_device_id, header=None, message_id=None):
+        '''
+        编码二进制帧，符号表中不存在的字段按字符串原样写入
+        :return: bytes
+        '''
+        flags = 0
+        field_list = [command, protocol, receiver_device_id]
+        if header is not None:
+            flags |= BINARY_FLAG_HAS_HEADER
+            field_list.insert(0, header)
+        if message_id is not None:
+            flags |= BINARY_FLAG_HAS_MESSAGE_ID
+            field_list.append(message_id)
+        body = bytearray()
+        symbol_table = self.symbol_table
+        symbol_id_dict = symbol_table.symbol_id_dict
+        for field in field_list:
+            symbol_id = symbol_id_dict.get(field)
+            if symbol_id is not None:
+                body += SYMBOL_ID_STRUCT.pack(symbol_id)
+                continue
+            literal = str(field).encode()
+            if len(literal) > 0xFF:
+                raise DeviceCommandError("Field is too long for binary message format: " + str(field))
+            body += SYMBOL_ID_STRUCT.pack(LITERAL_SYMBOL_ID)
+            body.append(len(literal))
+            body += literal
+        frame_header = BINARY_HEADER_STRUCT.pack(BINARY_MAGIC,
+                                                 BINARY_VERSION,
+                                                 flags, symbol_table.table_id, len(body))
+        return frame_header + bytes(body)
+
+    @staticmethod
+    def is_binary_message(data):
+        return isinstance(data, (bytes, bytearray, memoryview)) and len(data) > 0 and \
+            data[0] == BINARY_MAGIC
+
+    @staticmethod
+    def get_binary_frame_length(data):
+        '''
+        从缓冲区开头的二进制帧头读取整帧长度，用于流式读取时切分帧
+        :return: 整帧长度，帧头不完整时返回None
+        '''
+        if len(data) < BINARY_HEADER_LENGTH:
+            return None
+        body_length = BINARY_HEADER_STRUCT.unpack_from(data)[4]
+        return BINARY_HEADER_LENGTH + body_length
+
+    def decode_message(self, data):
+        '''
+        解码节点发来的消息，自动识别文本格式和二进制格式
+        :return: DeviceMessage
+        '''
+        if self.is_binary_message(data):
+            return self.decode_binary_message(data)
+        if not isinstance(data, str):
+            data = bytes(data).decode(errors="replace")
+        return self.decode_text_message(data)
+
+    @staticmethod
+    def split_binary_fields(data):
+        '''
+        按帧头中的长度切分二进制帧的各字段，不查符号表
+        :return: [字段的原始编码, ...]，帧不完整时返回空列表
+        '''
+        if len(data) < BINARY_HEADER_LENGTH:
+            return []
+        frame_length = BINARY_HEADER_LENGTH + BINARY_HEADER_STRUCT.unpack_from(data)[4]
+        if len(data) < frame_length:
+            return []
+        field_list = []
+        offset = BINARY_HEADER_LENGTH
+        while offset + SYMBOL_ID_STRUCT.size <= frame_length:
+            next_offset = offset + SYMBOL_ID_STRUCT.size
+            if SYMBOL_ID_STRUCT.unpack_from(data, offset)[0] == LITERAL_SYMBOL_ID:
+                if next_offset >= frame_length:
+                    return []
+                next_offset += 1 + data[next_offset]
+            if next_offset > frame_length:
+                return []
+            field_list.append(bytes(data[offset:next_offset]))
+            offset = next_offset
+        return field_list
+
+    @classmethod
+    def get_message_id(cls, data):
+        '''
+        不完整解码，只取出消息的发送者和message_id字段，用于在路由前过滤重复消息
+        二进制消息不查符号表，返回header和message_id字段的原始编码
+        :return: (header, message_id)，没有message_id字段时返回None
+        '''
+        if cls.is_binary_message(data):
+            if len(data) < BINARY_HEADER_LENGTH or not data[2] & BINARY_FLAG_HAS_MESSAGE_ID:
+                return None
+            has_header = data[2] & BINARY_FLAG_HAS_HEADER
+            field_list = cls.split_binary_fields(data)
+            if len(field_list) < (5 if has_header else 4):
+                return None
+            return (field_list[0] if has_header else None), field_list[4 if has_header else 3]
+        if isinstance(data, str):
+            if MESSAGE_ID_FIELD_TEXT not in data:
+                return None
+        elif isinstance(data, (bytes, bytearray)):
+            if MESSAGE_ID_FIELD_BYTES not in data or cls.is_binary_message(data):
+                return None
+            data = bytes(data).decode(errors="replace")
+        else:
+            return None
+        header = message_id = None
+        for line in data.splitlines():
+            key, _, value = line.partition(":")
+            key = key.strip()
+            if key == "header":
+                header = value.strip()
+            elif key == MESSAGE_ID_FIELD_NAME:
+                message_id = value.strip()
+        return None if message_id is None else (header, message_id)
+
+    @classmethod
+    def get_message_sender(cls, data):
+        '''
+        不完整解码，只取出消息的发送者，二进制消息返回header字段的原始编码
+        :return: 发送者，没有header时返回None
+        '''
+        if cls.is_binary_message(data):
+            if len(data) < BINARY_HEADER_LENGTH or not data[2] & BINARY_FLAG_HAS_HEADER:
+                return None
+            field_list = cls.split_binary_fields(data)
+            return field_list[0] if field_list else None
+        if isinstance(data, (bytes, bytearray)):
+            data = bytes(data).decode(errors="replace")
+        elif not isinstance(data, str):
+            return None
+        for line in data.splitlines():
+            key, _, value = line.partition(":")
+            if key.strip() == "header":
+                return value.strip()
+        return None
+
+    @staticmethod
+    def decode_text_message(text):
+        field_dict = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            key, separator, value = line.partition(":")
+            if not separator:
+                raise DeviceCommandError("Malformed message: " + text)
+            field_dict[key.strip()] = value.strip()
+        return DeviceMessage(field_dict.get("header"), field_dict.get("command"), field_dict.get("protocol"),
+                             field_dict.get("receiver"),
+                             field_dict.get(FORMAT_FIELD_NAME))
+
+    def decode_binary_message(self, data):
+        if len(data) < BINARY_HEADER_LENGTH:
+            raise DeviceCommandError("Truncated binary message")
+        magic, version, flags, symbol_table_id, body_length = BINARY_HEADER_STRUCT.unpack_from(data)
+        if version != BINARY_VERSION:
+            raise DeviceCommandError("Unsupported binary message version: " + str(version))
+        offset = BINARY_HEADER_LENGTH
+        if len(data) < offset + body_length:
+            raise DeviceCommandError("Truncated binary message")
+        symbol_table = self.symbol_table
+        field_number = 4 if flags & BINARY_FLAG_HAS_HEADER else 3
+        try:
+            if body_length == SYMBOL_ID_STRUCT.size * field_number and symbol_table_id == symbol_table.table_id:
+                # 所有字段都在符号表中时一次性解出全部编号
+                symbol_list = symbol_table.symbol_list
+                field_list = [symbol_list[symbol_id] for symbol_id in
+                              SYMBOL_ID_STRUCT_DICT[field_number].unpack_from(data, offset)]
+            else:
+                field_list = self.decode_binary_fields(memoryview(data), offset, field_number, symbol_table_id,
+                                                       symbol_table)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise DeviceCommandError("Malformed binary message: " + str(e))
+        if field_number == 3:
+            field_list.insert(0, None)
+        return DeviceMessage(*field_list)
+
+    @staticmethod
+    def decode_binary_fields(view, offset, field_number, symbol_table_id, symbol_table):
+        field_list = []
+        for _ in range(field_number):
+            symbol_id = SYMBOL_ID_STRUCT.unpack_from(view, offset)[0]
+            offset += SYMBOL_ID_STRUCT.size
+            if symbol_id == LITERAL_SYMBOL_ID:
+                literal_length = view[offset]
+                field_list.append(bytes(view[offset + 1:offset + 1 + literal_length]).decode())
+                offset += 1 + literal_length
+            elif symbol_table_id != symbol_table.table_id:
+                raise DeviceCommandError("Binary message uses unknown symbol table: " + str(symbol_table_id))
+            else:
+                field_list.append(symbol_table.symbol_list[symbol_id])
+        return field_list
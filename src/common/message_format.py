@@ -12,3 +12,27 @@ class MessageFormatEnum(Enum):
     RECEIVING_COMMAND_POSITION = 1
     RECEIVING_PROTOCOL_POSITION = 2
     RECEIVING_RECEIVER_POSITION = 3
+
+
+class MessageWireFormatEnum(Enum):
+    '''
+    消息的线上编码格式
+    文本格式即上面的"key: value\r\n"格式；二进制格式为定长帧头加字段，帧头依次为：
+    magic(1字节) version(1字节) flags(1字节) symbol_table_id(2字节) body_length(2字节)，均为大端序
+    帧体依次为header（flags标记时存在）、command、protocol、receiver、message_id（flags标记时存在），
+    每个字段为2字节的符号编号，编号为LITERAL_SYMBOL_ID时后面紧跟1字节长度和utf-8字符串
+    message_id位于帧体末尾，不识别该标记的解码器读完receiver后忽略剩余字节，因此不需要升级版本号
+    '''
+    TEXT_FORMAT = "text"
+    BINARY_FORMAT = "binary/1"
+    # 二进制帧的首字节，不是ASCII字符，因此可以和文本格式区分
+    BINARY_MAGIC = 0xA5
+    BINARY_VERSION = 1
+    BINARY_HEADER_LENGTH = 7
+    BINARY_FLAG_HAS_HEADER = 0x01
+    BINARY_FLAG_HAS_MESSAGE_ID = 0x02
+    LITERAL_SYMBOL_ID = 0xFFFF
+    # 节点声明自身支持的编码格式时使用的字段名，如"header: A\r\nformat: binary/1;table=1234,text"
+    FORMAT_FIELD_NAME = "format"
+    # 文本格式中可选的消息编号字段，同一发送者重复发送同一编号的消息时只转发一次，如"header: A\r\nmessage_id: 42\r\n..."
+    MESSAGE_ID_FIELD_NAME = "message_id"
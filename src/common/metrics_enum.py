@@ -0,0 +1,18 @@
+from enum import Enum
+
+
+class MetricsEnum(Enum):
+    '''
+    监控指标相关常量
+    '''
+    # 关闭后所有指标都是空操作，埋点几乎没有开销
+    METRICS_ENABLED = True
+    # 以Prometheus文本格式提供指标的HTTP地址，端口为0时不启动
+    HTTP_HOST = "127.0.0.1"
+    HTTP_PORT = 9108
+    HTTP_PATH = "/metrics"
+    # 定期将指标快照写入log目录的间隔（秒），为0时不写
+    SNAPSHOT_INTERVAL = 60
+    SNAPSHOT_FILE_NAME = "metrics_snapshot.json"
+    # 直方图默认的桶上界（秒）
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
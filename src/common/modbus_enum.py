@@ -7,3 +7,40 @@ class ModbusSerialEnum(Enum):
     '''
     BAND_RATE_ENUM = 115200
     SERIAL_TIMEOUT_ENUM = 5
+    # 串口上文本消息之间的分隔符
+    TEXT_FRAME_DELIMITER = b"\r\n\r\n"
+    # 串口接收缓冲区大小（字节），需大于单条消息的最大长度
+    RECEIVE_BUFFER_SIZE = 4096
+    # 串口帧格式：text为文本/二进制消息帧，rtu为Modbus RTU帧
+    FRAME_MODE = "text"
+
+
+class ModbusRTUEnum(Enum):
+    '''
+    Modbus RTU帧相关常量
+    '''
+    # RTU帧最短为地址、功能码加2字节CRC，最长256字节
+    MIN_FRAME_LENGTH = 4
+    MAX_FRAME_LENGTH = 256
+    # 功能码最高位为1表示异常响应
+    EXCEPTION_FUNCTION_FLAG = 0x80
+
+
+class SerialPortEnum(Enum):
+    '''
+    串口管理相关常量
+    '''
+    # 每个串口等待写入的消息数量上限
+    WRITE_QUEUE_SIZE = 1000
+    # 文本模式下一次合并写入的最大字节数
+    MAX_COALESCE_SIZE = 4096
+    # 等待消息写入串口的超时时间（秒）
+    WRITE_TIMEOUT = 5
+    # 串口异常后首次重新打开的等待时间（秒），连续失败时翻倍，直到MAX_REOPEN_INTERVAL
+    REOPEN_INTERVAL = 0.5
+    MAX_REOPEN_INTERVAL = 30
+    # RTU帧之间至少间隔3.5个字符时间，每个字符按11位计算；波特率高于19200时固定为1.75毫秒
+    RTU_FRAME_GAP_CHARACTERS = 3.5
+    RTU_CHARACTER_BITS = 11
+    RTU_FIXED_GAP_BAUDRATE = 19200
+    RTU_FIXED_FRAME_GAP = 0.00175
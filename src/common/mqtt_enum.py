@@ -34,3 +34,59 @@ class CommonEnum(Enum):
     MQTT服务器超时时间
     '''
     MQTT_TIMEOUT_ENUM = 60
+
+
+class MQTTPublisherEnum(Enum):
+    '''
+    持久化发布者会话相关常量
+    '''
+    # 是否使用持久化发布者会话，关闭时每次发布都会重新连接服务器
+    PERSISTENT_PUBLISHER = True
+    # 发布消息使用的QoS等级
+    PUBLISH_QOS = 1
+    # 同时等待服务器确认的最大消息数量
+    MAX_INFLIGHT_MESSAGES = 20
+    # 攒批等待时间（秒），第一条消息入队后最多等待该时间再统一发送
+    LINGER_TIME = 0.005
+    # 单批次最多发送的消息数量
+    MAX_BATCH_SIZE = 100
+    # 待发送队列的最大长度
+    MAX_PENDING_MESSAGES = 10000
+    # 关闭发布者时等待剩余消息发送完成的最长时间（秒）
+    CLOSE_TIMEOUT = 5
+    # 关闭时检查剩余消息是否发送完成的间隔（秒）
+    CLOSE_POLL_INTERVAL = 0.005
+    # 待发送队列满时入队的最长等待时间（秒），超时后该消息失败
+    ENQUEUE_TIMEOUT = 1
+    # 在途消息达到上限时等待空位的最长时间（秒），服务器断开期间在途消息得不到确认，超时后该批次剩余的消息失败
+    INFLIGHT_TIMEOUT = 5
+
+
+class MQTTTopicEnum(Enum):
+    '''
+    设备topic命名规则，{device_id}所在的层级为设备ID
+    '''
+    DEVICE_ID_PLACEHOLDER = "{device_id}"
+    # 设备上行消息的topic模板，每个模板对应一个设备分组，订阅时{device_id}替换为通配符+
+    UPLINK_TOPIC_TEMPLATES = ("devices/{device_id}/up",)
+    # 下发给设备的topic，与上行topic不同，控制器不会收到自己发布的消息
+    DOWNLINK_TOPIC_TEMPLATE = "devices/{device_id}/down"
+    # 共享订阅前缀（MQTT 5，EMQX、Mosquitto 2.0等也支持MQTT 3.1.1客户端使用）
+    SHARE_SUBSCRIPTION_PREFIX = "$share/"
+
+
+class MQTTSubscriberEnum(Enum):
+    '''
+    共享订阅者相关常量
+    '''
+    # 订阅上行topic使用的QoS等级
+    SUBSCRIBE_QOS = 0
+    # 等待控制器取走的消息数量上限，超出后丢弃新消息
+    MAX_PENDING_MESSAGES = 100000
+    # 控制器每次最多取走的消息数量
+    MAX_BATCH_SIZE = 500
+    # 控制器等待新消息的最长时间（秒）
+    DRAIN_TIMEOUT = 1
+    # 断开后重新连接的等待时间（秒），连续失败时翻倍直到上限
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 30
@@ -0,0 +1,27 @@
+from enum import Enum
+
+
+class TracingEnum(Enum):
+    '''
+    消息链路追踪相关常量
+    '''
+    # 关闭后消息不携带追踪上下文，各阶段打点只做一次属性查找
+    TRACING_ENABLED = True
+    # 每SAMPLE_INTERVAL条接收到的消息采样一条，为1时追踪所有消息
+    SAMPLE_INTERVAL = 100
+    # 环形缓冲区保留的最近完成的追踪数量
+    RING_BUFFER_SIZE = 10000
+    # 定期将环形缓冲区写入log目录的间隔（秒），为0时不写
+    DUMP_INTERVAL = 60
+    DUMP_FILE_NAME = "message_traces.json"
+    # 各阶段名称，发送阶段名称后接协议，例如send_MQTT
+    RECEIVE_STAGE = "receive"
+    CHANNEL_DEQUEUE_STAGE = "channel_dequeue"
+    ENQUEUE_STAGE = "enqueue"
+    DEQUEUE_STAGE = "dequeue"
+    ROUTE_STAGE = "route"
+    SEND_STAGE_PREFIX = "send_"
+    # 队列已满被丢弃的消息以该阶段结束
+    DROPPED_STAGE = "dropped"
+    # 重复消息被过滤时以该阶段结束
+    DUPLICATE_STAGE = "duplicate"
@@ -7,4 +7,38 @@ class WebsocketEnum(Enum):
     '''
     WEBSOCKET_HOST = "0.0.0.0"
     WEBSOCKET_PORT = 5678
-    WEBSOCKET_TIMEOUT_ENUM = 10
\ No newline at end of file
+    WEBSOCKET_TIMEOUT_ENUM = 10
+
+
+class WebsocketHubEnum(Enum):
+    '''
+    WebSocket服务器路由中心相关常量
+    设备连接后发送"register: {device_id}"登记自身，之后该连接上发来的消息都视为该设备的上行消息，
+    发给该设备的下行消息也通过这个连接推送；订阅者发送"subscribe: {device_id}"订阅指定设备的上行消息，
+    device_id为SUBSCRIBE_ALL时订阅所有设备
+    未登记的连接发来带header的消息视为设备上行消息并自动登记，不带header的消息按receiver转发给对应设备
+    '''
+    REGISTER_FIELD_NAME = "register"
+    SUBSCRIBE_FIELD_NAME = "subscribe"
+    SUBSCRIBE_ALL = "*"
+    # 每个连接发送队列的最大长度，连接消费过慢导致队列满时丢弃新消息
+    SEND_QUEUE_SIZE = 1000
+    # 客户端在下行消息前加一行"id: {correlation_id}"，服务器的回复带上同一个编号，
+    # 如"id: 17\r\ndelivered: A"，从而在一个连接上同时等待多条消息的结果
+    CORRELATION_FIELD_NAME = "id"
+    DELIVERED_FIELD_NAME = "delivered"
+    UNDELIVERED_FIELD_NAME = "undelivered"
+
+
+class WebsocketClientEnum(Enum):
+    '''
+    WebSocket持久化客户端连接相关常量
+    '''
+    # 心跳间隔和等待心跳回复的超时时间（秒）
+    PING_INTERVAL = 20
+    PING_TIMEOUT = 20
+    # 断开后首次重连的等待时间（秒），连续失败时翻倍，直到MAX_RECONNECT_INTERVAL
+    RECONNECT_INTERVAL = 1
+    MAX_RECONNECT_INTERVAL = 30
+    # 一个连接上同时等待服务器回复的消息数量上限
+    MAX_INFLIGHT_REQUESTS = 1000
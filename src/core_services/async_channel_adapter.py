@@ -0,0 +1,152 @@
+import asyncio
+import paho.mqtt.client as mqtt
+
+from common.controller_enum import AsyncControllerEnum
+from common.mqtt_enum import CommonEnum
+from common.tracing_enum import TracingEnum
+from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+from util.tracing import mark_stage
+
+ENQUEUE_STAGE = TracingEnum.ENQUEUE_STAGE.value
+DROPPED_STAGE = TracingEnum.DROPPED_STAGE.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
+
+
+class AsyncioQueueAdapter:
+    def __init__(self, loop, message_queue):
+        '''
+        将asyncio.Queue包装为各channel使用的queue.Queue接口，任意线程调用put都会安全地投递到事件循环中
+        :return:
+        '''
+        self.loop = loop
+        self.message_queue = message_queue
+        self.logger = Logger("AsyncioQueueAdapter")
+        # 开启消息日志和流量录制时由控制器设置
+        self.message_journal = None
+        self.traffic_capture = None
+
+    def bind_source(self, protocol_type, device_id):
+        '''
+        只按queue.Queue接口放入消息的channel使用的队列，放入的消息带上来源协议和设备ID
+        :return: SourceQueueAdapter
+        '''
+        return SourceQueueAdapter(self, protocol_type, device_id)
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.put_received_message, message, "", None)
+
+    def put_nowait(self, message):
+        self.put_received_message(message, "", None)
+
+    def put_received_message(self, message, device_id, protocol_type):
+        '''
+        在事件循环线程中放入消息，开启流量录制和消息日志时先写入录制文件和日志，来源协议未知的消息不录制
+        :return:
+        '''
+        mark_stage(message, ENQUEUE_STAGE)
+        if self.traffic_capture is not None and protocol_type is not None:
+            message = self.traffic_capture.capture_inbound(message, device_id, protocol_type)
+        if self.message_journal is not None:
+            message = self.message_journal.append_message(message, device_id)
+        try:
+            self.message_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.logger.error("asyncio message queue is full, drop message: " + str(message))
+            mark_stage(message, DROPPED_STAGE)
+            MESSAGE_TRACER.finish_trace(message)
+            if self.message_journal is not None:
+                self.message_journal.acknowledge_message(message)
+
+    def qsize(self):
+        return self.message_queue.qsize()
+
+
+class SourceQueueAdapter:
+    def __init__(self, queue_adapter, protocol_type, device_id):
+        '''
+        单个设备单个协议的监听使用的队列接口，放入的消息交给AsyncioQueueAdapter并带上来源
+        :return:
+        '''
+        self.queue_adapter = queue_adapter
+        self.protocol_type = protocol_type
+        self.device_id = device_id
+
+    def put(self, message):
+        self.queue_adapter.loop.call_soon_threadsafe(self.put_nowait, message)
+
+    def put_nowait(self, message):
+        self.queue_adapter.put_received_message(message, self.device_id, self.protocol_type)
+
+    def qsize(self):
+        return self.queue_adapter.qsize()
+
+
+class MQTTAsyncioAdapter:
+    def __init__(self, loop, client):
+        '''
+        将paho客户端的网络读写挂到asyncio事件循环上，替代loop_forever/loop_start的独立线程
+        :return:
+        '''
+        self.loop = loop
+        self.client = client
+        self.logger = Logger("MQTTAsyncioAdapter")
+        self.misc_task = None
+        self.disconnected_future = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # paho可能在执行connect的线程池线程中触发以下回调，统一切换回事件循环线程注册读写
+    # 切换线程后socket可能已被关闭，因此在回调中先取出文件描述符
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.register_socket, sock.fileno())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.unregister_socket, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock.fileno())
+
+    def register_socket(self, sock_fd):
+        self.loop.add_reader(sock_fd, self.client.loop_read)
+        self.misc_task = self.loop.create_task(self.run_loop_misc())
+
+    def unregister_socket(self, sock_fd):
+        self.loop.remove_reader(sock_fd)
+        self.loop.remove_writer(sock_fd)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+        if self.disconnected_future is not None and not self.disconnected_future.done():
+            self.disconnected_future.set_result(True)
+
+    async def run_loop_misc(self):
+        '''
+        定时处理心跳和超时重发
+        :return:
+        '''
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def run_client(self, host, port):
+        '''
+        连接服务器并在断开后等待一段时间重新连接，协程不会主动退出
+        建立TCP连接是阻塞操作，放到线程池中执行以免卡住事件循环
+        :return:
+        '''
+        while True:
+            self.disconnected_future = self.loop.create_future()
+            try:
+                await self.loop.run_in_executor(None, self.client.connect, host, port,
+                                                CommonEnum.MQTT_TIMEOUT_ENUM.value)
+            except OSError as e:
+                self.logger.error("An error occurred when connected to the mqtt server: " + str(e))
+            else:
+                await self.disconnected_future
+                self.logger.warning("mqtt connection to " + host + " closed, reconnecting")
+            await asyncio.sleep(AsyncControllerEnum.MQTT_RECONNECT_INTERVAL.value)
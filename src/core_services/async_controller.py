@@ -0,0 +1,294 @@
+import time
+import asyncio
+import functools
+import concurrent.futures
+import serial
+
+from common.controller_enum import AsyncControllerEnum
+from common.exception import DeviceCommandError
+from common.mqtt_enum import MQTTReturnCode
+from common.mqtt_enum import MQTTServerEnum
+from common.mqtt_enum import MQTTSubscriberEnum
+from common.tracing_enum import TracingEnum
+from common.websocket_enum import WebsocketEnum
+from core_services.async_channel_adapter import AsyncioQueueAdapter
+from core_services.async_channel_adapter import MQTTAsyncioAdapter
+from core_services.controller import Controller
+from core_services.controller_metrics import FORWARD_LATENCY
+from core_services.controller_metrics import MESSAGES_RECEIVED
+from core_services.controller_metrics import METRICS_REGISTRY
+from core_services.controller_metrics import QUEUE_DEPTH
+from core_services.controller_metrics import SHED_MESSAGES
+from core_services.controller_metrics import record_connection
+from core_services.modbus_channel import ModBusChannel
+from core_services.mqtt_channel import MQTTChannel
+from core_services.mqtt_subscriber import get_uplink_topic_filters
+from core_services.serial_frame_parser import SerialFrameParser
+from core_services.serial_port_manager import SerialPort
+from core_services.websocket_channel import WebSocketChannel
+from util.circuit_breaker import get_endpoint_circuit_breaker
+from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+from util.tracing import mark_stage
+
+DEQUEUE_STAGE = TracingEnum.DEQUEUE_STAGE.value
+ROUTE_STAGE = TracingEnum.ROUTE_STAGE.value
+SEND_STAGE_PREFIX = TracingEnum.SEND_STAGE_PREFIX.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
+
+
+class AsyncController(Controller):
+
+    def __init__(self, max_executor_workers=AsyncControllerEnum.MAX_EXECUTOR_WORKERS.value,
+                 process_worker_number=AsyncControllerEnum.PROCESS_WORKER_NUMBER.value):
+        '''
+        单事件循环执行器，WebSocket服务器、所有设备的WebSocket/MQTT/串口监听以及消息处理都运行在同一个事件循环中
+        阻塞的发送操作交给有上限的线程池执行，不再为每个设备和协议单独拉起线程
+        :return:
+        '''
+        super().__init__()
+        self.logger = Logger("AsyncActuator")
+        self.process_worker_number = process_worker_number
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_executor_workers,
+                                                              thread_name_prefix="controller-executor")
+        self.loop = None
+        self.message_queue = None
+        self.message_queue_adapter = None
+        self.websocket_channel = WebSocketChannel(WebsocketEnum.WEBSOCKET_HOST.value, WebsocketEnum.WEBSOCKET_PORT.value)
+
+    async def start_async_server(self):
+        '''
+        拉起服务器以及所有的监听和处理协程，并一直运行
+        :return:
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.executor)
+        self.message_queue = asyncio.Queue(maxsize=AsyncControllerEnum.MESSAGE_QUEUE_SIZE.value)
+        message_queue_adapter = AsyncioQueueAdapter(self.loop, self.message_queue)
+        self.message_queue_adapter = message_queue_adapter
+        self.channel.channel_pool.start_maintenance_thread()
+        self.start_routing_table_watcher()
+        self.start_device_presence_service()
+        self.start_cluster_node()
+        self.start_metrics_exporter()
+        self.start_trace_dump()
+        METRICS_REGISTRY.add_collect_callback(self.collect_queue_metrics)
+        self.start_traffic_capture()
+        message_queue_adapter.traffic_capture = self.traffic_capture
+        replay_list = self.open_message_journal()
+        message_queue_adapter.message_journal = self.message_journal
+        websocket_hub = self.websocket_channel.websocket_hub
+        await websocket_hub.start_hub()
+        self.logger.info("websocket server start working!")
+        # 监听协程由start_listener单独调度，热加载路由表后也可以从监视线程中拉起
+        self.listening_started = True
+        self.start_channel_listeners()
+        coroutine_list = []
+        for _ in range(self.process_worker_number):
+            coroutine_list.append(self.process_received_command_async())
+        if replay_list:
+            coroutine_list.append(self.replay_journal_messages(replay_list))
+        try:
+            await asyncio.gather(*[self.start_persistent_task(coroutine) for coroutine in coroutine_list])
+        finally:
+            websocket_hub.server.close()
+
+    async def start_persistent_task(self, coroutine):
+        '''
+        协程异常退出时记录日志，各监听协程自己负责断开后的重连
+        :return:
+        '''
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(str(coroutine) + " stopped running for " + str(e))
+
+    def start_listener(self, protocol_type, device_id):
+        '''
+        在事件循环中拉起一个监听协程，可以在事件循环线程或路由表监视线程中调用
+        :return:
+        '''
+        if protocol_type == "MQTT":
+            coroutine = self.monitor_mqtt_message(self.message_queue_adapter)
+        elif protocol_type == "WebSocket":
+            coroutine = self.monitor_websocket_message(device_id, self.message_queue_adapter)
+        else:
+            coroutine = self.monitor_modbus_message(device_id, self.message_queue_adapter)
+        asyncio.run_coroutine_threadsafe(self.start_persistent_task(coroutine), self.loop)
+
+    async def monitor_websocket_message(self, device_id, message_queue_adapter):
+        '''
+        在事件循环中订阅指定设备的WebSocket消息，路由中心和控制器运行在同一个事件循环中
+        :return:
+        '''
+        websocket_channel = WebSocketChannel(self.websocket_channel.host, self.websocket_channel.port)
+        websocket_channel.websocket_message_queue = message_queue_adapter.bind_source("WebSocket", device_id)
+        await websocket_channel.websocket_server_receive_message_from_device(device_id)
+
+    async def monitor_mqtt_message(self, message_queue_adapter):
+        '''
+        所有设备共用一个挂在事件循环上的MQTT订阅者，按设备分组订阅通配符topic
+        :return:
+        '''
+        mqtt_channel = MQTTChannel(MQTTServerEnum.MQTT_SERVER_HOST.value, MQTTServerEnum.MQTT_SERVER_PORT.value)
+        mqtt_channel.mqtt_message_queue = message_queue_adapter
+        mqtt_channel.client.username_pw_set(MQTTServerEnum.MQTT_SERVER_USERNAME.value,
+                                            MQTTServerEnum.MQTT_SERVER_PASSWORD.value)
+        mqtt_channel.client.on_connect = functools.partial(self.subscribe_device_topics, mqtt_channel)
+        mqtt_channel.client.on_message = functools.partial(self.receive_mqtt_message, mqtt_channel)
+        mqtt_adapter = MQTTAsyncioAdapter(self.loop, mqtt_channel.client)
+        await mqtt_adapter.run_client(mqtt_channel.host, mqtt_channel.port)
+
+    def subscribe_device_topics(self, mqtt_channel, client, userdata, flags, rc):
+        '''
+        连接成功后订阅所有设备分组的上行topic，重连后也会重新订阅
+        :return:
+        '''
+        if str(rc) != MQTTReturnCode.CONNECTION_SUCCESS.value:
+            self.logger.error("Connection rejected, Connected with result code " + str(rc))
+            return
+        record_connection("MQTT", mqtt_channel.host + ":" + str(mqtt_channel.port), mqtt_channel.connected_count > 0)
+        mqtt_channel.connected_count += 1
+        topic_filter_list = get_uplink_topic_filters(share_group=self.channel.mqtt_share_group)
+        client.subscribe([(topic_filter, MQTTSubscriberEnum.SUBSCRIBE_QOS.value) for topic_filter in topic_filter_list])
+        self.logger.info("subscriber topics: " + ",".join(topic_filter_list))
+
+    def receive_mqtt_message(self, mqtt_channel, client, userdata, msg):
+        '''
+        MQTT消息回调，在事件循环中执行，按topic取出设备ID后放入消息队列
+        :return:
+        '''
+        device_id = mqtt_channel.topic_device_matcher.get_device_id(msg.topic) or msg.topic
+        self.message_queue_adapter.put_received_message(MESSAGE_TRACER.start_trace(msg.payload, "MQTT", device_id),
+                                                        device_id, "MQTT")
+        MESSAGES_RECEIVED.labels("MQTT", device_id).inc()
+
+    async def monitor_modbus_message(self, device_id, message_queue_adapter):
+        '''
+        在事件循环中监听指定设备的串口，串口可读时才读取，不占用线程
+        与发送共用串口管理中的同一个句柄，句柄被关闭后等待重新打开
+        :return:
+        '''
+        modbus_channel = ModBusChannel()
+        serial_port = SerialPort.get_serial_port(modbus_channel.get_serial_file_location_by_device_id(device_id))
+        while True:
+            try:
+                ser = serial_port.get_handle()
+            except serial.SerialException as e:
+                self.logger.error("The serial to device: " + device_id + " is abnormal for " + str(e))
+                await asyncio.sleep(AsyncControllerEnum.SERIAL_REOPEN_INTERVAL.value)
+                continue
+            serial_fd = ser.fileno()
+            closed_future = self.loop.create_future()
+            self.loop.add_reader(serial_fd, self.read_serial_message, serial_port, ser, SerialFrameParser(),
+                                 message_queue_adapter, closed_future, device_id)
+            self.logger.info("modbus monitor start for " + device_id)
+            try:
+                # 句柄也可能因为发送失败被关闭，定期检查
+                while not closed_future.done() and serial_port.ser is ser:
+                    await asyncio.wait([closed_future], timeout=AsyncControllerEnum.SERIAL_REOPEN_INTERVAL.value)
+            finally:
+                self.loop.remove_reader(serial_fd)
+
+    def read_serial_message(self, serial_port, ser, frame_parser, message_queue_adapter, closed_future,
+                            device_id):
+        '''
+        串口可读回调，读取当前缓冲区中的全部数据并切分出完整的帧
+        :return:
+        '''
+        try:
+            # 可读但没有数据说明串口已断开，此时不能再按句柄的timeout阻塞读取
+            if not ser.in_waiting:
+                raise serial.SerialException("device reports readiness to read but returned no data")
+            frame_list = frame_parser.read_from_serial(ser)
+        except (OSError, serial.SerialException) as e:
+            serial_port.handle_serial_error(ser, e)
+            if not closed_future.done():
+                closed_future.set_result(True)
+            return
+        for frame in frame_list:
+            message_queue_adapter.put_received_message(MESSAGE_TRACER.start_trace(frame, "Modbus", device_id),
+                                                       device_id, "Modbus")
+        MESSAGES_RECEIVED.labels("Modbus", device_id).inc(len(frame_list))
+
+    async def process_received_command_async(self):
+        '''
+        process_received_command的协程版本，本节点的WebSocket设备直接在事件循环中发送，其他发送交给线程池
+        :return:
+        '''
+        self.logger.info("start processing commands")
+        while True:
+            message = await self.message_queue.get()
+            start_time = time.perf_counter()
+            mark_stage(message, DEQUEUE_STAGE)
+            if self.is_duplicate_message(message):
+                self.message_queue.task_done()
+                continue
+            try:
+                route_list = self.route_received_message(message)
+                mark_stage(message, ROUTE_STAGE)
+                sent_list = []
+                for route in route_list:
+                    sent = await self.send_routed_message_async(route)
+                    sent_list.append(sent)
+                    if not sent:
+                        continue
+                    FORWARD_LATENCY.labels(route[0]).observe(time.perf_counter() - start_time)
+                    mark_stage(message, SEND_STAGE_PREFIX + route[0])
+                if self.traffic_capture is not None:
+                    self.traffic_capture.capture_routes(message, route_list, sent_list)
+            except DeviceCommandError as e:
+                self.logger.error("Invalid message: " + str(e))
+                if self.traffic_capture is not None:
+                    self.traffic_capture.capture_routes(message, [], [])
+            except Exception as e:
+                self.logger.error("process message failed for " + str(e))
+            finally:
+                self.finish_message(message)
+                self.message_queue.task_done()
+
+    async def send_routed_message_async(self, route):
+        '''
+        send_routed_message的协程版本：发往本节点WebSocket设备的消息直接在事件循环中发送，与其他协议一样经过熔断器；
+        其他协议以及集群中由其他节点拥有的设备交给线程池中的send_routed_message
+        :return: 是否已发送
+        '''
+        protocol, sending_command, receiver = route
+        cluster_node = self.cluster_node
+        if protocol != "WebSocket" or \
+                (cluster_node is not None and cluster_node.get_remote_owner(receiver, protocol) is not None):
+            return await self.loop.run_in_executor(self.executor, self.send_routed_message, route)
+        endpoint_name = self.channel.get_endpoint_name(protocol, receiver)
+        circuit_breaker = get_endpoint_circuit_breaker(protocol, endpoint_name)
+        if not circuit_breaker.allow_request():
+            SHED_MESSAGES.labels(protocol, endpoint_name).inc()
+            return False
+        try:
+            delivered = await self.websocket_channel.send_message_to_websocket_server(sending_command, receiver)
+        except Exception as e:
+            circuit_breaker.record_failure()
+            self.logger.error("forward " + sending_command + " to " + str(receiver) + " through " + protocol +
+                              " failed for " + str(e))
+            return False
+        # 设备没有连接时服务器仍然可用，与同步发送一样只记录成功，但这条消息不算已发送
+        circuit_breaker.record_success()
+        return delivered
+
+    async def replay_journal_messages(self, replay_list):
+        '''
+        将消息日志中未确认的消息重新放入消息队列，队列满时等待
+        :return:
+        '''
+        for message, _ in replay_list:
+            await self.message_queue.put(message)
+        self.logger.info("replayed " + str(len(replay_list)) + " journaled messages")
+
+    def collect_queue_metrics(self):
+        QUEUE_DEPTH.labels("async_message_queue", "*").set(self.message_queue.qsize())
+
+
+if __name__ == "__main__":
+    controller = AsyncController()
+    asyncio.run(controller.start_async_server())
@@ -0,0 +1,187 @@
+import time
+import threading
+import collections
+
+from common.channel_enum import ChannelPoolEnum
+from util.logger_manager_ment import Logger
+
+
+class PooledChannel:
+    def __init__(self, channel):
+        '''
+        连接池中的单个channel及其使用记录
+        :return:
+        '''
+        self.channel = channel
+        self.last_used_time = time.monotonic()
+        self.last_checked_time = self.last_used_time
+
+
+class ChannelPool:
+    def __init__(self, channel_factory, max_pool_size=ChannelPoolEnum.MAX_POOL_SIZE.value,
+                 idle_timeout=ChannelPoolEnum.IDLE_TIMEOUT.value,
+                 health_check_interval=ChannelPoolEnum.HEALTH_CHECK_INTERVAL.value):
+        '''
+        channel连接池，每个协议的每个endpoint只创建一个channel并在后续转发中复用
+        channel_factory(protocol_type, **endpoint)用于在池中不存在可用channel时创建新的channel
+        :return:
+        '''
+        self.channel_factory = channel_factory
+        self.max_pool_size = max_pool_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.logger = Logger("ChannelPool")
+        # 按最近使用顺序排列，最久未使用的在最前面
+        self._pooled_channel_dict = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._maintenance_thread = None
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def get_channel_key(protocol_type, endpoint):
+        '''
+        由协议类型和endpoint信息生成连接池中的key
+        :return:
+        '''
+        return (protocol_type,) + tuple(sorted(endpoint.items()))
+
+    def acquire_channel(self, protocol_type, endpoint):
+        '''
+        从连接池获取channel，不存在或不健康时重新创建
+        :return: channel
+        '''
+        channel_key = self.get_channel_key(protocol_type, endpoint)
+        with self._lock:
+            pooled_channel = self._pooled_channel_dict.get(channel_key)
+            now = time.monotonic()
+            if pooled_channel is not None and now - pooled_channel.last_checked_time >= self.health_check_interval:
+                pooled_channel.last_checked_time = now
+                if not self._is_channel_healthy(pooled_channel.channel):
+                    self.logger.warning("channel " + str(channel_key) + " is unhealthy, reconnecting")
+                    self._remove_channel(channel_key)
+                    pooled_channel = None
+            if pooled_channel is None:
+                pooled_channel = PooledChannel(self.channel_factory(protocol_type, **endpoint))
+                self._pooled_channel_dict[channel_key] = pooled_channel
+                self.logger.info("channel pool creates channel: " + str(channel_key))
+                self._evict_overflow_channels()
+            pooled_channel.last_used_time = now
+            self._pooled_channel_dict.move_to_end(channel_key)
+            return pooled_channel.channel
+
+    def invalidate_channel(self, protocol_type, endpoint):
+        '''
+        将指定channel移出连接池并关闭，下次使用时会重新创建
+        :return:
+        '''
+        with self._lock:
+            self._remove_channel(self.get_channel_key(protocol_type, endpoint))
+
+    def call_with_channel(self, protocol_type, endpoint, func_name, *args,
+                          retry_times=ChannelPoolEnum.RECONNECT_RETRY_TIMES.value):
+        '''
+        使用池中的channel调用指定方法，失败时重建channel后重试
+        :return: 方法的返回值
+        '''
+        while True:
+            channel = self.acquire_channel(protocol_type, endpoint)
+            try:
+                return getattr(channel, func_name)(*args)
+            except Exception as e:
+                self.invalidate_channel(protocol_type, endpoint)
+                if retry_times <= 0:
+                    raise
+                retry_times -= 1
+                self.logger.error(protocol_type + " channel failed for " + str(e) + ", reconnecting")
+
+    def evict_idle_channels(self):
+        '''
+        回收空闲超时的channel
+        :return: 被回收的channel数量
+        '''
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle_key_list = [key for key, pooled_channel in self._pooled_channel_dict.items()
+                             if pooled_channel.last_used_time < deadline]
+            for channel_key in idle_key_list:
+                self.logger.info("channel pool evicts idle channel: " + str(channel_key))
+                self._remove_channel(channel_key)
+        return len(idle_key_list)
+
+    def check_channels_health(self):
+        '''
+        对池中所有channel进行健康检查，不健康的直接移除
+        :return:
+        '''
+        with self._lock:
+            pooled_channel_items = list(self._pooled_channel_dict.items())
+        now = time.monotonic()
+        for channel_key, pooled_channel in pooled_channel_items:
+            pooled_channel.last_checked_time = now
+            if not self._is_channel_healthy(pooled_channel.channel):
+                self.logger.warning("channel " + str(channel_key) + " failed health check")
+                with self._lock:
+                    if self._pooled_channel_dict.get(channel_key) is pooled_channel:
+                        self._remove_channel(channel_key)
+
+    def start_maintenance_thread(self):
+        '''
+        拉起后台线程，定期进行空闲回收和健康检查
+        :return:
+        '''
+        if self._maintenance_thread is not None:
+            return
+        self._stop_event.clear()
+        self._maintenance_thread = threading.Thread(target=self._maintain_channels, name="channel-pool", daemon=True)
+        self._maintenance_thread.start()
+
+    def close_all_channels(self):
+        '''
+        停止后台维护线程并关闭池中所有channel
+        :return:
+        '''
+        self._stop_event.set()
+        with self._lock:
+            for channel_key in list(self._pooled_channel_dict.keys()):
+                self._remove_channel(channel_key)
+        self._maintenance_thread = None
+
+    def __len__(self):
+        return len(self._pooled_channel_dict)
+
+    def _maintain_channels(self):
+        interval = min(self.idle_timeout, self.health_check_interval)
+        while not self._stop_event.wait(interval):
+            try:
+                self.evict_idle_channels()
+                self.check_channels_health()
+            except Exception as e:
+                self.logger.error("channel pool maintenance failed for " + str(e))
+
+    def _evict_overflow_channels(self):
+        while len(self._pooled_channel_dict) > self.max_pool_size:
+            channel_key = next(iter(self._pooled_channel_dict))
+            self.logger.info("channel pool is full, evicts channel: " + str(channel_key))
+            self._remove_channel(channel_key)
+
+    def _remove_channel(self, channel_key):
+        pooled_channel = self._pooled_channel_dict.pop(channel_key, None)
+        if pooled_channel is None:
+            return
+        close_channel = getattr(pooled_channel.channel, "close_channel", None)
+        if close_channel is None:
+            return
+        try:
+            close_channel()
+        except Exception as e:
+            self.logger.error("close channel " + str(channel_key) + " failed for " + str(e))
+
+    @staticmethod
+    def _is_channel_healthy(channel):
+        check_channel_health = getattr(channel, "check_channel_health", None)
+        if check_channel_health is None:
+            return True
+        try:
+            return bool(check_channel_health())
+        except Exception:
+            return False
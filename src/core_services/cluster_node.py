@@ -0,0 +1,482 @@
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+import collections
+import socketserver
+
+from common.controller_enum import ClusterEnum
+from common.exception import ConfigError
+from core_services.controller import Controller
+from core_services.controller_metrics import CLUSTER_DROPPED_MESSAGES
+from core_services.controller_metrics import CLUSTER_FORWARDED_MESSAGES
+from core_services.controller_metrics import CLUSTER_NODES
+from core_services.controller_metrics import METRICS_REGISTRY
+from core_services.controller_metrics import record_connection
+from util.backoff import ExponentialBackoff
+from util.logger_manager_ment import Logger
+
+ANNOUNCE_FRAME = ClusterEnum.ANNOUNCE_FRAME.value
+FORWARD_FRAME = ClusterEnum.FORWARD_FRAME.value
+# 帧格式：4字节大端长度 + JSON
+FRAME_LENGTH_STRUCT = struct.Struct(">I")
+
+NodeEntry = collections.namedtuple("NodeEntry", ["address", "device_set", "last_seen_time"])
+
+
+def encode_frame(frame):
+    body = json.dumps(frame, separators=(",", ":")).encode()
+    return FRAME_LENGTH_STRUCT.pack(len(body)) + body
+
+
+def read_frame(stream):
+    '''
+    从连接中读取一帧
+    :return: frame，连接关闭时返回None
+    '''
+    length_bytes = stream.read(FRAME_LENGTH_STRUCT.size)
+    if len(length_bytes) < FRAME_LENGTH_STRUCT.size:
+        return None
+    body_length = FRAME_LENGTH_STRUCT.unpack(length_bytes)[0]
+    body = stream.read(body_length)
+    if len(body) < body_length:
+        return None
+    return json.loads(body)
+
+
+class MembershipTable:
+    def __init__(self, node_expire_time=ClusterEnum.NODE_EXPIRE_TIME.value, clock=time.monotonic):
+        '''
+        集群成员表：各节点的连接地址和拥有的设备，按(device_id, protocol)索引设备所在的节点
+        多个节点声明拥有同一设备时由先声明的节点拥有，直到其不再声明或过期
+        :return:
+        '''
+        self.node_expire_time = node_expire_time
+        self.clock = clock
+        self.logger = Logger("ClusterMembership")
+        self.node_dict = {}
+        # (device_id, protocol) -> node_id
+        self.owner_dict = {}
+        self.conflict_key_set = set()
+        self.lock = threading.Lock()
+
+    def update_node(self, node_id, address, device_list):
+        '''
+        用节点的通告更新成员表
+        :return: 是否为新加入的节点
+        '''
+        device_set = set(device_list)
+        with self.lock:
+            node_entry = self.node_dict.get(node_id)
+            if node_entry is not None:
+                self.remove_ownership(node_id, node_entry.device_set - device_set)
+            for device_key in device_set:
+                owner_node_id = self.owner_dict.get(device_key)
+                if owner_node_id is None:
+                    self.owner_dict[device_key] = node_id
+                elif owner_node_id != node_id and device_key not in self.conflict_key_set:
+                    self.conflict_key_set.add(device_key)
+                    self.logger.warning(str(device_key) + " is claimed by both " + owner_node_id + " and " + node_id)
+            self.node_dict[node_id] = NodeEntry(address, device_set, self.clock())
+            return node_entry is None
+
+    def expire_nodes(self, keep_node_id=None):
+        '''
+        移除超时未通告的节点及其设备
+        :return: [node_id, ...]
+        '''
+        deadline = self.clock() - self.node_expire_time
+        with self.lock:
+            expired_node_id_list = [node_id for node_id, node_entry in self.node_dict.items()
+                                    if node_entry.last_seen_time < deadline and node_id != keep_node_id]
+            for node_id in expired_node_id_list:
+                self.remove_ownership(node_id, self.node_dict.pop(node_id).device_set)
+        return expired_node_id_list
+
+    def remove_ownership(self, node_id, device_key_set):
+        for device_key in device_key_set:
+            if self.owner_dict.get(device_key) == node_id:
+                del self.owner_dict[device_key]
+                self.conflict_key_set.discard(device_key)
+
+    def get_owner(self, device_id, protocol):
+        return self.owner_dict.get((device_id, protocol))
+
+    def get_address(self, node_id):
+        node_entry = self.node_dict.get(node_id)
+        return None if node_entry is None else node_entry.address
+
+    def get_members(self):
+        '''
+        :return: {node_id: address}
+        '''
+        return {node_id: node_entry.address for node_id, node_entry in list(self.node_dict.items())}
+
+    def get_membership(self):
+        '''
+        各节点的地址、设备和距离上次通告的时间
+        :return: {node_id: {"address", "devices", "age"}}
+        '''
+        now = self.clock()
+        return {node_id: {"address": node_entry.address,
+                          "devices": sorted(list(device_key) for device_key in node_entry.device_set),
+                          "age": round(now - node_entry.last_seen_time, 3)}
+                for node_id, node_entry in list(self.node_dict.items())}
+
+
+class PeerLink:
+    def __init__(self, local_node_id, address, max_pending_messages=ClusterEnum.MAX_PENDING_MESSAGES.value,
+                 max_batch_size=ClusterEnum.MAX_BATCH_SIZE.value):
+        '''
+        到一个节点的持久化连接，只用于发送：转发的消息先放入队列，由发送线程把队列中已有的消息合并成一帧写出，
+        通告帧只保留最新的一帧；断开后按带抖动的指数退避重连，写出失败的那一帧中的消息丢失
+        :return:
+        '''
+        self.local_node_id = local_node_id
+        self.address = address
+        host, _, port = address.rpartition(":")
+        self.host = host
+        self.port = int(port)
+        self.max_pending_messages = max_pending_messages
+        self.max_batch_size = max_batch_size
+        self.logger = Logger("ClusterPeerLink")
+        self.pending_message_deque = collections.deque()
+        self.announce_frame = None
+        self.condition = threading.Condition()
+        self.backoff = ExponentialBackoff(ClusterEnum.RECONNECT_MIN_DELAY.value, ClusterEnum.RECONNECT_MAX_DELAY.value)
+        self.dropped_counter = CLUSTER_DROPPED_MESSAGES.labels(address)
+        self.forwarded_counter = CLUSTER_FORWARDED_MESSAGES.labels(address, "out")
+        self.created_time = time.monotonic()
+        self.connected_count = 0
+        self.connected = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.send_frames_forever, name="cluster-link-" + address, daemon=True)
+
+    def start_link(self):
+        self.thread.start()
+
+    def forward_message(self, message):
+        '''
+        放入发送队列，队列满时丢弃
+        :return: 是否放入队列
+        '''
+        with self.condition:
+            if len(self.pending_message_deque) >= self.max_pending_messages:
+                self.dropped_counter.inc()
+                return False
+            self.pending_message_deque.append(message)
+            self.condition.notify()
+        return True
+
+    def send_announce(self, announce_frame):
+        with self.condition:
+            self.announce_frame = announce_frame
+            self.condition.notify()
+
+    def close_link(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def send_frames_forever(self):
+        while not self.closed:
+            try:
+                sock = socket.create_connection((self.host, self.port), ClusterEnum.CONNECT_TIMEOUT.value)
+            except OSError as e:
+                delay = self.backoff.next_delay()
+                self.logger.error("connect to cluster node " + self.address + " failed for " + str(e) +
+                                  ", retry after " + str(round(delay, 2)) + "s")
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, delay)
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connected = True
+            record_connection("Cluster", self.address, self.connected_count > 0)
+            self.connected_count += 1
+            self.backoff.reset()
+            self.logger.info("connected to cluster node " + self.address)
+            try:
+                self.send_frames(sock)
+            except OSError as e:
+                self.logger.error("connection to cluster node " + self.address + " lost for " + str(e))
+            finally:
+                self.connected = False
+                sock.close()
+
+    def send_frames(self, sock):
+        pending_message_deque = self.pending_message_deque
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or pending_message_deque or
+                                        self.announce_frame is not None)
+                if self.closed:
+                    return
+                announce_frame, self.announce_frame = self.announce_frame, None
+                batch = [pending_message_deque.popleft()
+                         for _ in range(min(len(pending_message_deque), self.max_batch_size))]
+            data = announce_frame or b""
+            if batch:
+                data += encode_frame({"type": FORWARD_FRAME, "node_id": self.local_node_id, "messages": batch})
+            try:
+                sock.sendall(data)
+            except OSError:
+                self.dropped_counter.inc(len(batch))
+                raise
+            self.forwarded_counter.inc(len(batch))
+
+
+class ClusterServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, cluster_node):
+        self.cluster_node = cluster_node
+        super().__init__(server_address, ClusterRequestHandler)
+
+
+class ClusterRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except (OSError, ValueError) as e:
+                self.server.cluster_node.logger.error("read cluster frame from " + str(self.client_address) +
+                                                      " failed for " + str(e))
+                return
+            if frame is None:
+                return
+            self.server.cluster_node.handle_frame(frame)
+
+
+class ClusterNode:
+    def __init__(self, get_owned_devices, send_local_message, node_id=ClusterEnum.NODE_ID.value,
+                 listen_host=ClusterEnum.LISTEN_HOST.value, listen_port=ClusterEnum.LISTEN_PORT.value,
+                 advertise_host=ClusterEnum.ADVERTISE_HOST.value,
+                 peer_address_list=ClusterEnum.PEER_ADDRESS_LIST.value,
+                 announce_interval=ClusterEnum.ANNOUNCE_INTERVAL.value,
+                 node_expire_time=ClusterEnum.NODE_EXPIRE_TIME.value):
+        '''
+        集群节点：定期向其他节点通告本节点拥有的设备，维护成员表，把发往其他节点设备的消息通过持久化连接转发过去，
+        并在本地发送其他节点转发来的消息
+        get_owned_devices()返回本节点拥有的[(device_id, protocol), ...]
+        send_local_message(protocol, command, receiver)在本地发送消息，不再转发
+        :return:
+        '''
+        self.get_owned_devices = get_owned_devices
+        self.send_local_message = send_local_message
+        self.node_id = node_id
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.advertise_host = advertise_host
+        self.peer_address_list = list(peer_address_list)
+        self.announce_interval = announce_interval
+        self.address = None
+        self.logger = Logger("ClusterNode")
+        self.membership_table = MembershipTable(node_expire_time)
+        # 连接地址 -> PeerLink
+        self.peer_link_dict = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.stop_event = threading.Event()
+        METRICS_REGISTRY.add_collect_callback(self.collect_cluster_metrics)
+
+    def start_cluster_node(self):
+        '''
+        拉起节点间连接的监听，连接启动时配置的节点，并开始定期通告
+        :return:
+        '''
+        self.server = ClusterServer((self.listen_host, self.listen_port), self)
+        self.listen_port = self.server.server_address[1]
+        self.address = self.advertise_host + ":" + str(self.listen_port)
+        if not self.node_id:
+            self.node_id = socket.gethostname() + ":" + str(self.listen_port)
+        threading.Thread(target=self.server.serve_forever, name="cluster-server", daemon=True).start()
+        for address in self.peer_address_list:
+            self.get_peer_link(address)
+        threading.Thread(target=self.announce_forever, name="cluster-announce", daemon=True).start()
+        self.logger.info("cluster node " + self.node_id + " listening on " + self.address)
+
+    def stop_cluster_node(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        with self.lock:
+            peer_link_list = list(self.peer_link_dict.values())
+            self.peer_link_dict.clear()
+        for peer_link in peer_link_list:
+            peer_link.close_link()
+
+    def announce_forever(self):
+        while True:
+            try:
+                self.announce()
+            except Exception as e:
+                self.logger.error("cluster announce failed for " + str(e))
+            if self.stop_event.wait(self.announce_interval):
+                return
+
+    def announce(self):
+        '''
+        更新本节点拥有的设备，移除过期的节点，并向所有节点发送通告
+        :return:
+        '''
+        device_list = sorted(set(self.get_owned_devices()))
+        self.membership_table.update_node(self.node_id, self.address, device_list)
+        for node_id in self.membership_table.expire_nodes(keep_node_id=self.node_id):
+            self.logger.warning("cluster node " + node_id + " expired")
+        member_dict = self.membership_table.get_members()
+        self.close_stale_links(set(member_dict.values()))
+        announce_frame = encode_frame({"type": ANNOUNCE_FRAME, "node_id": self.node_id, "address": self.address,
+                                       "devices": device_list, "members": member_dict})
+        with self.lock:
+            peer_link_list = list(self.peer_link_dict.values())
+        for peer_link in peer_link_list:
+            peer_link.send_announce(announce_frame)
+
+    def close_stale_links(self, member_address_set):
+        '''
+        关闭到不在成员表中的节点的连接，启动时配置的节点一直保留
+        通过其他节点的通告发现的节点在连接建立后的一个过期时间内还没有发来通告时也不保留
+        :return:
+        '''
+        deadline = time.monotonic() - self.membership_table.node_expire_time
+        with self.lock:
+            stale_address_list = [address for address, peer_link in self.peer_link_dict.items()
+                                  if address not in member_address_set and address not in self.peer_address_list
+                                  and peer_link.created_time < deadline]
+            stale_peer_link_list = [self.peer_link_dict.pop(address) for address in stale_address_list]
+        for peer_link in stale_peer_link_list:
+            peer_link.close_link()
+
+    def handle_frame(self, frame):
+        '''
+        处理其他节点发来的一帧：通告更新成员表并连接新发现的节点，转发的消息在本地发送
+        :return:
+        '''
+        frame_type = frame.get("type")
+        if frame_type == FORWARD_FRAME:
+            message_list = frame["messages"]
+            CLUSTER_FORWARDED_MESSAGES.labels(frame["node_id"], "in").inc(len(message_list))
+            for protocol, command, receiver in message_list:
+                try:
+                    self.send_local_message(protocol, command, receiver)
+                except Exception as e:
+                    self.logger.error("send " + command + " forwarded by " + frame["node_id"] + " to " + receiver +
+                                      " failed for " + str(e))
+        elif frame_type == ANNOUNCE_FRAME:
+            node_id = frame["node_id"]
+            if node_id == self.node_id:
+                return
+            if self.membership_table.update_node(node_id, frame["address"],
+                                                 [tuple(device_key) for device_key in frame["devices"]]):
+                self.logger.info("cluster node " + node_id + " joined from " + frame["address"])
+            for member_node_id, address in frame["members"].items():
+                if member_node_id != self.node_id:
+                    self.get_peer_link(address)
+        else:
+            self.logger.error("unknown cluster frame type: " + str(frame_type))
+
+    def get_peer_link(self, address):
+        '''
+        获取到指定地址的连接，不存在时创建
+        :return: PeerLink，地址为本节点时返回None
+        '''
+        if address == self.address:
+            return None
+        peer_link = self.peer_link_dict.get(address)
+        if peer_link is not None:
+            return peer_link
+        with self.lock:
+            peer_link = self.peer_link_dict.get(address)
+            if peer_link is None and not self.stop_event.is_set():
+                peer_link = PeerLink(self.node_id, address)
+                self.peer_link_dict[address] = peer_link
+                peer_link.start_link()
+            return peer_link
+
+    def get_remote_owner(self, device_id, protocol):
+        '''
+        查询设备是否由其他节点拥有
+        :return: 拥有该设备的其他节点ID，设备在本节点或没有节点拥有时返回None
+        '''
+        owner_node_id = self.membership_table.get_owner(device_id, protocol)
+        return None if owner_node_id == self.node_id else owner_node_id
+
+    def forward_message(self, node_id, protocol, command, receiver):
+        '''
+        把消息交给到目标节点的连接批量发送，不等待对端发送结果
+        :return: 是否放入发送队列
+        '''
+        address = self.membership_table.get_address(node_id)
+        peer_link = self.get_peer_link(address) if address is not None else None
+        if peer_link is None:
+            return False
+        return peer_link.forward_message((protocol, command, receiver))
+
+    def get_cluster_status(self):
+        '''
+        成员表以及到各节点连接的状态
+        :return:
+        '''
+        with self.lock:
+            peer_link_list = list(self.peer_link_dict.values())
+        return {"node_id": self.node_id, "address": self.address,
+                "members": self.membership_table.get_membership(),
+                "links": {peer_link.address: {"connected": peer_link.connected,
+                                              "pending": len(peer_link.pending_message_deque)}
+                          for peer_link in peer_link_list}}
+
+    def collect_cluster_metrics(self):
+        CLUSTER_NODES.set(len(self.membership_table.node_dict))
+
+
+def parse_serial_locations(serial_location_text_list):
+    '''
+    解析"设备ID=串口位置"格式的参数
+    :return: {device_id: serial_file_location}
+    '''
+    serial_file_location_dict = {}
+    for serial_location_text in serial_location_text_list:
+        device_id, separator, serial_file_location = serial_location_text.partition("=")
+        if not separator:
+            raise ConfigError("Serial location must be DEVICE_ID=PATH: " + serial_location_text)
+        serial_file_location_dict[device_id] = serial_file_location
+    return serial_file_location_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run a controller as one node of a controller cluster")
+    parser.add_argument("--node-id", default=ClusterEnum.NODE_ID.value, help="defaults to hostname:listen-port")
+    parser.add_argument("--listen-host", default=ClusterEnum.LISTEN_HOST.value)
+    parser.add_argument("--listen-port", type=int, default=ClusterEnum.LISTEN_PORT.value,
+                        help="port other nodes connect to")
+    parser.add_argument("--advertise-host", default=ClusterEnum.ADVERTISE_HOST.value,
+                        help="host other nodes use to reach this node")
+    parser.add_argument("--peer", action="append", default=list(ClusterEnum.PEER_ADDRESS_LIST.value),
+                        help="HOST:PORT of a node to join through, may be given several times")
+    parser.add_argument("--websocket-port", type=int, help="port of this node's websocket server")
+    parser.add_argument("--serial", action="append", default=[],
+                        help="DEVICE_ID=PATH of a serial port attached to this node, may be given several times")
+    parser.add_argument("--metrics-port", type=int,
+                        help="port of this node's metrics http server, 0 to disable, "
+                             "defaults to the metrics port offset by --listen-port")
+    args = parser.parse_args()
+    controller = Controller()
+    controller.metrics_port = args.metrics_port
+    channel = controller.channel
+    if args.websocket_port is not None:
+        channel.protocol_type_dict["WebSocket"]["port"] = args.websocket_port
+    if args.serial:
+        channel.load_channel_class("Modbus").serial_file_location_dict = parse_serial_locations(args.serial)
+    controller.enable_cluster(node_id=args.node_id, listen_host=args.listen_host, listen_port=args.listen_port,
+                              advertise_host=args.advertise_host, peer_address_list=args.peer)
+    controller.start_server_process()
+
+
+if __name__ == "__main__":
+    main()
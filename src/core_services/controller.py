@@ -1,12 +1,41 @@
-import asyncio
+import os
+import time
+import atexit
 import threading
-import concurrent.futures
+import importlib
 
-from common.websocket_enum import WebsocketEnum
-from common.message_format import MessageFormatEnum
+from common.channel_enum import ChannelProtocolEnum
+from common.channel_enum import MessageJournalEnum
+from common.channel_enum import TrafficCaptureEnum
+from common.controller_enum import ClusterEnum
+from common.controller_enum import MessageDedupEnum
+from common.exception import CircuitOpenError
+from common.exception import CommonError
+from common.exception import DeviceCommandError
+from common.metrics_enum import MetricsEnum
+from common.tracing_enum import TracingEnum
+from common.message_codec import MessageCodec
 from core_services.controller_channel import ControllerChannel
-from core_services.websocket_channel import WebSocketChannel
+from core_services.controller_metrics import DUPLICATE_MESSAGES
+from core_services.controller_metrics import FORWARD_LATENCY
+from core_services.controller_metrics import METRICS_REGISTRY
+from core_services.device_presence import DevicePresenceService
+from core_services.message_dedup import MessageDeduplicator
+from core_services.message_journal import MessageJournal
+from core_services.routing_table import RoutingTable
+from core_services.routing_table import RoutingTableLoader
+from core_services.supervisor import Supervisor
+from util.circuit_breaker import get_endpoint_circuit_breaker
 from util.logger_manager_ment import Logger
+from util.startup_profile import profile_stage
+from util.tracing import MessageTracer
+from util.tracing import mark_stage
+
+DEQUEUE_STAGE = TracingEnum.DEQUEUE_STAGE.value
+DUPLICATE_STAGE = TracingEnum.DUPLICATE_STAGE.value
+ROUTE_STAGE = TracingEnum.ROUTE_STAGE.value
+SEND_STAGE_PREFIX = TracingEnum.SEND_STAGE_PREFIX.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
 
 
 class Controller:
@@ -20,29 +49,47 @@ class Controller:
         self.logger = Logger("Actuator")
         self.command_map = {"A": {"template1": {"protocol": "MQTT", "next_command": "template2"},
                                   "template2": {"protocol": "WebSocket", "next_command": "template1"}}}
-
-    def start_persistent_thread(self, func):
-        '''
-        用于拉起永久执行的进程并且在其挂掉时重新拉起
-        :return:
-        '''
-        while True:
-            try:
-                func()
-                self.logger.info(str(func) + "start working!")
-                break
-            except Exception as e:
-                self.logger.error(str(func) + "stopped running for " + str(e))
-                continue
+        # 监听和转发共用同一个channel，从而共用消息队列和channel连接池
+        # 各协议的channel类在首次使用时才导入和创建
+        with profile_stage("create controller channel"):
+            self.channel = ControllerChannel()
+        self.message_codec = MessageCodec.get_default_codec()
+        # 路由规则优先从路由表文件加载，文件不存在时使用上面的默认规则；文件修改后热加载，不需要重启监听
+        with profile_stage("load routing table"):
+            self.routing_table_loader = RoutingTableLoader(RoutingTableLoader.get_default_file_path(),
+                                                           self.reload_routing_table)
+            self.routing_table = None
+            self.apply_routing_table(self.load_routing_table())
+        # 转发前跳过离线的设备，在线状态由后台扫描得到
+        self.device_presence = DevicePresenceService.get_default_service()
+        # 可选的消息预写日志，进程重启后重放未转发完成的消息
+        self.message_journal = None
+        # 可选的流量录制，记录收到的消息及其路由结果，用于回放测试
+        self.traffic_capture = None
+        # 重连、重发以及监听线程重启都可能导致同一条消息被多次接收，路由前过滤
+        self.message_deduplicator = MessageDeduplicator() if MessageDedupEnum.DEDUP_ENABLED.value else None
+        # 监听线程异常退出后按退避间隔重新拉起，get_listener_states可查询各监听线程和熔断器的状态
+        self.supervisor = Supervisor()
+        # 执行测试流程时由TestFlowScheduler设置，流程等待的设备回复交给调度器，不再路由
+        self.test_flow_scheduler = None
+        # 集群模式下由enable_cluster创建，向其他节点通告本节点拥有的设备，发往其他节点设备的消息转发给该节点
+        self.cluster_node = None
+        # 分片控制器的工作进程中为分片编号，用于区分各分片写入的文件
+        self.shard_index = None
+        # 指标HTTP接口的端口，为None时由get_metrics_port按本进程推算
+        self.metrics_port = None
+        # 已经拉起的监听，key为(protocol_type, device_id)，MQTT订阅者的device_id为None；热加载路由表后只拉起新增的监听
+        self.listening_key_set = set()
+        self.listening_started = False
+        self.listening_lock = threading.Lock()
 
     def start_server_process(self):
         '''
         拉起服务器进程
         :return:
         '''
-        websocket_server = WebSocketChannel(WebsocketEnum.WEBSOCKET_HOST.value, WebsocketEnum.WEBSOCKET_PORT.value)
-        start_websocket_server = websocket_server.start_websocket_server()
-        websocket_server_thread = threading.Thread(target=lambda: asyncio.run(start_websocket_server))
+        websocket_server = self.channel.create_channel("WebSocket", **self.channel.get_channel_endpoint("WebSocket"))
+        websocket_server_thread = threading.Thread(target=websocket_server.asyncio_run_websocket_server)
         try:
             websocket_server_thread.start()
             self.logger.info("websocket server start working!")
@@ -53,48 +100,409 @@ class Controller:
 
     def start_monitor_channel_message(self):
         '''
-        将所有的需要监听的信息收发增加到线程池中，拉起所有线程池的监听进程
-        :return:
-        '''
-        receive_message_function_list = []
-        channel = ControllerChannel()
-        for device_id in self.device_id_list:
-            for protocol_type in channel.protocol_type_dict.keys():
-                receive_message_function_list.append(lambda device_id=device_id, protocol_type=protocol_type:
-                                                     channel.get_message_from_device(device_id, protocol_type))
-        receive_message_function_list.append(self.process_received_command)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(receive_message_function_list)) as monitor_actuator:
-            futures = [monitor_actuator.submit(self.start_persistent_thread, func) for func in receive_message_function_list]
-            concurrent.futures.wait(futures)
-            for future in futures:
-                if future.result() is None:
-                    futures.remove(future)
-                    futures.append(monitor_actuator.submit(self.start_persistent_thread, receive_message_function_list[futures.index(future)]))
-            monitor_actuator.shutdown(wait=True)
+        拉起所有的监听线程和消息处理线程，由监督者在其异常退出后按退避间隔重新拉起
+        :return:
+        '''
+        channel = self.channel
+        channel.channel_pool.start_maintenance_thread()
+        self.start_routing_table_watcher()
+        self.start_device_presence_service()
+        self.start_cluster_node()
+        self.start_metrics_exporter()
+        self.start_trace_dump()
+        self.start_traffic_capture()
+        self.start_message_journal()
+        self.listening_started = True
+        self.start_channel_listeners()
+        self.supervisor.add_listener("command-processor", self.process_received_command)
+        self.supervisor.join_listeners()
+
+    def get_listening_protocols(self):
+        '''
+        需要拉起监听的协议，未配置ENABLED_PROTOCOLS时为所有注册的协议；没有启用的协议不会导入其依赖库
+        :return: [protocol_type, ...]
+        '''
+        enabled_protocol_list = ChannelProtocolEnum.ENABLED_PROTOCOLS.value
+        return [protocol_type for protocol_type in self.channel.protocol_type_dict
+                if enabled_protocol_list is None or protocol_type in enabled_protocol_list]
+
+    def start_channel_listeners(self):
+        '''
+        为各设备拉起启用的协议的监听，所有设备共用一个MQTT订阅者；已经拉起的监听不重复拉起，热加载路由表后再次调用
+        :return:
+        '''
+        for protocol_type in self.get_listening_protocols():
+            # 所有设备共用一个MQTT订阅者，不再为每个设备建立连接
+            device_id_list = [None] if protocol_type == "MQTT" else list(self.device_id_list)
+            for device_id in device_id_list:
+                if self.add_listening_key(protocol_type, device_id):
+                    self.start_listener(protocol_type, device_id)
+
+    def start_listener(self, protocol_type, device_id):
+        '''
+        由监督者拉起一个监听，MQTT订阅者的device_id为None
+        :return:
+        '''
+        channel = self.channel
+        if protocol_type == "MQTT":
+            self.supervisor.add_listener("MQTT-subscriber", channel.get_message_from_mqtt_subscriber,
+                                         self.get_listener_circuit_breaker("MQTT", None))
+            return
+        self.supervisor.add_listener(protocol_type + "-" + device_id,
+                                     lambda: channel.get_message_from_device(device_id, protocol_type),
+                                     self.get_listener_circuit_breaker(protocol_type, device_id))
+
+    def add_listening_key(self, protocol_type, device_id):
+        '''
+        :return: 监听是否是第一次加入，启动监听和热加载在不同线程中调用
+        '''
+        with self.listening_lock:
+            if (protocol_type, device_id) in self.listening_key_set:
+                return False
+            self.listening_key_set.add((protocol_type, device_id))
+            return True
+
+    def get_listener_circuit_breaker(self, protocol_type, device_id):
+        '''
+        监听所连接的endpoint的熔断器，WebSocket在进程内的路由中心订阅，不经过网络
+        :return: circuit_breaker，没有时为None
+        '''
+        if protocol_type == "WebSocket":
+            return None
+        return get_endpoint_circuit_breaker(protocol_type, self.channel.get_endpoint_name(protocol_type, device_id))
 
     def process_received_command(self):
         '''
         监听获得的信息，并对其进行处理从而执行下一步的转发操作
         :return:
         '''
-        channel = ControllerChannel()
+        channel = self.channel
         self.logger.info("start processing commands")
         while True:
-            message_list = channel.message_queue.get().splitlines()
-            self.logger.info("channel.message_queue get: " + message_list)
-            received_element_list = [content.split(": ", maxsplit=1)[1] for content in message_list]
-            header = received_element_list[MessageFormatEnum.RECEIVING_HEADER_POSITION.value]
-            if header in self.device_id_list:
-                received_command = received_element_list[MessageFormatEnum.RECEIVING_COMMAND_POSITION.value]
-                if received_command in self.command_map[header]:
-                    sending_command = self.command_map[header][received_command]["next_command"]
-                    protocol = self.command_map[header][received_command]["protocol"]
-                    receiver = received_element_list[MessageFormatEnum.RECEIVING_RECEIVER_POSITION.value]
-                    channel.send_message_to_device(protocol, sending_command, receiver)
-                else:
-                    self.logger.error("Unsupported command: " + received_command + " for " + header)
-            else:
-                self.logger.error(header + " is not a supported device id!")
+            message = channel.message_queue.get()
+            start_time = time.perf_counter()
+            mark_stage(message, DEQUEUE_STAGE)
+            if self.is_duplicate_message(message):
+                continue
+            try:
+                route_list = self.route_received_message(message)
+            except DeviceCommandError as e:
+                self.logger.error("Invalid message: " + str(e))
+                if self.traffic_capture is not None:
+                    self.traffic_capture.capture_routes(message, [], [])
+                self.finish_message(message)
+                continue
+            mark_stage(message, ROUTE_STAGE)
+            sent_list = []
+            for route in route_list:
+                sent = self.send_routed_message(route)
+                sent_list.append(sent)
+                if not sent:
+                    continue
+                FORWARD_LATENCY.labels(route[0]).observe(time.perf_counter() - start_time)
+                mark_stage(message, SEND_STAGE_PREFIX + route[0])
+            if self.traffic_capture is not None:
+                self.traffic_capture.capture_routes(message, route_list, sent_list)
+            self.finish_message(message)
+
+    def send_routed_message(self, route):
+        '''
+        按路由发送一条消息，endpoint熔断时丢弃，发送失败只记录日志，不影响后续消息的处理
+        channel返回False表示没有送达（例如设备没有连接到WebSocket服务器），channel已经记录日志
+        :return: 是否已发送
+        '''
+        try:
+            if self.channel.send_message_to_device(*route) is False:
+                return False
+        except CircuitOpenError:
+            return False
+        except Exception as e:
+            self.logger.error("forward " + route[1] + " to " + str(route[2]) + " through " + route[0] +
+                              " failed for " + str(e))
+            return False
+        return True
+
+    def is_duplicate_message(self, message):
+        '''
+        判断消息是否重复，重复的消息直接结束处理，不再路由和发送
+        :return:
+        '''
+        if self.message_deduplicator is None or not self.message_deduplicator.is_duplicate(message):
+            return False
+        DUPLICATE_MESSAGES.inc()
+        mark_stage(message, DUPLICATE_STAGE)
+        self.logger.info("drop duplicate message: " + str(message))
+        self.finish_message(message)
+        return True
+
+    def finish_message(self, message):
+        '''
+        消息处理结束：完成追踪，开启消息日志时确认该消息
+        :return:
+        '''
+        MESSAGE_TRACER.finish_trace(message)
+        if self.message_journal is not None:
+            self.message_journal.acknowledge_message(message)
+
+    def load_routing_table(self):
+        '''
+        加载路由表文件，文件不存在时由device_id_list和command_map编译默认路由表
+        :return: RoutingTable
+        '''
+        if not os.path.exists(self.routing_table_loader.file_path):
+            return RoutingTable.compile_routing_table(self.device_id_list, self.command_map)
+        routing_table = self.routing_table_loader.load_routing_table()
+        self.device_id_list = list(routing_table.device_id_list)
+        return routing_table
+
+    def apply_routing_table(self, routing_table):
+        '''
+        替换当前使用的路由表，并将其中的设备ID和命令加入编解码器的符号表
+        :return:
+        '''
+        self.message_codec.register_symbols(routing_table.get_symbols())
+        self.routing_table = routing_table
+
+    def reload_routing_table(self, routing_table):
+        '''
+        路由表文件热加载的回调：替换路由表，监听已经拉起时为新增的设备拉起监听
+        从路由表中移除的设备保留其监听，只是收到的消息不再被路由
+        :return:
+        '''
+        self.apply_routing_table(routing_table)
+        self.device_id_list = list(routing_table.device_id_list)
+        if self.listening_started:
+            self.start_channel_listeners()
+
+    def start_routing_table_watcher(self):
+        '''
+        存在路由表文件时拉起热加载线程
+        :return:
+        '''
+        if self.routing_table_loader.file_modified_time is not None:
+            self.routing_table_loader.start_watcher_thread()
+
+    def start_device_presence_service(self):
+        '''
+        跟踪串口设备和配置了序列号的开发板，拉起在线状态扫描线程
+        :return:
+        '''
+        modbus_channel_class = self.channel.load_channel_class("Modbus")
+        self.device_presence.track_devices(modbus_channel_class.serial_file_location_dict,
+                                           modbus_channel_class.device_sn_dict)
+        self.device_presence.start_poll_thread()
+
+    def enable_cluster(self, **kwargs):
+        '''
+        开启集群模式，参数与ClusterNode相同，未指定的使用ClusterEnum中的配置
+        :return: cluster_node
+        '''
+        cluster_node_class = importlib.import_module("core_services.cluster_node").ClusterNode
+        self.cluster_node = cluster_node_class(self.get_owned_devices, self.channel.send_message_to_local_device,
+                                               **kwargs)
+        self.channel.cluster_node = self.cluster_node
+        self.channel.mqtt_share_group = ClusterEnum.MQTT_SHARE_GROUP.value
+        return self.cluster_node
+
+    def start_cluster_node(self):
+        '''
+        开启集群模式时拉起节点间连接的监听和通告线程
+        :return:
+        '''
+        if self.cluster_node is None:
+            if not ClusterEnum.CLUSTER_ENABLED.value:
+                return
+            self.enable_cluster()
+        self.cluster_node.start_cluster_node()
+
+    def get_owned_devices(self):
+        '''
+        本节点拥有的设备：串口在本机上的Modbus设备，以及连接在本节点WebSocket服务器上的设备
+        :return: [(device_id, protocol), ...]
+        '''
+        owned_device_list = [(device_id, "Modbus")
+                             for device_id in self.channel.load_channel_class("Modbus").serial_file_location_dict
+                             if self.device_presence.is_serial_port_online(device_id)]
+        websocket_hub_class = importlib.import_module("core_services.websocket_hub").WebSocketHub
+        websocket_hub = websocket_hub_class.get_hub(**self.channel.get_channel_endpoint("WebSocket"))
+        if websocket_hub.is_serving():
+            owned_device_list += [(device_id, "WebSocket") for device_id in list(websocket_hub.device_session_dict)]
+        return owned_device_list
+
+    def is_receiver_reachable(self, protocol, receiver):
+        '''
+        判断是否向接收者转发：开发板离线时跳过所有转发，只是串口不在时跳过Modbus转发；
+        集群中由其他节点拥有的设备由该节点发送，不在本节点判断
+        :return:
+        '''
+        cluster_node = self.cluster_node
+        if cluster_node is not None and cluster_node.get_remote_owner(receiver, protocol) is not None:
+            return True
+        return self.device_presence.is_device_online(receiver) and \
+            (protocol != "Modbus" or self.device_presence.is_serial_port_online(receiver))
+
+    def get_process_tag(self):
+        '''
+        同一台机器上同时运行多个控制器进程时本进程的标识，用于区分各进程写入的文件，
+        分片的工作进程为"shard-分片编号"，集群节点为"node-节点间连接的监听端口"
+        :return: 只有一个控制器进程时返回None
+        '''
+        if self.shard_index is not None:
+            return MessageJournalEnum.SHARD_DIR_PREFIX.value + str(self.shard_index)
+        if self.cluster_node is not None:
+            return ClusterEnum.NODE_TAG_PREFIX.value + str(self.cluster_node.listen_port)
+        return None
+
+    def get_process_file_name(self, file_name):
+        '''
+        在文件名的扩展名前加上本进程的标识，例如metrics_snapshot-shard-0.json
+        :return:
+        '''
+        process_tag = self.get_process_tag()
+        if process_tag is None:
+            return file_name
+        file_root, file_extension = os.path.splitext(file_name)
+        return file_root + "-" + process_tag + file_extension
+
+    def get_metrics_port(self):
+        '''
+        指标HTTP接口的端口，未指定时分片的工作进程使用HTTP_PORT加分片编号，集群节点使用HTTP_PORT加监听端口相对默认监听端口的偏移，
+        同一台机器上的多个进程不会争用同一个端口
+        :return: 为0时不启动
+        '''
+        if self.metrics_port is not None:
+            return self.metrics_port
+        metrics_port = MetricsEnum.HTTP_PORT.value
+        if not metrics_port:
+            return metrics_port
+        if self.shard_index is not None:
+            return metrics_port + self.shard_index
+        if self.cluster_node is not None:
+            node_metrics_port = metrics_port + self.cluster_node.listen_port - ClusterEnum.LISTEN_PORT.value
+            # 偏移后超出端口范围时使用默认端口，这种情况下应通过--metrics-port指定
+            if 0 < node_metrics_port < 65536:
+                return node_metrics_port
+        return metrics_port
+
+    def start_metrics_exporter(self):
+        '''
+        拉起指标HTTP接口，日志目录可用时定期把指标快照写入日志目录
+        :return:
+        '''
+        METRICS_REGISTRY.start_http_server(port=self.get_metrics_port())
+        try:
+            log_dir = Logger.find_log_dir()
+        except CommonError as e:
+            self.logger.warning("metrics snapshot disabled for " + str(e))
+            return
+        snapshot_file_name = self.get_process_file_name(MetricsEnum.SNAPSHOT_FILE_NAME.value)
+        METRICS_REGISTRY.start_snapshot_thread(os.path.join(log_dir, snapshot_file_name))
+
+    def start_trace_dump(self):
+        '''
+        日志目录可用时定期把采样的消息追踪写入日志目录
+        :return:
+        '''
+        try:
+            log_dir = Logger.find_log_dir()
+        except CommonError as e:
+            self.logger.warning("message trace dump disabled for " + str(e))
+            return
+        dump_file_name = self.get_process_file_name(TracingEnum.DUMP_FILE_NAME.value)
+        MESSAGE_TRACER.start_dump_thread(os.path.join(log_dir, dump_file_name))
+
+    def open_message_journal(self):
+        '''
+        开启消息日志时打开log目录下的日志，分片的工作进程各自使用一个子目录，进程退出时写入剩余的记录
+        :return: [(message, device_id), ...]，需要重放的未确认消息
+        '''
+        if not MessageJournalEnum.JOURNAL_ENABLED.value:
+            return []
+        try:
+            log_dir = Logger.find_log_dir()
+        except CommonError as e:
+            self.logger.warning("message journal disabled for " + str(e))
+            return []
+        journal_dir = os.path.join(log_dir, MessageJournalEnum.JOURNAL_DIR_NAME.value)
+        process_tag = self.get_process_tag()
+        if process_tag is not None:
+            journal_dir = os.path.join(journal_dir, process_tag)
+        self.message_journal = MessageJournal(journal_dir)
+        replay_list = self.message_journal.open_journal()
+        atexit.register(self.message_journal.close_journal)
+        return replay_list
+
+    def start_traffic_capture(self, file_path=None):
+        '''
+        开启流量录制，未指定文件时只在配置开启录制的情况下写入log目录，已经开启时不做任何事；录制文件已存在时抛出FileExistsError
+        :return:
+        '''
+        if self.traffic_capture is not None:
+            return
+        if file_path is None:
+            if not TrafficCaptureEnum.CAPTURE_ENABLED.value:
+                return
+            try:
+                log_dir = Logger.find_log_dir()
+            except CommonError as e:
+                self.logger.warning("traffic capture disabled for " + str(e))
+                return
+            # 文件名带上进程号，同一秒内启动的多个进程（例如各分片的工作进程）不会写同一个文件
+            file_path = os.path.join(log_dir, TrafficCaptureEnum.CAPTURE_DIR_NAME.value,
+                                     TrafficCaptureEnum.CAPTURE_FILE_PREFIX.value + time.strftime("%Y%m%d-%H%M%S") +
+                                     "-" + str(os.getpid()) + TrafficCaptureEnum.CAPTURE_FILE_SUFFIX.value)
+        traffic_capture_class = importlib.import_module("core_services.traffic_capture").TrafficCapture
+        self.traffic_capture = traffic_capture_class(file_path)
+        self.traffic_capture.open_capture()
+        # 进程退出时写入索引和文件尾，异常退出时读取方顺序扫描
+        atexit.register(self.traffic_capture.close_capture)
+        self.channel.traffic_capture = self.traffic_capture
+
+    def start_message_journal(self):
+        '''
+        打开消息日志，并在后台把未确认的消息重新放入汇总队列
+        :return:
+        '''
+        replay_list = self.open_message_journal()
+        if self.message_journal is None:
+            return
+        self.channel.message_journal = self.message_journal
+        threading.Thread(target=self.channel.replay_journal_messages, args=(replay_list,),
+                         name="journal-replay", daemon=True).start()
+
+    def route_received_message(self, message):
+        '''
+        解析节点发来的信息，根据路由表得到下一步需要转发的协议、命令和接收者
+        节点声明自身支持的编码格式的消息只做格式协商，不转发
+        :return: [(protocol, sending_command, receiver), ...]，无法转发时返回空列表
+        '''
+        self.logger.info("channel.message_queue get: " + str(message))
+        device_message = self.message_codec.decode_message(message)
+        header = device_message.header
+        routing_table = self.routing_table
+        if not routing_table.is_supported_device(header):
+            self.logger.error(str(header) + " is not a supported device id!")
+            return []
+        if device_message.wire_format is not None:
+            wire_format = self.message_codec.negotiate_format(header, device_message.wire_format)
+            self.logger.info(header + " negotiated message format: " + wire_format)
+            return []
+        received_command = device_message.command
+        test_flow_scheduler = self.test_flow_scheduler
+        if test_flow_scheduler is not None and test_flow_scheduler.receive_device_message(header, received_command):
+            return []
+        route_actions = routing_table.get_route_actions(header, received_command)
+        if route_actions is None:
+            self.logger.error("Unsupported command: " + str(received_command) + " for " + header)
+            return []
+        route_list = []
+        for route_action in route_actions:
+            receiver = device_message.receiver if route_action.receiver is None else route_action.receiver
+            if not self.is_receiver_reachable(route_action.protocol, receiver):
+                self.logger.error(str(receiver) + " is offline, skip " + route_action.command)
+                continue
+            route_list.append((route_action.protocol, route_action.command, receiver))
+        return route_list
 
 
 if __name__ == "__main__":
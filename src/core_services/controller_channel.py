@@ -1,29 +1,58 @@
 import queue
+import functools
+import threading
+import importlib
+import concurrent.futures
 
+from common.channel_enum import ChannelPoolEnum
+from common.channel_enum import MessageQueueEnum
+from common.exception import CircuitOpenError
+from common.exception import CommonError
+from common.tracing_enum import TracingEnum
+from common.mqtt_enum import MQTTPublisherEnum
 from common.mqtt_enum import MQTTServerEnum
 from common.websocket_enum import WebsocketEnum
-from core_services.modbus_channel import ModBusChannel
-from core_services.mqtt_channel import MQTTChannel
-from core_services.websocket_channel import WebSocketChannel
+from core_services.channel_pool import ChannelPool
+from core_services.controller_metrics import METRICS_REGISTRY
+from core_services.controller_metrics import QUEUE_DEPTH
+from core_services.controller_metrics import QUEUE_DROPPED
+from core_services.controller_metrics import SHED_MESSAGES
+from core_services.fair_message_queue import FairMessageQueue
+from util.circuit_breaker import get_endpoint_circuit_breaker
 from util.logger_manager_ment import Logger
+from util.startup_profile import profile_stage
+from util.tracing import MessageTracer
+from util.tracing import mark_stage
+
+CHANNEL_DEQUEUE_STAGE = TracingEnum.CHANNEL_DEQUEUE_STAGE.value
+ENQUEUE_STAGE = TracingEnum.ENQUEUE_STAGE.value
+DROPPED_STAGE = TracingEnum.DROPPED_STAGE.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
 
 
 class ControllerChannel:
-    def __init__(self):
+    def __init__(self, channel_pool=None):
         '''
         channel类，主机代理
+        发送消息使用的channel由连接池统一创建和复用，不再每次转发都重新建立连接
         :return:
         '''
-        self.protocol_type_dict = {"MQTT": {"class": "MQTTChannel",
+        # channel类所在的模块只在首次使用该协议时导入，只用到部分协议时不会加载其他协议的依赖库
+        self.protocol_type_dict = {"MQTT": {"module": "core_services.mqtt_channel", "class": "MQTTChannel",
                                             "host": MQTTServerEnum.MQTT_SERVER_HOST.value,
                                             "port": MQTTServerEnum.MQTT_SERVER_PORT.value},
-                                   "WebSocket": {"class": "WebSocketChannel",
+                                   "WebSocket": {"module": "core_services.websocket_channel",
+                                                 "class": "WebSocketChannel",
                                                  "host": WebsocketEnum.WEBSOCKET_HOST.value,
                                                  "port": WebsocketEnum.WEBSOCKET_PORT.value},
-                                   "Modbus": {"class": "ModBusChannel"}}
+                                   "Modbus": {"module": "core_services.modbus_channel", "class": "ModBusChannel"}}
+        # retry_times为发送失败后重建channel重试的次数，未配置时使用RECONNECT_RETRY_TIMES；
+        # 持久化发布者的消息由paho在重连后重发，再次发布会导致重复，因此不重试
         self.channel_function_dict = {"MQTT": {"send_message_func_name": "publish_message_to_mqtt_server",
                                                "receive_message_func_name": "subscriber_connect_to_mqtt_server",
-                                               "message_queue": "mqtt_message_queue"},
+                                               "message_queue": "mqtt_message_queue",
+                                               "retry_times": 0 if MQTTPublisherEnum.PERSISTENT_PUBLISHER.value
+                                               else ChannelPoolEnum.RECONNECT_RETRY_TIMES.value},
                                       "WebSocket": {"send_message_func_name": "asyncio_run_send_message_to_websocket_server",
                                                     "receive_message_func_name": "asyncio_run_receive_message_from_device",
                                                     "message_queue": "websocket_message_queue"},
@@ -31,21 +60,128 @@ class ControllerChannel:
                                                  "receive_message_func_name": "receive_message_from_device_through_serial",
                                                  "message_queue": "modbus_message_queue"}}
         self.logger = Logger("Channel")
-        self.message_queue = queue.Queue()
+        self.message_queue = FairMessageQueue()
+        # 正在监听的channel，key为(device_id, protocol_type)，用于统计各channel队列的深度
+        self.listening_channel_dict = {}
+        # 开启消息日志时由控制器设置，进入汇总队列的消息先写入日志
+        self.message_journal = None
+        # 开启流量录制时由控制器设置，进入汇总队列的消息先写入录制文件
+        self.traffic_capture = None
+        # 所有设备共用的MQTT订阅者
+        self.mqtt_subscriber = None
+        # 集群模式下由控制器设置：发往其他节点拥有的设备的消息转发给该节点，MQTT上行消息以共享订阅在节点间分摊
+        self.cluster_node = None
+        self.mqtt_share_group = None
+        # 分片工作进程中由控制器设置为本分片的设备，MQTT只订阅这些设备的上行topic，为None时订阅所有设备
+        self.mqtt_device_id_list = None
+        # 已导入的channel类，key为协议类型
+        self.channel_class_dict = {}
+        self.channel_pool = channel_pool if channel_pool is not None else ChannelPool(self.create_channel)
+        # 队列深度只在输出指标时统计，不在入队出队时更新
+        METRICS_REGISTRY.add_collect_callback(self.collect_queue_metrics)
+
+    def register_protocol(self, protocol_type, module_name, class_name, send_message_func_name,
+                          receive_message_func_name, message_queue, **endpoint):
+        '''
+        注册一个协议：channel类在首次使用时才从module_name导入，endpoint为创建channel所需的参数
+        :return:
+        '''
+        protocol = {"module": module_name, "class": class_name}
+        protocol.update(endpoint)
+        self.protocol_type_dict[protocol_type] = protocol
+        self.channel_function_dict[protocol_type] = {"send_message_func_name": send_message_func_name,
+                                                     "receive_message_func_name": receive_message_func_name,
+                                                     "message_queue": message_queue}
+        self.channel_class_dict.pop(protocol_type, None)
+
+    def load_channel_class(self, protocol_type):
+        '''
+        获取协议对应的channel类，首次使用时导入其所在的模块
+        :return: channel_class
+        '''
+        channel_class = self.channel_class_dict.get(protocol_type)
+        if channel_class is None:
+            protocol = self.protocol_type_dict[protocol_type]
+            with profile_stage("load " + protocol_type + " channel"):
+                channel_class = getattr(importlib.import_module(protocol["module"]), protocol["class"])
+            self.channel_class_dict[protocol_type] = channel_class
+        return channel_class
+
+    def create_channel(self, protocol_type, **kwargs):
+        '''
+        根据协议类型创建对应的channel实例
+        :return: channel
+        '''
+        return self.load_channel_class(protocol_type)(**kwargs)
+
+    def get_channel_endpoint(self, protocol_type):
+        '''
+        获取协议对应的endpoint信息，即创建channel所需的参数
+        :return: endpoint
+        '''
+        return {key: var for key, var in self.protocol_type_dict[protocol_type].items()
+                if key not in ("module", "class")}
 
     def send_message_to_device(self, protocol_type, command, receiver_device_id):
         '''
-        channel发送信息
+        channel发送信息，集群模式下设备由其他节点拥有时交给到该节点的连接转发，不等待对端的发送结果
+        :return:
+        '''
+        cluster_node = self.cluster_node
+        if cluster_node is not None:
+            owner_node_id = cluster_node.get_remote_owner(receiver_device_id, protocol_type)
+            if owner_node_id is not None:
+                if not cluster_node.forward_message(owner_node_id, protocol_type, command, receiver_device_id):
+                    raise CommonError("cluster node " + owner_node_id + " is unreachable")
+                return True
+        return self.send_message_to_local_device(protocol_type, command, receiver_device_id)
+
+    def send_message_to_local_device(self, protocol_type, command, receiver_device_id):
+        '''
+        通过本节点的channel发送信息，endpoint熔断时不发送，抛出CircuitOpenError
+        channel返回future时（如MQTT持久化发布者）不等待完成，在future完成后记录熔断器的结果
         :return:
         '''
         if protocol_type not in self.protocol_type_dict:
             return self.logger.error("Unknown protocol_type")
-        channel_class_info = self.protocol_type_dict[protocol_type]
-        channel_class = globals()[channel_class_info["class"]]
-        kwargs = {key: var for key, var in channel_class_info.items() if key != 'class'}
-        channel = channel_class(**kwargs)
-        send_message = getattr(channel, self.channel_function_dict[protocol_type]['send_message_func_name'])
-        return send_message(command, receiver_device_id)
+        endpoint_name = self.get_endpoint_name(protocol_type, receiver_device_id)
+        circuit_breaker = get_endpoint_circuit_breaker(protocol_type, endpoint_name)
+        if not circuit_breaker.allow_request():
+            SHED_MESSAGES.labels(protocol_type, endpoint_name).inc()
+            raise CircuitOpenError(protocol_type + " endpoint " + endpoint_name + " is unavailable")
+        channel_function = self.channel_function_dict[protocol_type]
+        try:
+            result = self.channel_pool.call_with_channel(protocol_type, self.get_channel_endpoint(protocol_type),
+                                                         channel_function["send_message_func_name"], command,
+                                                         receiver_device_id,
+                                                         retry_times=channel_function.get(
+                                                             "retry_times", ChannelPoolEnum.RECONNECT_RETRY_TIMES.value))
+        except Exception:
+            circuit_breaker.record_failure()
+            raise
+        if isinstance(result, concurrent.futures.Future):
+            result.add_done_callback(functools.partial(self.record_send_result, circuit_breaker))
+            return result
+        circuit_breaker.record_success()
+        return result
+
+    @staticmethod
+    def record_send_result(circuit_breaker, future):
+        if future.cancelled() or future.exception() is not None:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+
+    def get_endpoint_name(self, protocol_type, device_id):
+        '''
+        消息实际发往的endpoint，与连接指标中的endpoint一致，用于按endpoint熔断
+        :return:
+        '''
+        if protocol_type == "Modbus":
+            return self.load_channel_class("Modbus").serial_file_location_dict.get(device_id, device_id)
+        endpoint = self.protocol_type_dict[protocol_type]
+        host_port = endpoint["host"] + ":" + str(endpoint["port"])
+        return "ws://" + host_port if protocol_type == "WebSocket" else host_port
 
     def get_message_from_device(self, device_id, protocol_type):
         '''
@@ -55,18 +191,116 @@ class ControllerChannel:
         self.logger.info("start monitor " + protocol_type + " for " + device_id)
         if protocol_type not in self.protocol_type_dict:
             return self.logger.error("Unknown protocol_type")
-        channel_class_info = self.protocol_type_dict[protocol_type]
-        channel_class = globals()[channel_class_info["class"]]
-        kwargs = {key: var for key, var in channel_class_info.items() if key != "class"}
-        channel = channel_class(**kwargs)
+        channel = self.create_channel(protocol_type, **self.get_channel_endpoint(protocol_type))
+        self.listening_channel_dict[(device_id, protocol_type)] = channel
         receive_message = getattr(channel, self.channel_function_dict[protocol_type]["receive_message_func_name"])
-        channel_message_queue_name = self.channel_function_dict[protocol_type]["message_queue"]
-        if channel_message_queue_name:
-            channel_message_queue = getattr(channel, channel_message_queue_name)
-            message = channel_message_queue.get()
-            self.message_queue.put(message)
-            self.logger.info("message_queue newly adds: " + message)
-        return receive_message(device_id)
+        channel_message_queue = getattr(channel, self.channel_function_dict[protocol_type]["message_queue"])
+        receive_error_list = []
+        receive_thread = threading.Thread(target=self.run_receive_message,
+                                          args=(receive_message, device_id, receive_error_list),
+                                          name=protocol_type + "-receiver-" + device_id, daemon=True)
+        receive_thread.start()
+        # 设备子队列处于高水位时停止搬运，channel队列随之写满，channel的接收线程阻塞后不再读取上游数据
+        while receive_thread.is_alive() or not channel_message_queue.empty():
+            self.message_queue.wait_until_writable(device_id)
+            try:
+                message = channel_message_queue.get(timeout=MessageQueueEnum.CHANNEL_QUEUE_POLL_INTERVAL.value)
+            except queue.Empty:
+                continue
+            mark_stage(message, CHANNEL_DEQUEUE_STAGE)
+            self.put_received_message(message, device_id, protocol_type)
+        raise CommonError(protocol_type + " receiver for " + device_id + " stopped" +
+                          (" for " + str(receive_error_list[0]) if receive_error_list else ""))
+
+    def put_received_message(self, message, device_id, protocol_type):
+        '''
+        将channel收到的消息放入汇总队列，开启流量录制和消息日志时先写入录制文件和日志
+        :return: 是否放入队列
+        '''
+        mark_stage(message, ENQUEUE_STAGE)
+        if self.traffic_capture is not None:
+            message = self.traffic_capture.capture_inbound(message, device_id, protocol_type)
+        if self.message_journal is not None:
+            message = self.message_journal.append_message(message, device_id)
+        if self.message_queue.put(message, device_id):
+            self.logger.info("message_queue newly adds: " + str(message))
+            return True
+        self.drop_message(message)
+        return False
+
+    def get_message_from_mqtt_subscriber(self):
+        '''
+        所有设备共用一个MQTT订阅者，按批取出消息放入汇总队列
+        设备共用一个连接，无法只暂停某个设备的读取，设备子队列满时由汇总队列丢弃该设备的新消息
+        :return:
+        '''
+        # 与MQTTChannel一样在首次使用时才导入paho
+        mqtt_subscriber_class = importlib.import_module("core_services.mqtt_subscriber").MQTTSubscriber
+        endpoint = self.get_channel_endpoint("MQTT")
+        self.mqtt_subscriber = mqtt_subscriber_class.get_subscriber(endpoint["host"], endpoint["port"],
+                                                                    share_group=self.mqtt_share_group,
+                                                                    device_id_list=self.mqtt_device_id_list)
+        self.logger.info("start monitor MQTT for all devices")
+        while True:
+            device_message_list = self.mqtt_subscriber.drain_messages()
+            if not device_message_list:
+                continue
+            for index, (device_id, message) in enumerate(device_message_list):
+                mark_stage(message, CHANNEL_DEQUEUE_STAGE)
+                mark_stage(message, ENQUEUE_STAGE)
+                if self.traffic_capture is not None:
+                    message = self.traffic_capture.capture_inbound(message, device_id, "MQTT")
+                if self.message_journal is not None:
+                    message = self.message_journal.append_message(message, device_id)
+                device_message_list[index] = (device_id, message)
+            for message in self.message_queue.put_batch(device_message_list):
+                self.drop_message(message)
+
+    def drop_message(self, message):
+        mark_stage(message, DROPPED_STAGE)
+        MESSAGE_TRACER.finish_trace(message)
+        if self.message_journal is not None:
+            self.message_journal.acknowledge_message(message)
+
+    def replay_journal_messages(self, replay_list):
+        '''
+        将消息日志中未确认的消息重新放入汇总队列，设备子队列处于高水位时等待
+        :return:
+        '''
+        for message, device_id in replay_list:
+            self.message_queue.wait_until_writable(device_id)
+            if not self.message_queue.put(message, device_id):
+                self.message_journal.acknowledge_message(message)
+        self.logger.info("replayed " + str(len(replay_list)) + " journaled messages")
+
+    @staticmethod
+    def run_receive_message(receive_message, device_id, receive_error_list):
+        try:
+            receive_message(device_id)
+        except Exception as e:
+            receive_error_list.append(e)
+
+    def get_queue_stats(self):
+        '''
+        汇总队列中各设备子队列的统计信息以及各channel队列的深度
+        :return:
+        '''
+        channel_queue_depth_dict = {}
+        for (device_id, protocol_type), channel in list(self.listening_channel_dict.items()):
+            channel_message_queue = getattr(channel, self.channel_function_dict[protocol_type]["message_queue"])
+            channel_queue_depth_dict[protocol_type + "/" + device_id] = channel_message_queue.qsize()
+        if self.mqtt_subscriber is not None:
+            channel_queue_depth_dict["MQTT/*"] = self.mqtt_subscriber.qsize()
+        return {"message_queue": self.message_queue.get_queue_stats(),
+                "channel_queues": channel_queue_depth_dict}
+
+    def collect_queue_metrics(self):
+        queue_stats = self.get_queue_stats()
+        for device_id, device_queue_stats in queue_stats["message_queue"].items():
+            QUEUE_DEPTH.labels("message_queue", device_id).set(device_queue_stats["depth"])
+            QUEUE_DROPPED.labels("message_queue", device_id).set(device_queue_stats["dropped"])
+        for channel_key, depth in queue_stats["channel_queues"].items():
+            QUEUE_DEPTH.labels("channel_queue", channel_key).set(depth)
 
 
 if __name__ == "__main__":
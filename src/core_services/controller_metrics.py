@@ -0,0 +1,50 @@
+from util.circuit_breaker import get_endpoint_circuit_breaker
+from util.metrics import MetricsRegistry
+
+# 控制器各处埋点使用的指标，关闭监控时都是空指标
+METRICS_REGISTRY = MetricsRegistry.get_default_registry()
+
+MESSAGES_RECEIVED = METRICS_REGISTRY.counter("controller_messages_received_total",
+                                             "Messages received from devices", ("protocol", "device"))
+MESSAGES_SENT = METRICS_REGISTRY.counter("controller_messages_sent_total",
+                                         "Messages sent to devices", ("protocol", "device"))
+CONNECTIONS = METRICS_REGISTRY.counter("controller_connections_total",
+                                       "Connections established to servers and serial ports", ("protocol", "endpoint"))
+RECONNECTIONS = METRICS_REGISTRY.counter("controller_reconnections_total",
+                                         "Connections re-established after the first one", ("protocol", "endpoint"))
+QUEUE_DEPTH = METRICS_REGISTRY.gauge("controller_queue_depth",
+                                     "Messages waiting in controller and channel queues", ("queue", "device"))
+QUEUE_DROPPED = METRICS_REGISTRY.gauge("controller_queue_dropped_messages",
+                                       "Messages dropped because a queue was full", ("queue", "device"))
+DUPLICATE_MESSAGES = METRICS_REGISTRY.counter("controller_duplicate_messages_total",
+                                              "Messages dropped as duplicates before routing")
+SHED_MESSAGES = METRICS_REGISTRY.counter("controller_shed_messages_total",
+                                         "Messages not sent because the endpoint circuit was open",
+                                         ("protocol", "endpoint"))
+LISTENER_UP = METRICS_REGISTRY.gauge("controller_listener_up",
+                                     "Whether a supervised listener is running", ("listener",))
+LISTENER_RESTARTS = METRICS_REGISTRY.counter("controller_listener_restarts_total",
+                                             "Supervised listener restarts after failures", ("listener",))
+CIRCUIT_STATE = METRICS_REGISTRY.gauge("controller_circuit_state",
+                                       "Endpoint circuit state: 0 closed, 1 half open, 2 open", ("endpoint",))
+CLUSTER_FORWARDED_MESSAGES = METRICS_REGISTRY.counter("controller_cluster_forwarded_messages_total",
+                                                      "Messages forwarded between cluster nodes",
+                                                      ("peer", "direction"))
+CLUSTER_DROPPED_MESSAGES = METRICS_REGISTRY.counter("controller_cluster_dropped_messages_total",
+                                                    "Messages for a cluster peer dropped before being sent", ("peer",))
+CLUSTER_NODES = METRICS_REGISTRY.gauge("controller_cluster_nodes", "Live nodes in the cluster membership table")
+FORWARD_LATENCY = METRICS_REGISTRY.histogram("controller_forward_latency_seconds",
+                                             "Time from taking a message off the queue to finishing a forward",
+                                             ("protocol",))
+
+
+def record_connection(protocol, endpoint, is_reconnect):
+    '''
+    记录一次连接建立，is_reconnect表示之前已经连接过
+    :return:
+    '''
+    CONNECTIONS.labels(protocol, endpoint).inc()
+    # 连接建立说明endpoint已恢复，闭合其熔断器
+    get_endpoint_circuit_breaker(protocol, endpoint).record_success()
+    if is_reconnect:
+        RECONNECTIONS.labels(protocol, endpoint).inc()
@@ -0,0 +1,237 @@
+import os
+import glob
+import time
+import shlex
+import threading
+import subprocess
+
+from common.device_enum import DevicePresenceEnum
+from util.logger_manager_ment import Logger
+
+CONNECT_EVENT = DevicePresenceEnum.CONNECT_EVENT.value
+DISCONNECT_EVENT = DevicePresenceEnum.DISCONNECT_EVENT.value
+
+
+def read_usb_serial_number(tty_name):
+    '''
+    通过sysfs读取USB串口所属USB设备的序列号
+    :return: 序列号，读取不到时返回None
+    '''
+    device_path = os.path.realpath(os.path.join(DevicePresenceEnum.SYSFS_TTY_PATH.value, tty_name, "device"))
+    # 从串口接口向上查找USB设备目录中的serial文件
+    while device_path not in ("/", ""):
+        serial_file_path = os.path.join(device_path, "serial")
+        if os.path.isfile(serial_file_path):
+            try:
+                with open(serial_file_path, "r") as serial_file:
+                    return serial_file.read().strip() or None
+            except OSError:
+                return None
+        device_path = os.path.dirname(device_path)
+    return None
+
+
+class DevicePresenceService:
+    default_service = None
+    default_service_lock = threading.Lock()
+
+    def __init__(self, poll_interval=DevicePresenceEnum.POLL_INTERVAL.value,
+                 hdc_poll_interval=DevicePresenceEnum.HDC_POLL_INTERVAL.value,
+                 presence_ttl=DevicePresenceEnum.PRESENCE_TTL.value,
+                 hdc_command=DevicePresenceEnum.HDC_COMMAND.value):
+        '''
+        设备在线状态服务：后台线程定期扫描串口设备文件和sysfs中的USB序列号，并按较长的间隔执行hdc查询开发板序列号，
+        结果按序列号和设备ID缓存，最后一次扫描到之后PRESENCE_TTL内视为在线；状态变化时通知监听者
+        查询在线状态只读缓存，不会为每条消息启动子进程
+        :return:
+        '''
+        self.poll_interval = poll_interval
+        self.hdc_poll_interval = hdc_poll_interval
+        self.presence_ttl = presence_ttl
+        self.hdc_command = hdc_command
+        self.logger = Logger("DevicePresence")
+        # 需要跟踪的设备：device_id -> 串口位置，device_id -> 开发板序列号
+        self.serial_file_location_dict = {}
+        self.device_sn_dict = {}
+        # 序列号/设备ID -> 最后一次扫描到的时间，设备ID分别按开发板序列号和串口位置记录
+        self.serial_number_seen_dict = {}
+        self.device_seen_dict = {}
+        self.serial_port_seen_dict = {}
+        self.online_serial_number_set = set()
+        self.online_device_id_set = set()
+        self.online_serial_port_set = set()
+        self.hdc_serial_number_set = set()
+        self.next_hdc_poll_time = 0
+        self.hdc_available = True
+        self.last_poll_time = None
+        self.listener_list = []
+        self.poll_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.poll_thread = None
+
+    @classmethod
+    def get_default_service(cls):
+        '''
+        获取进程内共享的设备在线状态服务
+        :return: service
+        '''
+        with cls.default_service_lock:
+            if cls.default_service is None:
+                cls.default_service = cls()
+            return cls.default_service
+
+    def track_devices(self, serial_file_location_dict, device_sn_dict=None):
+        '''
+        设置需要跟踪的设备，开发板序列号被扫描到时设备在线，串口位置存在时设备的串口在线
+        :return:
+        '''
+        self.serial_file_location_dict = dict(serial_file_location_dict)
+        self.device_sn_dict = dict(device_sn_dict or {})
+
+    def add_listener(self, callback):
+        '''
+        注册状态变化监听者，callback(event, key_type, key)，event为connect或disconnect，
+        key_type为sn、device_id或serial_port（key为设备ID）
+        callback在扫描线程中调用，不能阻塞
+        :return:
+        '''
+        self.listener_list.append(callback)
+
+    def start_poll_thread(self):
+        if self.poll_thread is not None and self.poll_thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.poll_thread = threading.Thread(target=self.poll_presence_forever, name="device-presence", daemon=True)
+        self.poll_thread.start()
+
+    def stop_poll_thread(self):
+        self.stop_event.set()
+
+    def poll_presence_forever(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll_presence()
+            except Exception as e:
+                self.logger.error("poll device presence failed for " + str(e))
+            self.stop_event.wait(self.poll_interval)
+
+    def poll_presence(self):
+        '''
+        扫描一次设备，更新缓存并通知状态变化
+        :return:
+        '''
+        with self.poll_lock:
+            now = time.monotonic()
+            serial_number_set = self.scan_usb_serial_numbers()
+            if now >= self.next_hdc_poll_time:
+                self.hdc_serial_number_set = self.query_hdc_serial_numbers()
+                self.next_hdc_poll_time = now + self.hdc_poll_interval
+            serial_number_set |= self.hdc_serial_number_set
+            for serial_number in serial_number_set:
+                self.serial_number_seen_dict[serial_number] = now
+            for device_id, serial_file_location in self.serial_file_location_dict.items():
+                if os.path.exists(serial_file_location):
+                    self.serial_port_seen_dict[device_id] = now
+            for device_id, serial_number in self.device_sn_dict.items():
+                if serial_number in serial_number_set:
+                    self.device_seen_dict[device_id] = now
+            self.last_poll_time = now
+            online_serial_number_set = self.get_online_keys(self.serial_number_seen_dict, now)
+            online_device_id_set = self.get_online_keys(self.device_seen_dict, now)
+            online_serial_port_set = self.get_online_keys(self.serial_port_seen_dict, now)
+            self.notify_changes("sn", self.online_serial_number_set, online_serial_number_set)
+            self.notify_changes("device_id", self.online_device_id_set, online_device_id_set)
+            self.notify_changes("serial_port", self.online_serial_port_set, online_serial_port_set)
+            self.online_serial_number_set = online_serial_number_set
+            self.online_device_id_set = online_device_id_set
+            self.online_serial_port_set = online_serial_port_set
+
+    def get_online_keys(self, seen_dict, now):
+        expired_key_list = [key for key, seen_time in seen_dict.items() if now - seen_time > self.presence_ttl]
+        for key in expired_key_list:
+            del seen_dict[key]
+        return set(seen_dict)
+
+    def notify_changes(self, key_type, previous_key_set, current_key_set):
+        for event, key_set in ((CONNECT_EVENT, current_key_set - previous_key_set),
+                               (DISCONNECT_EVENT, previous_key_set - current_key_set)):
+            for key in sorted(key_set):
+                self.logger.info(key_type + " " + key + " " + event + "ed")
+                for callback in self.listener_list:
+                    try:
+                        callback(event, key_type, key)
+                    except Exception as e:
+                        self.logger.error("device presence listener failed for " + str(e))
+
+    @staticmethod
+    def scan_usb_serial_numbers():
+        serial_number_set = set()
+        for serial_device_path in glob.glob(DevicePresenceEnum.SERIAL_DEVICE_PATTERN.value):
+            serial_number = read_usb_serial_number(os.path.basename(serial_device_path))
+            if serial_number is not None:
+                serial_number_set.add(serial_number)
+        return serial_number_set
+
+    def query_hdc_serial_numbers(self):
+        '''
+        执行hdc查询已连接开发板的序列号，hdc不可用时返回空集合
+        :return: {serial_number, ...}
+        '''
+        if not self.hdc_available:
+            return set()
+        try:
+            result = subprocess.run(shlex.split(self.hdc_command), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    timeout=DevicePresenceEnum.HDC_TIMEOUT.value, universal_newlines=True)
+        except FileNotFoundError:
+            # 没有安装hdc的主机上不再重复尝试
+            self.hdc_available = False
+            self.logger.warning("hdc is not available, only serial devices are tracked")
+            return set()
+        except subprocess.TimeoutExpired:
+            self.logger.error("hdc list targets timeout")
+            return self.hdc_serial_number_set
+        return {line.strip() for line in result.stdout.splitlines()
+                if line.strip() and line.strip() != DevicePresenceEnum.HDC_EMPTY_OUTPUT.value}
+
+    def refresh_if_stale(self):
+        '''
+        后台线程没有运行且缓存已过期时同步扫描一次
+        :return:
+        '''
+        if self.poll_thread is not None and self.poll_thread.is_alive():
+            return
+        if self.last_poll_time is None or time.monotonic() - self.last_poll_time > self.presence_ttl:
+            self.poll_presence()
+
+    def is_device_online(self, device_id):
+        '''
+        查询开发板是否在线，没有配置序列号的设备无法判断，视为在线
+        :return:
+        '''
+        if device_id not in self.device_sn_dict:
+            return True
+        self.refresh_if_stale()
+        return device_id in self.online_device_id_set
+
+    def is_serial_port_online(self, device_id):
+        '''
+        查询设备的串口是否存在，没有配置串口位置的设备视为在线
+        :return:
+        '''
+        if device_id not in self.serial_file_location_dict:
+            return True
+        self.refresh_if_stale()
+        return device_id in self.online_serial_port_set
+
+    def is_serial_number_online(self, serial_number):
+        self.refresh_if_stale()
+        return serial_number in self.online_serial_number_set
+
+    def get_presence_map(self):
+        '''
+        当前在线的序列号和设备ID
+        :return: {"sn": [...], "device_id": [...], "serial_port": [...]}
+        '''
+        self.refresh_if_stale()
+        return {"sn": sorted(self.online_serial_number_set), "device_id": sorted(self.online_device_id_set),
+                "serial_port": sorted(self.online_serial_port_set)}
@@ -0,0 +1,174 @@
+import queue
+import threading
+import collections
+
+from common.channel_enum import MessageQueueEnum
+from util.logger_manager_ment import Logger
+
+
+class DeviceMessageQueue:
+    def __init__(self, device_id):
+        '''
+        单个设备的子队列及其统计信息
+        :return:
+        '''
+        self.device_id = device_id
+        self.message_deque = collections.deque()
+        self.deficit = 0
+        self.active = False
+        self.enqueued_count = 0
+        self.dropped_count = 0
+        # set表示可以继续读取该设备的上游数据，达到高水位时clear
+        self.writable_event = threading.Event()
+        self.writable_event.set()
+
+
+class FairMessageQueue:
+    def __init__(self, max_device_queue_size=MessageQueueEnum.MAX_DEVICE_QUEUE_SIZE.value,
+                 max_total_queue_size=MessageQueueEnum.MAX_TOTAL_QUEUE_SIZE.value,
+                 high_watermark=MessageQueueEnum.HIGH_WATERMARK.value,
+                 low_watermark=MessageQueueEnum.LOW_WATERMARK.value,
+                 quantum=MessageQueueEnum.DRR_QUANTUM.value):
+        '''
+        有界的汇总消息队列，每个设备一个子队列，get时按差额轮询（DRR）在有消息的设备之间调度，
+        一个设备消息再多也只能按字节额度轮流出队，不会饿死其他设备
+        设备子队列达到高水位时暂停读取上游数据，降到低水位时恢复；队列满时丢弃新消息并计数
+        接口与queue.Queue保持一致，put额外接收device_id参数
+        :return:
+        '''
+        self.max_device_queue_size = max_device_queue_size
+        self.max_total_queue_size = max_total_queue_size
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.quantum = quantum
+        self.device_queue_dict = {}
+        # 有待出队消息的设备，按轮询顺序排列
+        self.active_device_deque = collections.deque()
+        self.total_size = 0
+        self.condition = threading.Condition()
+        self.logger = Logger("FairMessageQueue")
+
+    def get_device_queue(self, device_id):
+        device_queue = self.device_queue_dict.get(device_id)
+        if device_queue is None:
+            device_queue = DeviceMessageQueue(device_id)
+            self.device_queue_dict[device_id] = device_queue
+        return device_queue
+
+    def put(self, message, device_id="", block=True, timeout=None):
+        '''
+        消息加入指定设备的子队列，队列已满时丢弃
+        block和timeout只为兼容queue.Queue的接口，入队从不阻塞，上游应通过wait_until_writable限流
+        :return: 是否入队成功
+        '''
+        with self.condition:
+            if not self.append_message(message, device_id):
+                return False
+            self.condition.notify()
+            return True
+
+    def put_batch(self, device_message_list):
+        '''
+        一次加锁将一批消息加入各自设备的子队列
+        :param device_message_list: [(device_id, message), ...]
+        :return: 因队列已满被丢弃的消息列表
+        '''
+        dropped_message_list = []
+        with self.condition:
+            for device_id, message in device_message_list:
+                if not self.append_message(message, device_id):
+                    dropped_message_list.append(message)
+            self.condition.notify(len(device_message_list) - len(dropped_message_list))
+        return dropped_message_list
+
+    def append_message(self, message, device_id):
+        '''
+        在持有锁时将消息加入设备子队列
+        :return: 是否入队成功
+        '''
+        device_queue = self.get_device_queue(device_id)
+        if len(device_queue.message_deque) >= self.max_device_queue_size or \
+                self.total_size >= self.max_total_queue_size:
+            device_queue.dropped_count += 1
+            if device_queue.dropped_count % 1000 == 1:
+                self.logger.warning("message queue of " + str(device_id) + " is full, dropped " +
+                                    str(device_queue.dropped_count) + " messages")
+            return False
+        device_queue.message_deque.append(message)
+        device_queue.enqueued_count += 1
+        self.total_size += 1
+        if not device_queue.active:
+            device_queue.active = True
+            self.active_device_deque.append(device_queue)
+        if len(device_queue.message_deque) >= self.high_watermark and device_queue.writable_event.is_set():
+            device_queue.writable_event.clear()
+            self.logger.warning("message queue of " + str(device_id) + " reaches high watermark, pause reading")
+        return True
+
+    def put_nowait(self, message, device_id=""):
+        return self.put(message, device_id, block=False)
+
+    def get(self, block=True, timeout=None):
+        '''
+        按差额轮询取出下一条消息
+        :return: message
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.total_size > 0, timeout if block else 0):
+                raise queue.Empty
+            while True:
+                device_queue = self.active_device_deque[0]
+                message_cost = self.get_message_cost(device_queue.message_deque[0])
+                if device_queue.deficit < message_cost:
+                    device_queue.deficit += self.quantum
+                    self.active_device_deque.rotate(-1)
+                    continue
+                device_queue.deficit -= message_cost
+                message = device_queue.message_deque.popleft()
+                self.total_size -= 1
+                if not device_queue.message_deque:
+                    device_queue.active = False
+                    device_queue.deficit = 0
+                    self.active_device_deque.popleft()
+                if len(device_queue.message_deque) <= self.low_watermark and not device_queue.writable_event.is_set():
+                    device_queue.writable_event.set()
+                    self.logger.info("message queue of " + str(device_queue.device_id) +
+                                     " drops to low watermark, resume reading")
+                return message
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    @staticmethod
+    def get_message_cost(message):
+        try:
+            return len(message)
+        except TypeError:
+            return 1
+
+    def wait_until_writable(self, device_id, timeout=None):
+        '''
+        上游读取消息前调用，设备子队列处于高水位时阻塞，直到降到低水位
+        :return: 是否可以继续读取
+        '''
+        with self.condition:
+            device_queue = self.get_device_queue(device_id)
+        return device_queue.writable_event.wait(timeout)
+
+    def qsize(self):
+        return self.total_size
+
+    def empty(self):
+        return self.total_size == 0
+
+    def get_queue_stats(self):
+        '''
+        各设备子队列的深度、入队数量、丢弃数量以及是否暂停读取
+        :return: {device_id: {...}}
+        '''
+        with self.condition:
+            return {device_id: {"depth": len(device_queue.message_deque),
+                                "enqueued": device_queue.enqueued_count,
+                                "dropped": device_queue.dropped_count,
+                                "paused": not device_queue.writable_event.is_set()}
+                    for device_id, device_queue in self.device_queue_dict.items()}
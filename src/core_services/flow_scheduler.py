@@ -0,0 +1,354 @@
+import sys
+import json
+import time
+import heapq
+import argparse
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+from common.controller_enum import TestFlowEnum
+from common.exception import ConfigError
+from core_services.controller import Controller
+from util.logger_manager_ment import Logger
+from util.rate_limiter import TokenBucket
+from util.tracing import calculate_percentile
+
+PASSED_STATUS = TestFlowEnum.PASSED_STATUS.value
+FAILED_STATUS = TestFlowEnum.FAILED_STATUS.value
+TIMEOUT_STATUS = TestFlowEnum.TIMEOUT_STATUS.value
+SEND_FAILED_STATUS = TestFlowEnum.SEND_FAILED_STATUS.value
+
+# 流程中的一步：通过protocol向设备发送command，设备执行后回复同一个command
+FlowStep = collections.namedtuple("FlowStep", ["protocol", "command"])
+
+
+def build_flow_steps(routing_table, device_id, start_command, max_step_number=TestFlowEnum.MAX_STEP_NUMBER.value):
+    '''
+    从设备发出start_command开始，沿路由表展开命令链，命令重复出现或没有下一步时结束
+    一条命令有多个转发动作时只取发给设备自身的第一个
+    :return: [FlowStep, ...]
+    '''
+    step_list = []
+    visited_command_set = set()
+    command = start_command
+    while command not in visited_command_set and len(step_list) < max_step_number:
+        visited_command_set.add(command)
+        route_action = next((route_action for route_action in routing_table.get_route_actions(device_id, command) or ()
+                             if route_action.receiver in (None, device_id)), None)
+        if route_action is None:
+            break
+        step_list.append(FlowStep(route_action.protocol, route_action.command))
+        command = route_action.command
+    return step_list
+
+
+class FlowRun:
+    def __init__(self, device_id, run_index, step_list):
+        '''
+        一个设备的一次流程执行，按顺序执行step_list中的每一步
+        :return:
+        '''
+        self.device_id = device_id
+        self.run_index = run_index
+        self.step_list = step_list
+        self.step_index = 0
+        # 每开始一步加一，用于识别已经过期的超时和发送结果
+        self.step_token = 0
+        self.start_time = None
+        self.step_start_time = None
+        self.step_result_list = []
+        self.status = None
+
+
+class TestFlowScheduler:
+    def __init__(self, controller, max_concurrent_flows=TestFlowEnum.MAX_CONCURRENT_FLOWS.value,
+                 pipeline_depth=TestFlowEnum.PIPELINE_DEPTH.value, step_timeout=TestFlowEnum.STEP_TIMEOUT.value,
+                 protocol_rate_limit_dict=TestFlowEnum.PROTOCOL_RATE_LIMIT.value,
+                 rate_limit_burst=TestFlowEnum.RATE_LIMIT_BURST.value,
+                 send_worker_number=TestFlowEnum.SEND_WORKER_NUMBER.value, clock=time.monotonic):
+        '''
+        多设备测试流程调度：各设备的命令链并行执行，设备的回复由控制器交给调度器后立即开始下一步
+        总耗时接近最慢的设备而不是所有设备之和；并发流程数、每个设备的流水线深度和各协议的发送速率都有上限
+        调度在调用run_flows的线程中进行，发送交给线程池，超时和限速等待由定时器堆处理
+        :return:
+        '''
+        self.controller = controller
+        self.max_concurrent_flows = max_concurrent_flows
+        self.pipeline_depth = pipeline_depth
+        self.step_timeout = step_timeout
+        self.rate_limiter_dict = {protocol: TokenBucket(rate, rate_limit_burst, clock)
+                                  for protocol, rate in protocol_rate_limit_dict.items() if rate}
+        self.send_worker_number = send_worker_number
+        self.clock = clock
+        self.logger = Logger("TestFlowScheduler")
+        self.condition = threading.Condition()
+        # (到期时间, 序号, 回调, 参数)
+        self.timer_heap = []
+        self.timer_counter = itertools.count()
+        # 等待执行的流程，key为设备ID
+        self.pending_run_dict = collections.OrderedDict()
+        self.active_run_count_dict = collections.defaultdict(int)
+        self.active_run_count = 0
+        # 等待设备回复的流程，key为(device_id, command)，同一设备流水线执行时按发送顺序匹配回复
+        self.waiting_run_dict = collections.defaultdict(collections.deque)
+        # 流程中所有的(device_id, command)，超时之后才到达的回复也由调度器丢弃，不再被控制器路由
+        self.flow_command_set = set()
+        self.finished_run_list = []
+        self.executor = None
+        self.start_time = None
+
+    def add_flows(self, device_id, start_command, repeat_times=1):
+        '''
+        为设备添加repeat_times次从start_command开始的流程
+        :return: 流程的步骤
+        '''
+        step_list = build_flow_steps(self.controller.routing_table, device_id, start_command)
+        if not step_list:
+            raise ConfigError("No route for " + str(start_command) + " of " + str(device_id))
+        self.flow_command_set.update((device_id, step.command) for step in step_list)
+        pending_run_deque = self.pending_run_dict.setdefault(device_id, collections.deque())
+        for run_index in range(repeat_times):
+            pending_run_deque.append(FlowRun(device_id, run_index, step_list))
+        return step_list
+
+    def run_flows(self):
+        '''
+        执行所有已添加的流程，全部结束后返回
+        :return: 测试结果，见get_campaign_result
+        '''
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.send_worker_number,
+                                                              thread_name_prefix="test-flow-sender")
+        self.start_time = self.clock()
+        self.controller.test_flow_scheduler = self
+        try:
+            with self.condition:
+                self.start_pending_runs()
+                while True:
+                    self.run_due_timers()
+                    if not self.active_run_count and not any(self.pending_run_dict.values()):
+                        break
+                    self.condition.wait(self.timer_heap[0][0] - self.clock() if self.timer_heap else None)
+        finally:
+            self.controller.test_flow_scheduler = None
+            self.executor.shutdown(wait=False)
+        return self.get_campaign_result()
+
+    def receive_device_message(self, device_id, command):
+        '''
+        控制器收到设备消息时调用，消息是某个流程正在等待的回复时由调度器处理，不再路由
+        :return: 消息是否被调度器处理
+        '''
+        if (device_id, command) not in self.flow_command_set:
+            return False
+        with self.condition:
+            waiting_run_deque = self.waiting_run_dict.get((device_id, command))
+            if not waiting_run_deque:
+                self.logger.warning("drop late reply " + command + " from " + device_id)
+                return True
+            flow_run = waiting_run_deque.popleft()
+            self.finish_step(flow_run, PASSED_STATUS)
+            self.condition.notify()
+            return True
+
+    def start_pending_runs(self):
+        '''
+        在并发上限和各设备流水线深度内开始等待中的流程，各设备轮流开始，不让某个设备占满并发
+        :return:
+        '''
+        started = True
+        while started and self.active_run_count < self.max_concurrent_flows:
+            started = False
+            for device_id, pending_run_deque in self.pending_run_dict.items():
+                if self.active_run_count >= self.max_concurrent_flows:
+                    return
+                if not pending_run_deque or self.active_run_count_dict[device_id] >= self.pipeline_depth:
+                    continue
+                flow_run = pending_run_deque.popleft()
+                self.active_run_count_dict[device_id] += 1
+                self.active_run_count += 1
+                flow_run.start_time = self.clock()
+                self.start_step(flow_run)
+                started = True
+
+    def start_step(self, flow_run):
+        '''
+        开始流程的当前步骤，协议限速时推迟发送
+        :return:
+        '''
+        flow_run.step_token += 1
+        rate_limiter = self.rate_limiter_dict.get(flow_run.step_list[flow_run.step_index].protocol)
+        delay = rate_limiter.reserve() if rate_limiter is not None else 0
+        if delay:
+            self.add_timer(delay, self.send_step, flow_run, flow_run.step_token)
+        else:
+            self.send_step(flow_run, flow_run.step_token)
+
+    def send_step(self, flow_run, step_token):
+        '''
+        先登记等待的回复和超时，再交给线程池发送，避免回复先于登记到达
+        :return:
+        '''
+        step = flow_run.step_list[flow_run.step_index]
+        flow_run.step_start_time = self.clock()
+        self.waiting_run_dict[(flow_run.device_id, step.command)].append(flow_run)
+        self.add_timer(self.step_timeout, self.check_step_timeout, flow_run, step_token)
+        self.executor.submit(self.send_step_message, flow_run, step, step_token)
+
+    def send_step_message(self, flow_run, step, step_token):
+        try:
+            self.controller.channel.send_message_to_device(step.protocol, step.command, flow_run.device_id)
+        except Exception as e:
+            with self.condition:
+                if flow_run.step_token == step_token and flow_run.status is None:
+                    self.finish_step(flow_run, SEND_FAILED_STATUS, str(e))
+                    self.condition.notify()
+
+    def check_step_timeout(self, flow_run, step_token):
+        if flow_run.step_token == step_token and flow_run.status is None:
+            self.finish_step(flow_run, TIMEOUT_STATUS,
+                             "no reply within " + str(self.step_timeout) + "s")
+
+    def finish_step(self, flow_run, status, error=None):
+        '''
+        记录当前步骤的结果，通过时开始下一步，否则流程失败
+        :return:
+        '''
+        step = flow_run.step_list[flow_run.step_index]
+        if status != PASSED_STATUS:
+            waiting_run_deque = self.waiting_run_dict.get((flow_run.device_id, step.command))
+            if waiting_run_deque and flow_run in waiting_run_deque:
+                waiting_run_deque.remove(flow_run)
+        now = self.clock()
+        flow_run.step_result_list.append({"step": flow_run.step_index, "protocol": step.protocol,
+                                          "command": step.command, "status": status,
+                                          "start_ms": round((flow_run.step_start_time - self.start_time) * 1000, 3),
+                                          "duration_ms": round((now - flow_run.step_start_time) * 1000, 3),
+                                          "error": error})
+        if status == PASSED_STATUS and flow_run.step_index + 1 < len(flow_run.step_list):
+            flow_run.step_index += 1
+            self.start_step(flow_run)
+            return
+        flow_run.status = PASSED_STATUS if status == PASSED_STATUS else FAILED_STATUS
+        flow_run.step_token += 1
+        if flow_run.status == FAILED_STATUS:
+            self.logger.error(flow_run.device_id + " flow " + str(flow_run.run_index) + " failed at step " +
+                              str(flow_run.step_index) + " " + step.command + ": " + status)
+        self.finished_run_list.append((flow_run, now))
+        self.active_run_count_dict[flow_run.device_id] -= 1
+        self.active_run_count -= 1
+        self.start_pending_runs()
+
+    def add_timer(self, delay, callback, *args):
+        heapq.heappush(self.timer_heap, (self.clock() + delay, next(self.timer_counter), callback, args))
+
+    def run_due_timers(self):
+        now = self.clock()
+        while self.timer_heap and self.timer_heap[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timer_heap)
+            callback(*args)
+
+    def get_campaign_result(self):
+        '''
+        汇总所有流程的结果：每个流程各步骤的耗时和结果，按协议和命令统计的步骤耗时，以及各设备的总耗时
+        :return: {"wall_time_ms", "device_time_sum_ms", "slowest_device_ms", "flow_count", "passed", "failed",
+                  "steps": {"protocol/command": {...}}, "flows": [...]}
+        '''
+        flow_result_list = []
+        device_time_dict = {}
+        step_duration_dict = collections.OrderedDict()
+        for flow_run, finish_time in self.finished_run_list:
+            start_ms = (flow_run.start_time - self.start_time) * 1000
+            finish_ms = (finish_time - self.start_time) * 1000
+            flow_result_list.append({"device": flow_run.device_id, "run": flow_run.run_index,
+                                     "status": flow_run.status, "start_ms": round(start_ms, 3),
+                                     "duration_ms": round(finish_ms - start_ms, 3),
+                                     "steps": flow_run.step_result_list})
+            first_start_ms, last_finish_ms = device_time_dict.get(flow_run.device_id, (start_ms, finish_ms))
+            device_time_dict[flow_run.device_id] = (min(first_start_ms, start_ms), max(last_finish_ms, finish_ms))
+            for step_result in flow_run.step_result_list:
+                step_duration_dict.setdefault(step_result["protocol"] + "/" + step_result["command"], []).append(
+                    step_result)
+        step_summary_dict = collections.OrderedDict()
+        for step_name, step_result_list in step_duration_dict.items():
+            duration_list = sorted(step_result["duration_ms"] for step_result in step_result_list
+                                   if step_result["status"] == PASSED_STATUS)
+            status_counter = collections.Counter(step_result["status"] for step_result in step_result_list)
+            step_summary_dict[step_name] = {"count": len(step_result_list), "status": dict(status_counter),
+                                            "mean_ms": round(sum(duration_list) / len(duration_list), 3)
+                                            if duration_list else None,
+                                            "p50_ms": calculate_percentile(duration_list, 0.5),
+                                            "p99_ms": calculate_percentile(duration_list, 0.99),
+                                            "max_ms": duration_list[-1] if duration_list else None}
+        device_time_list = [last_finish_ms - first_start_ms for first_start_ms, last_finish_ms
+                            in device_time_dict.values()]
+        return {"wall_time_ms": round((self.clock() - self.start_time) * 1000, 3),
+                "device_time_sum_ms": round(sum(device_time_list), 3),
+                "slowest_device_ms": round(max(device_time_list), 3) if device_time_list else 0,
+                "flow_count": len(flow_result_list),
+                "passed": sum(1 for flow_result in flow_result_list if flow_result["status"] == PASSED_STATUS),
+                "failed": sum(1 for flow_result in flow_result_list if flow_result["status"] == FAILED_STATUS),
+                "steps": step_summary_dict,
+                "flows": flow_result_list}
+
+
+def format_campaign_result(campaign_result):
+    line_list = ["flows: %d, passed: %d, failed: %d" % (campaign_result["flow_count"], campaign_result["passed"],
+                                                        campaign_result["failed"]),
+                 "wall time: %.3f ms, slowest device: %.3f ms, sum of devices: %.3f ms" % (
+                     campaign_result["wall_time_ms"], campaign_result["slowest_device_ms"],
+                     campaign_result["device_time_sum_ms"]),
+                 "%-40s %8s %8s %10s %10s %10s" % ("step", "count", "passed", "mean_ms", "p50_ms", "p99_ms")]
+    for step_name, step_summary in campaign_result["steps"].items():
+        line_list.append("%-40s %8d %8d %10s %10s %10s" % (
+            step_name, step_summary["count"], step_summary["status"].get(PASSED_STATUS, 0),
+            step_summary["mean_ms"], step_summary["p50_ms"], step_summary["p99_ms"]))
+    return "\n".join(line_list)
+
+
+def parse_rate_limit(rate_limit_text_list):
+    '''
+    解析"协议=每秒命令数"格式的限速参数
+    :return: {protocol: rate}
+    '''
+    protocol_rate_limit_dict = dict(TestFlowEnum.PROTOCOL_RATE_LIMIT.value)
+    for rate_limit_text in rate_limit_text_list:
+        protocol, separator, rate = rate_limit_text.partition("=")
+        if not separator:
+            raise ConfigError("Rate limit must be PROTOCOL=RATE: " + rate_limit_text)
+        protocol_rate_limit_dict[protocol] = float(rate)
+    return protocol_rate_limit_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run command_map test flows on many devices in parallel")
+    parser.add_argument("--start-command", required=True, help="command the flows start from")
+    parser.add_argument("--device", action="append", default=[],
+                        help="device to test, may be given several times; defaults to all devices of the routing table")
+    parser.add_argument("--repeat", type=int, default=1, help="number of flows per device")
+    parser.add_argument("--pipeline-depth", type=int, default=TestFlowEnum.PIPELINE_DEPTH.value)
+    parser.add_argument("--max-concurrent-flows", type=int, default=TestFlowEnum.MAX_CONCURRENT_FLOWS.value)
+    parser.add_argument("--step-timeout", type=float, default=TestFlowEnum.STEP_TIMEOUT.value)
+    parser.add_argument("--rate", action="append", default=[], help="PROTOCOL=COMMANDS_PER_SECOND")
+    parser.add_argument("--output", help="write the full result as json to this file")
+    parser.add_argument("--json", action="store_true", help="print the full result as json")
+    args = parser.parse_args()
+    controller = Controller()
+    threading.Thread(target=controller.start_monitor_channel_message, name="test-flow-controller",
+                     daemon=True).start()
+    time.sleep(TestFlowEnum.STARTUP_DELAY.value)
+    scheduler = TestFlowScheduler(controller, args.max_concurrent_flows, args.pipeline_depth, args.step_timeout,
+                                  parse_rate_limit(args.rate))
+    for device_id in args.device or controller.routing_table.device_id_list:
+        scheduler.add_flows(device_id, args.start_command, args.repeat)
+    campaign_result = scheduler.run_flows()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(campaign_result, output_file, indent=2)
+    print(json.dumps(campaign_result, indent=2) if args.json else format_campaign_result(campaign_result))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
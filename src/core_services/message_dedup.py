@@ -0,0 +1,32 @@
+from common.controller_enum import MessageDedupEnum
+from common.message_codec import MessageCodec
+from util.ttl_cache import TTLCache
+
+
+class MessageDeduplicator:
+    def __init__(self, dedup_by_content=MessageDedupEnum.DEDUP_BY_CONTENT.value):
+        '''
+        在路由之前过滤重复的设备消息：携带message_id的消息按（发送者, message_id）在MESSAGE_ID_TTL内去重，
+        其他消息在开启DEDUP_BY_CONTENT时按（发送者, 内容哈希）在CONTENT_TTL内去重
+        内容去重的有效期从第一次出现起计算，节点持续重复发送的相同命令每CONTENT_TTL至少转发一次
+        :return:
+        '''
+        self.message_id_cache = TTLCache(MessageDedupEnum.MAX_MESSAGE_ID_NUMBER.value,
+                                         MessageDedupEnum.MESSAGE_ID_TTL.value)
+        self.content_cache = TTLCache(MessageDedupEnum.MAX_CONTENT_HASH_NUMBER.value,
+                                      MessageDedupEnum.CONTENT_TTL.value,
+                                      refresh_on_hit=False) if dedup_by_content else None
+
+    def is_duplicate(self, message):
+        '''
+        记录消息并判断是否在有效期内出现过
+        :return:
+        '''
+        message_id = MessageCodec.get_message_id(message)
+        if message_id is not None:
+            return self.message_id_cache.check_and_add(message_id)
+        if self.content_cache is None:
+            return False
+        # str和bytes的哈希值不同，统一按bytes计算，内容相同的str和bytes视为同一条消息
+        content = message.encode() if isinstance(message, str) else bytes(message)
+        return self.content_cache.check_and_add((MessageCodec.get_message_sender(message), hash(content)))
@@ -0,0 +1,328 @@
+import os
+import glob
+import mmap
+import time
+import zlib
+import struct
+import threading
+
+from common.channel_enum import MessageJournalEnum
+from util.logger_manager_ment import Logger
+
+# 记录格式：负载长度、CRC32 | 序号、记录类型 | 负载，CRC覆盖序号、记录类型和负载
+LENGTH_CRC_STRUCT = struct.Struct("<II")
+SEQUENCE_TYPE_STRUCT = struct.Struct("<QB")
+RECORD_HEADER_SIZE = LENGTH_CRC_STRUCT.size + SEQUENCE_TYPE_STRUCT.size
+# 接收记录的负载：消息是否为str、设备ID长度 | 设备ID | 消息
+ACCEPT_PAYLOAD_STRUCT = struct.Struct("<BH")
+ACCEPT_RECORD = 1
+ACK_RECORD = 2
+SEGMENT_FILE_PREFIX = "segment-"
+SEGMENT_FILE_SUFFIX = ".wal"
+
+
+class JournaledBytes(bytes):
+    '''
+    携带日志序号的bytes消息
+    '''
+    journal_sequence = None
+
+
+class JournaledStr(str):
+    '''
+    携带日志序号的str消息
+    '''
+    journal_sequence = None
+
+
+def attach_journal_sequence(message, sequence):
+    '''
+    将日志序号附加到消息上，转发完成后按序号确认
+    :return: message
+    '''
+    # 已经可以携带属性的消息（例如被追踪采样的消息）直接设置
+    if hasattr(message, "__dict__"):
+        message.journal_sequence = sequence
+        return message
+    journaled_message = JournaledStr(message) if isinstance(message, str) else JournaledBytes(message)
+    journaled_message.journal_sequence = sequence
+    return journaled_message
+
+
+def encode_record(record_type, sequence, payload=b""):
+    sequence_type = SEQUENCE_TYPE_STRUCT.pack(sequence, record_type)
+    return LENGTH_CRC_STRUCT.pack(len(payload), zlib.crc32(payload, zlib.crc32(sequence_type))) + \
+        sequence_type + payload
+
+
+def encode_accept_payload(message, device_id):
+    device_id_data = device_id.encode("utf-8")
+    if isinstance(message, str):
+        return ACCEPT_PAYLOAD_STRUCT.pack(1, len(device_id_data)) + device_id_data + message.encode("utf-8")
+    return ACCEPT_PAYLOAD_STRUCT.pack(0, len(device_id_data)) + device_id_data + bytes(message)
+
+
+def decode_accept_payload(payload):
+    '''
+    :return: (message, device_id)
+    '''
+    is_text, device_id_length = ACCEPT_PAYLOAD_STRUCT.unpack_from(payload)
+    message_offset = ACCEPT_PAYLOAD_STRUCT.size + device_id_length
+    device_id = bytes(payload[ACCEPT_PAYLOAD_STRUCT.size:message_offset]).decode("utf-8")
+    message = bytes(payload[message_offset:])
+    return (message.decode("utf-8") if is_text else message), device_id
+
+
+class JournalSegment:
+    def __init__(self, segment_index, file_path):
+        '''
+        单个日志段文件，unacked_count为其中尚未确认的接收记录数量
+        :return:
+        '''
+        self.segment_index = segment_index
+        self.file_path = file_path
+        self.size = 0
+        self.unacked_count = 0
+
+
+class MessageJournal:
+    def __init__(self, journal_dir, segment_size=MessageJournalEnum.SEGMENT_SIZE.value,
+                 group_commit_interval=MessageJournalEnum.GROUP_COMMIT_INTERVAL.value,
+                 group_commit_size=MessageJournalEnum.GROUP_COMMIT_SIZE.value,
+                 compact_interval=MessageJournalEnum.COMPACT_INTERVAL.value,
+                 compact_max_rewrite_entries=MessageJournalEnum.COMPACT_MAX_REWRITE_ENTRIES.value):
+        '''
+        按日志段追加写入的消息预写日志：汇总队列接收的消息写入接收记录，转发完成后写入确认记录
+        追加只在内存中编码记录，由写线程成批写入并fsync一次（组提交）；重启时用mmap读取日志段，重放未确认的消息
+        最旧的日志段中的消息全部确认后删除该日志段，只剩少量未确认的消息时将其改写到当前日志段后删除
+        组提交意味着进程崩溃时最多丢失最近GROUP_COMMIT_INTERVAL内接收的消息，确认记录丢失时消息会被重复转发
+        :return:
+        '''
+        self.journal_dir = journal_dir
+        self.segment_size = segment_size
+        self.group_commit_interval = group_commit_interval
+        self.group_commit_size = group_commit_size
+        self.compact_interval = compact_interval
+        self.compact_max_rewrite_entries = compact_max_rewrite_entries
+        self.logger = Logger("MessageJournal")
+        self.next_sequence = 1
+        # 待写线程写入的记录：[(record_type, sequence, record), ...]
+        self.pending_record_list = []
+        self.condition = threading.Condition()
+        # 以下状态只在打开日志和写线程中修改；日志段按编号升序排列
+        self.segment_dict = {}
+        self.active_segment = None
+        self.active_fd = None
+        # 未确认的序号 -> (日志段, 记录偏移, 记录长度)
+        self.unacked_record_dict = {}
+        self.last_compact_time = time.monotonic()
+        self.sync_file = getattr(os, "fdatasync", os.fsync)
+        self.writer_thread = None
+        self.closed = False
+
+    def open_journal(self):
+        '''
+        读取已有的日志段，新建一个日志段用于追加，并拉起写线程
+        :return: [(message, device_id), ...]，按接收顺序排列的未确认消息，消息已附加日志序号
+        '''
+        os.makedirs(self.journal_dir, exist_ok=True)
+        accept_record_dict = {}
+        acked_sequence_set = set()
+        max_sequence = 0
+        for file_path in sorted(glob.glob(os.path.join(self.journal_dir,
+                                                       SEGMENT_FILE_PREFIX + "*" + SEGMENT_FILE_SUFFIX))):
+            segment_index = int(os.path.basename(file_path)[len(SEGMENT_FILE_PREFIX):-len(SEGMENT_FILE_SUFFIX)])
+            segment = JournalSegment(segment_index, file_path)
+            self.segment_dict[segment_index] = segment
+            max_sequence = max(max_sequence, self.read_segment(segment, accept_record_dict, acked_sequence_set))
+        replay_list = []
+        # 压缩时崩溃会留下同一序号的两条接收记录，以较新的日志段中的为准
+        for sequence in sorted(accept_record_dict):
+            if sequence in acked_sequence_set:
+                continue
+            segment, offset, record_length, message, device_id = accept_record_dict[sequence]
+            segment.unacked_count += 1
+            self.unacked_record_dict[sequence] = (segment, offset, record_length)
+            replay_list.append((attach_journal_sequence(message, sequence), device_id))
+        self.next_sequence = max_sequence + 1
+        self.open_segment(max(self.segment_dict, default=0) + 1)
+        self.writer_thread = threading.Thread(target=self.write_records_forever, name="message-journal", daemon=True)
+        self.writer_thread.start()
+        self.logger.info("message journal opened in " + self.journal_dir + ", " + str(len(replay_list)) +
+                         " unacknowledged messages to replay")
+        return replay_list
+
+    def read_segment(self, segment, accept_record_dict, acked_sequence_set):
+        '''
+        用mmap顺序读取日志段中的记录，遇到写了一半或校验失败的记录时停止
+        :return: 日志段中的最大序号
+        '''
+        segment.size = os.path.getsize(segment.file_path)
+        max_sequence = 0
+        if segment.size == 0:
+            return max_sequence
+        with open(segment.file_path, "rb") as segment_file, \
+                mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment_data:
+            offset = 0
+            while offset + RECORD_HEADER_SIZE <= segment.size:
+                payload_length, crc = LENGTH_CRC_STRUCT.unpack_from(segment_data, offset)
+                record_end = offset + RECORD_HEADER_SIZE + payload_length
+                if record_end > segment.size or \
+                        zlib.crc32(segment_data[offset + LENGTH_CRC_STRUCT.size:record_end]) != crc:
+                    break
+                sequence, record_type = SEQUENCE_TYPE_STRUCT.unpack_from(segment_data, offset + LENGTH_CRC_STRUCT.size)
+                if record_type == ACCEPT_RECORD:
+                    message, device_id = decode_accept_payload(segment_data[offset + RECORD_HEADER_SIZE:record_end])
+                    accept_record_dict[sequence] = (segment, offset, record_end - offset, message, device_id)
+                elif record_type == ACK_RECORD:
+                    acked_sequence_set.add(sequence)
+                max_sequence = max(max_sequence, sequence)
+                offset = record_end
+        if offset < segment.size:
+            self.logger.warning("journal segment " + segment.file_path + " is truncated at " + str(offset))
+        return max_sequence
+
+    def open_segment(self, segment_index):
+        file_path = os.path.join(self.journal_dir, SEGMENT_FILE_PREFIX + "%010d" % segment_index + SEGMENT_FILE_SUFFIX)
+        self.active_fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.active_segment = JournalSegment(segment_index, file_path)
+        self.active_segment.size = os.fstat(self.active_fd).st_size
+        self.segment_dict[segment_index] = self.active_segment
+
+    def append_message(self, message, device_id=""):
+        '''
+        为接收的消息写入接收记录，只在内存中编码，不等待写入磁盘
+        :return: 附加了日志序号的消息
+        '''
+        payload = encode_accept_payload(message, device_id)
+        with self.condition:
+            if self.closed:
+                return message
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self.add_pending_record(ACCEPT_RECORD, sequence, encode_record(ACCEPT_RECORD, sequence, payload))
+        return attach_journal_sequence(message, sequence)
+
+    def acknowledge_message(self, message):
+        '''
+        消息转发完成（或被丢弃）后写入确认记录，没有日志序号的消息直接返回
+        :return:
+        '''
+        sequence = getattr(message, "journal_sequence", None)
+        if sequence is None:
+            return
+        message.journal_sequence = None
+        with self.condition:
+            if not self.closed:
+                self.add_pending_record(ACK_RECORD, sequence, encode_record(ACK_RECORD, sequence))
+
+    def add_pending_record(self, record_type, sequence, record):
+        self.pending_record_list.append((record_type, sequence, record))
+        # 只在写线程可能正在等待时唤醒
+        if len(self.pending_record_list) == 1 or len(self.pending_record_list) == self.group_commit_size:
+            self.condition.notify()
+
+    def write_records_forever(self):
+        '''
+        写线程：每次取出所有待写入的记录，一次写入并fsync；空闲时定期压缩旧日志段
+        :return:
+        '''
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending_record_list or self.closed, self.compact_interval)
+                if self.pending_record_list and len(self.pending_record_list) < self.group_commit_size:
+                    self.condition.wait_for(lambda: len(self.pending_record_list) >= self.group_commit_size or
+                                            self.closed, self.group_commit_interval)
+                record_list, self.pending_record_list = self.pending_record_list, []
+                closed = self.closed
+            try:
+                if record_list:
+                    self.write_records(record_list)
+                if time.monotonic() - self.last_compact_time >= self.compact_interval:
+                    self.compact_segments(True)
+                elif len(self.segment_dict) > 1:
+                    self.compact_segments(False)
+            except OSError as e:
+                self.logger.error("write message journal failed for " + str(e))
+            if closed and not record_list:
+                os.close(self.active_fd)
+                return
+
+    def write_records(self, record_list):
+        '''
+        将记录追加到当前日志段并fsync，当前日志段写满时先写入已有的部分再新建日志段
+        :return:
+        '''
+        data_list = []
+        for record_type, sequence, record in record_list:
+            if self.active_segment.size >= self.segment_size:
+                self.flush_data(data_list)
+                data_list = []
+                os.close(self.active_fd)
+                self.open_segment(self.active_segment.segment_index + 1)
+            if record_type == ACCEPT_RECORD:
+                # 压缩时改写的记录会从旧日志段移到当前日志段
+                self.release_sequence(sequence)
+                self.unacked_record_dict[sequence] = (self.active_segment, self.active_segment.size, len(record))
+                self.active_segment.unacked_count += 1
+            else:
+                self.release_sequence(sequence)
+            data_list.append(record)
+            self.active_segment.size += len(record)
+        self.flush_data(data_list)
+
+    def flush_data(self, data_list):
+        if not data_list:
+            return
+        data = memoryview(b"".join(data_list))
+        while data:
+            data = data[os.write(self.active_fd, data):]
+        self.sync_file(self.active_fd)
+
+    def release_sequence(self, sequence):
+        unacked_record = self.unacked_record_dict.pop(sequence, None)
+        if unacked_record is not None:
+            unacked_record[0].unacked_count -= 1
+
+    def compact_segments(self, rewrite_unacked):
+        '''
+        从最旧的日志段开始删除：全部确认的直接删除；rewrite_unacked时未确认的消息不多的日志段先改写到当前日志段
+        改写只按COMPACT_INTERVAL定期进行，刚写满的日志段中大多是正在转发的消息，很快就会被确认
+        必须按顺序删除，否则较旧日志段中已确认的消息会因为确认记录被删除而在重启后重放
+        :return:
+        '''
+        if rewrite_unacked:
+            self.last_compact_time = time.monotonic()
+        for segment in list(self.segment_dict.values()):
+            if segment is self.active_segment or \
+                    segment.unacked_count > (self.compact_max_rewrite_entries if rewrite_unacked else 0):
+                return
+            if segment.unacked_count:
+                self.rewrite_segment(segment)
+            os.remove(segment.file_path)
+            del self.segment_dict[segment.segment_index]
+
+    def rewrite_segment(self, segment):
+        record_list = []
+        with open(segment.file_path, "rb") as segment_file, \
+                mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment_data:
+            for sequence, (record_segment, offset, record_length) in sorted(self.unacked_record_dict.items()):
+                if record_segment is segment:
+                    record_list.append((ACCEPT_RECORD, sequence, segment_data[offset:offset + record_length]))
+        self.write_records(record_list)
+        self.logger.info("rewrote " + str(len(record_list)) + " unacknowledged messages from " + segment.file_path)
+
+    def get_journal_stats(self):
+        return {"segments": len(self.segment_dict), "unacknowledged": len(self.unacked_record_dict),
+                "pending": len(self.pending_record_list), "next_sequence": self.next_sequence}
+
+    def close_journal(self):
+        '''
+        写入剩余的记录后停止写线程
+        :return:
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
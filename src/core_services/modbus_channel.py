@@ -1,29 +1,43 @@
-import os
-import re
 import queue
-import serial
+import concurrent.futures
 
+from common.channel_enum import MessageQueueEnum
+from common.exception import CommonError
+from common.message_codec import MessageCodec
 from common.modbus_enum import ModbusSerialEnum
+from common.modbus_enum import SerialPortEnum
+from core_services.controller_metrics import MESSAGES_RECEIVED
+from core_services.controller_metrics import MESSAGES_SENT
+from core_services.device_presence import DevicePresenceService
+from core_services.serial_frame_parser import SerialFrameParser
+from core_services.serial_port_manager import SerialPort
 from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
 
 
 class ModBusChannel:
+    # 设备ID与串口位置的对应关系，所有ModBusChannel实例共用
+    serial_file_location_dict = {"A": "/dev/ttyUSB0"}
+    # 设备ID与开发板序列号的对应关系，用于通过hdc判断设备是否在线
+    device_sn_dict = {}
+
     def __init__(self):
         '''
         Modbus协议交互是通过串口工具将开发板的串口接口连接到PCB的串口专用USB接口上
         :return:
         '''
-        self.serial_file_location_dict = {"A": "/dev/ttyUSB0"}
         self.logger = Logger("ModbusController")
-        self.modbus_message_queue = queue.Queue()
+        self.modbus_message_queue = queue.Queue(maxsize=MessageQueueEnum.CHANNEL_QUEUE_SIZE.value)
+        self.message_codec = MessageCodec.get_default_codec()
 
     def device_connection_status(self, device_sn_code):
         '''
-        通过hdc查找设备是否已连接
+        查询开发板是否已连接，结果来自设备在线状态服务的缓存，不再每次执行hdc
         :return:
         '''
-        device_info = str(os.popen(r"hdc_std list targets"))
-        if re.search(device_sn_code, device_info):
+        if DevicePresenceService.get_default_service().is_serial_number_online(device_sn_code):
             self.logger.info("Device connected !")
             return True
         else:
@@ -40,33 +54,35 @@ class ModBusChannel:
 
     def send_message_to_device_through_serial(self, command, receiver_device_id):
         '''
-        对指定串口发送消息
+        对指定串口发送消息，消息交给串口的写线程合并写入，等待写入完成
         :return:
         '''
         serial_file_location = self.get_serial_file_location_by_device_id(receiver_device_id)
-        ser = serial.Serial(port=serial_file_location, baudrate=ModbusSerialEnum.BAND_RATE_ENUM.value,
-                            timeout=ModbusSerialEnum.SERIAL_TIMEOUT_ENUM.value)
-        message = f"command: {command}\r\nprotocol: Modbus\r\nreceiver: {receiver_device_id}"
-        ser.write(message.encode())
-        self.logger.info("send message:" + message + " to device")
-        ser.close()
+        message = self.message_codec.encode_message(command, "Modbus", receiver_device_id)
+        # 文本消息没有长度信息，需要追加分隔符，接收端才能切分出完整的帧
+        write_future = SerialPort.get_serial_port(serial_file_location).write_frame(
+            message.encode() + ModbusSerialEnum.TEXT_FRAME_DELIMITER.value if isinstance(message, str) else message)
+        try:
+            write_future.result(SerialPortEnum.WRITE_TIMEOUT.value)
+        except concurrent.futures.TimeoutError:
+            raise CommonError("write message to " + serial_file_location + " timeout")
+        MESSAGES_SENT.labels("Modbus", receiver_device_id).inc()
+        self.logger.info("send message:" + str(message) + " to device")
 
     def receive_message_from_device_through_serial(self, device_id):
         '''
-        从指定串口接收消息
+        从指定串口接收消息，每收到一个完整的帧就立即放入队列
         :return:
         '''
-        serial_file_location = self.get_serial_file_location_by_device_id(device_id)
-        ser = serial.Serial(port=serial_file_location, baudrate=ModbusSerialEnum.BAND_RATE_ENUM.value,
-                            timeout=ModbusSerialEnum.SERIAL_TIMEOUT_ENUM.value)
+        serial_port = SerialPort.get_serial_port(self.get_serial_file_location_by_device_id(device_id))
+        frame_parser = SerialFrameParser()
+        received_counter = MESSAGES_RECEIVED.labels("Modbus", device_id)
         self.logger.info("modbus monitor start!")
         while True:
-            try:
-                message = str(ser.readlines())
-                self.modbus_message_queue.put(message)
-                self.logger.info("modbus_message_queue newly adds: " + message)
-            except serial.SerialException:
-                self.logger.error("The serial to device: " + device_id + "is abnormal!")
+            for message in serial_port.read_frames(frame_parser):
+                self.modbus_message_queue.put(MESSAGE_TRACER.start_trace(message, "Modbus", device_id))
+                received_counter.inc()
+                self.logger.info("modbus_message_queue newly adds: " + str(message))
 
 
 if __name__ == "__main__":
@@ -1,74 +1,151 @@
 import queue
+import functools
 import paho.mqtt.client as mqtt
 
+from common.channel_enum import MessageQueueEnum
+from common.exception import CommonError
+from common.message_codec import MessageCodec
 from common.mqtt_enum import CommonEnum
+from common.mqtt_enum import MQTTPublisherEnum
 from common.mqtt_enum import MQTTReturnCode
 from common.mqtt_enum import MQTTServerEnum
+from common.mqtt_enum import MQTTSubscriberEnum
+from common.mqtt_enum import MQTTTopicEnum
+from core_services.controller_metrics import MESSAGES_RECEIVED
+from core_services.controller_metrics import MESSAGES_SENT
+from core_services.controller_metrics import record_connection
+from core_services.mqtt_publisher import MQTTPublisher
+from core_services.mqtt_subscriber import TopicDeviceMatcher
+from core_services.mqtt_subscriber import get_downlink_topic
 from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
 
 
 class MQTTChannel:
-    def __init__(self, host, port):
+    def __init__(self, host, port, persistent_publisher=MQTTPublisherEnum.PERSISTENT_PUBLISHER.value):
         '''
         与MQTT服务器交互的channel，主机可执行的包括发布者的操作、订阅者的操作
+        persistent_publisher为True时发布消息使用每个服务器共享的持久化发布者会话
         :return:
         '''
         self.host = host
         self.port = port
+        self.persistent_publisher = persistent_publisher
         self.client = mqtt.Client()
         self.client.on_connect = self.subscriber_connect_to_mqtt_server_status
         self.client.on_message = self.subscriber_receive_message_from_mqtt_server
         self.logger = Logger("MQTTChannel")
-        self.mqtt_message_queue = queue.Queue()
+        self.mqtt_message_queue = queue.Queue(maxsize=MessageQueueEnum.CHANNEL_QUEUE_SIZE.value)
+        self.message_codec = MessageCodec.get_default_codec()
+        self.publisher_loop_started = False
+        self.connected_count = 0
+        # 订阅的topic，连接或重连成功后订阅
+        self.subscribed_topic_list = []
+        self.topic_device_matcher = TopicDeviceMatcher()
 
     def subscriber_connect_to_mqtt_server_status(self,  client, userdata, flags, rc):
         '''
         查询连接状态，判断是否是否能正常连接服务器
         :return:
         '''
-        topic = "test"
         if str(rc) == MQTTReturnCode.CONNECTION_SUCCESS.value:
-            self.client.subscribe(topic)
+            record_connection("MQTT", self.host + ":" + str(self.port), self.connected_count > 0)
+            self.connected_count += 1
+            if self.subscribed_topic_list:
+                self.client.subscribe([(topic, 0) for topic in self.subscribed_topic_list])
         else:
             self.logger.error("Connection rejected, Connected with result code " + str(rc))
 
     def subscriber_receive_message_from_mqtt_server(self, client, userdata, msg):
         '''
-        获取订阅获得的信息
+        获取订阅获得的信息，设备ID取自上行topic
         :return: msg
         '''
-        self.mqtt_message_queue.put(str(msg.payload))
+        device_id = self.topic_device_matcher.get_device_id(msg.topic) or msg.topic
+        self.mqtt_message_queue.put(MESSAGE_TRACER.start_trace(msg.payload, "MQTT", device_id))
+        MESSAGES_RECEIVED.labels("MQTT", device_id).inc()
         self.logger.info("mqtt_message_queue newly adds: " + str(msg.payload))
         return msg
 
-    def subscriber_connect_to_mqtt_server(self, topic):
+    def subscriber_connect_to_mqtt_server(self, device_id):
         '''
-        订阅者连接到服务器
+        订阅者连接到服务器，只订阅单个设备的上行topic；控制器使用所有设备共用的MQTTSubscriber
+        断开后由paho按退避间隔重连，首次连接失败或网络循环异常时抛出，由调用方决定何时重试
         :return: msg
         '''
+        self.subscribed_topic_list = [topic_template.replace(MQTTTopicEnum.DEVICE_ID_PLACEHOLDER.value, device_id)
+                                      for topic_template in MQTTTopicEnum.UPLINK_TOPIC_TEMPLATES.value]
         self.client.username_pw_set(MQTTServerEnum.MQTT_SERVER_USERNAME.value, MQTTServerEnum.MQTT_SERVER_PASSWORD.value)
+        self.client.reconnect_delay_set(MQTTSubscriberEnum.RECONNECT_MIN_DELAY.value,
+                                        MQTTSubscriberEnum.RECONNECT_MAX_DELAY.value)
         self.client.connect(self.host, self.port, CommonEnum.MQTT_TIMEOUT_ENUM.value)
-        self.client.subscribe(topic)
-        self.logger.info("subscriber topic: " + topic)
-        while True:
-            try:
-                self.client.loop_forever()
-            except Exception as e:
-                self.logger.error("An error occurred when connected to the mqtt server: " + str(e))
+        self.logger.info("subscriber topic: " + ",".join(self.subscribed_topic_list))
+        self.client.loop_forever()
 
-    def publish_message_to_mqtt_server(self, command, receiver_device_id):
+    def publisher_connect_to_mqtt_server(self):
         '''
-        发布者向MQTT服务器发布消息
+        发布者连接到服务器，连接建立后保持网络循环运行以便复用
         :return:
         '''
+        if self.publisher_loop_started:
+            return
         self.client.username_pw_set(MQTTServerEnum.MQTT_SERVER_USERNAME.value, MQTTServerEnum.MQTT_SERVER_PASSWORD.value)
         self.client.connect(self.host, self.port, CommonEnum.MQTT_TIMEOUT_ENUM.value)
         self.client.loop_start()
-        topic = receiver_device_id
-        message = f"command: {command}\r\nprotocol: MQTT\r\nreceiver: {receiver_device_id}"
+        self.publisher_loop_started = True
+
+    def publish_message_to_mqtt_server(self, command, receiver_device_id):
+        '''
+        发布者向MQTT服务器发布消息，连接只在首次发布或断开后建立
+        持久化发布者模式下不等待服务器确认，多条消息同时在途并攒批发送；入队失败时抛出CommonError
+        :return: 持久化发布者模式下返回future，服务器确认后结果为消息的mid
+        '''
+        topic = get_downlink_topic(receiver_device_id)
+        message = self.message_codec.encode_message(command, "MQTT", receiver_device_id)
+        if self.persistent_publisher:
+            future = MQTTPublisher.get_publisher(self.host, self.port).publish(topic, message)
+            # 待发送队列满时future在入队时就已失败，直接抛出，调用方可以立即感知
+            if future.done() and future.exception() is not None:
+                raise CommonError("publish to " + topic + " failed for " + str(future.exception()))
+            future.add_done_callback(functools.partial(self.record_publish_result, topic, receiver_device_id))
+            return future
+        MESSAGES_SENT.labels("MQTT", receiver_device_id).inc()
+        self.publisher_connect_to_mqtt_server()
         self.client.publish(topic, message)
-        self.client.loop_stop()
+
+    def record_publish_result(self, topic, receiver_device_id, future):
+        '''
+        持久化发布者的消息得到确认或失败时回调，在发布者的线程中执行
+        :return:
+        '''
+        if not future.cancelled() and future.exception() is None:
+            MESSAGES_SENT.labels("MQTT", receiver_device_id).inc()
+            return
+        self.logger.error("publish to " + topic + " failed for " +
+                          ("cancelled" if future.cancelled() else str(future.exception())))
+
+    def check_channel_health(self):
+        '''
+        连接池健康检查，未建立过连接的channel视为健康
+        持久化发布者由paho网络线程自动重连，不需要重建channel
+        :return:
+        '''
+        if self.persistent_publisher:
+            return True
+        return not self.publisher_loop_started or self.client.is_connected()
+
+    def close_channel(self):
+        '''
+        停止网络循环并断开与服务器的连接
+        :return:
+        '''
+        if not self.publisher_loop_started:
+            return
         self.client.disconnect()
+        self.client.loop_stop()
+        self.publisher_loop_started = False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import time
+import queue
+import threading
+import concurrent.futures
+import paho.mqtt.client as mqtt
+
+from common.exception import CommonError
+from common.mqtt_enum import CommonEnum
+from common.mqtt_enum import MQTTPublisherEnum
+from common.mqtt_enum import MQTTReturnCode
+from common.mqtt_enum import MQTTServerEnum
+from core_services.controller_metrics import record_connection
+from util.logger_manager_ment import Logger
+
+
+class MQTTPublishRequest:
+    def __init__(self, topic, payload, qos):
+        '''
+        待发布的单条消息，future在服务器确认后完成
+        :return:
+        '''
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.future = concurrent.futures.Future()
+
+
+class MQTTPublisher:
+    # 每个服务器只保留一个持久化发布者，key为(host, port, username)
+    publisher_dict = {}
+    publisher_dict_lock = threading.Lock()
+
+    def __init__(self, host, port, username=MQTTServerEnum.MQTT_SERVER_USERNAME.value,
+                 password=MQTTServerEnum.MQTT_SERVER_PASSWORD.value,
+                 qos=MQTTPublisherEnum.PUBLISH_QOS.value,
+                 max_inflight_messages=MQTTPublisherEnum.MAX_INFLIGHT_MESSAGES.value,
+                 linger_time=MQTTPublisherEnum.LINGER_TIME.value,
+                 max_batch_size=MQTTPublisherEnum.MAX_BATCH_SIZE.value,
+                 max_pending_messages=MQTTPublisherEnum.MAX_PENDING_MESSAGES.value):
+        '''
+        持久化的MQTT发布者会话，保持一个已认证的连接，消息先入队再由后台线程攒批发布
+        每条消息返回一个future，QoS>0时在收到服务器确认后完成，QoS=0时在消息写出后完成
+        :return:
+        '''
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.linger_time = linger_time
+        self.max_batch_size = max_batch_size
+        self.logger = Logger("MQTTPublisher")
+        self.client = mqtt.Client()
+        self.client.username_pw_set(username, password)
+        self.client.max_inflight_messages_set(max_inflight_messages)
+        self.client.on_connect = self.publisher_connect_to_mqtt_server_status
+        self.client.on_disconnect = self.publisher_disconnect_from_mqtt_server
+        self.client.on_publish = self.publisher_receive_publish_ack
+        self.pending_queue = queue.Queue(maxsize=max_pending_messages)
+        # 已发出等待确认的消息，key为mid
+        self.inflight_request_dict = {}
+        # on_publish可能先于inflight_request_dict登记触发，先记录下来
+        self.early_acked_mid_set = set()
+        self.inflight_semaphore = threading.BoundedSemaphore(max_inflight_messages)
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        self.connected_count = 0
+
+    @classmethod
+    def get_publisher(cls, host, port, username=MQTTServerEnum.MQTT_SERVER_USERNAME.value,
+                      password=MQTTServerEnum.MQTT_SERVER_PASSWORD.value):
+        '''
+        获取指定服务器的持久化发布者，不存在时创建并启动
+        :return: publisher
+        '''
+        publisher_key = (host, port, username)
+        with cls.publisher_dict_lock:
+            publisher = cls.publisher_dict.get(publisher_key)
+            if publisher is None:
+                publisher = cls(host, port, username, password)
+                publisher.start_publisher()
+                cls.publisher_dict[publisher_key] = publisher
+            return publisher
+
+    @classmethod
+    def close_all_publishers(cls):
+        '''
+        关闭所有持久化发布者
+        :return:
+        '''
+        with cls.publisher_dict_lock:
+            publisher_list = list(cls.publisher_dict.values())
+            cls.publisher_dict.clear()
+        for publisher in publisher_list:
+            publisher.close_publisher()
+
+    def start_publisher(self):
+        '''
+        连接服务器并拉起网络循环和攒批发送线程
+        :return:
+        '''
+        self.client.connect_async(self.host, self.port, CommonEnum.MQTT_TIMEOUT_ENUM.value)
+        self.client.loop_start()
+        self.stop_event.clear()
+        self.flush_thread = threading.Thread(target=self.flush_pending_messages, name="mqtt-publisher", daemon=True)
+        self.flush_thread.start()
+
+    def close_publisher(self, timeout=MQTTPublisherEnum.CLOSE_TIMEOUT.value):
+        '''
+        等待队列中的消息发送完成后断开连接
+        :return:
+        '''
+        deadline = time.monotonic() + timeout
+        while (not self.pending_queue.empty() or self.inflight_request_dict) and time.monotonic() < deadline:
+            time.sleep(MQTTPublisherEnum.CLOSE_POLL_INTERVAL.value)
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join(timeout=max(deadline - time.monotonic(), 0))
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.fail_inflight_requests(CommonError("MQTT publisher closed"))
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def publish(self, topic, payload, qos=None):
+        '''
+        将消息加入待发送队列，队列满时最多等待ENQUEUE_TIMEOUT
+        :return: future，结果为消息的mid，入队或发布失败时为异常
+        '''
+        if self.stop_event.is_set():
+            raise CommonError("MQTT publisher to " + self.host + " is closed")
+        publish_request = MQTTPublishRequest(topic, payload, self.qos if qos is None else qos)
+        try:
+            self.pending_queue.put(publish_request, timeout=MQTTPublisherEnum.ENQUEUE_TIMEOUT.value)
+        except queue.Full:
+            publish_request.future.set_exception(
+                CommonError("MQTT publisher to " + self.host + " has too many pending messages"))
+        return publish_request.future
+
+    def flush_pending_messages(self):
+        '''
+        后台线程：收到第一条消息后最多等待linger_time，将期间入队的消息作为一个批次连续发出
+        linger_time为0时不等待，只把队列中已有的消息一起发出
+        :return:
+        '''
+        while not self.stop_event.is_set():
+            try:
+                publish_request = self.pending_queue.get(timeout=CommonEnum.MQTT_TIMEOUT_ENUM.value)
+            except queue.Empty:
+                continue
+            batch = [publish_request]
+            deadline = time.monotonic() + self.linger_time
+            while len(batch) < self.max_batch_size:
+                remaining_time = deadline - time.monotonic()
+                try:
+                    # 等待时间到后仍把队列中已有的消息一起发出
+                    batch.append(self.pending_queue.get(timeout=remaining_time) if remaining_time > 0
+                                 else self.pending_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.publish_batch(batch)
+
+    def publish_batch(self, batch):
+        '''
+        连续发布一个批次的消息，不等待前一条的确认，同时在途的消息数量受max_inflight限制
+        :return:
+        '''
+        for index, publish_request in enumerate(batch):
+            # 服务器断开期间在途的消息得不到确认，不能一直等待空位，否则发送线程和待发送队列都会阻塞
+            if not self.inflight_semaphore.acquire(timeout=MQTTPublisherEnum.INFLIGHT_TIMEOUT.value):
+                error = CommonError("MQTT publisher to " + self.host + " has no free inflight slot")
+                for failed_request in batch[index:]:
+                    failed_request.future.set_exception(error)
+                break
+            # paho在持有内部锁时调用on_publish，而on_publish需要self.lock，因此publish不能在self.lock内调用
+            try:
+                message_info = self.client.publish(publish_request.topic, publish_request.payload,
+                                                   publish_request.qos)
+            except Exception as e:
+                self.inflight_semaphore.release()
+                publish_request.future.set_exception(e)
+                continue
+            # QoS>0时断连期间的消息由paho保存并在重连后重发，QoS=0的消息会直接丢失
+            if message_info.rc != mqtt.MQTT_ERR_SUCCESS and (publish_request.qos == 0 or
+                                                              message_info.rc != mqtt.MQTT_ERR_NO_CONN):
+                self.inflight_semaphore.release()
+                publish_request.future.set_exception(
+                    CommonError("publish to " + publish_request.topic + " failed: " +
+                                mqtt.error_string(message_info.rc), message_info.rc))
+                continue
+            with self.lock:
+                if message_info.mid in self.early_acked_mid_set:
+                    self.early_acked_mid_set.discard(message_info.mid)
+                    self.inflight_semaphore.release()
+                    publish_request.future.set_result(message_info.mid)
+                else:
+                    self.inflight_request_dict[message_info.mid] = publish_request
+        self.logger.debug("mqtt publisher flushed " + str(len(batch)) + " messages")
+
+    def publisher_receive_publish_ack(self, client, userdata, mid):
+        '''
+        paho回调：消息已被服务器确认（QoS=0时为已写出）
+        :return:
+        '''
+        with self.lock:
+            publish_request = self.inflight_request_dict.pop(mid, None)
+            if publish_request is None:
+                self.early_acked_mid_set.add(mid)
+                return
+        self.inflight_semaphore.release()
+        publish_request.future.set_result(mid)
+
+    def publisher_connect_to_mqtt_server_status(self, client, userdata, flags, rc):
+        '''
+        paho回调：查询连接状态
+        :return:
+        '''
+        if str(rc) == MQTTReturnCode.CONNECTION_SUCCESS.value:
+            self.logger.info("mqtt publisher connected to " + self.host + ":" + str(self.port))
+            record_connection("MQTT", self.host + ":" + str(self.port), self.connected_count > 0)
+            self.connected_count += 1
+        else:
+            self.logger.error("Publisher connection rejected, Connected with result code " + str(rc))
+
+    def publisher_disconnect_from_mqtt_server(self, client, userdata, rc):
+        '''
+        paho回调：连接断开，非主动断开时由loop_start的网络线程自动重连
+        :return:
+        '''
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self.logger.warning("mqtt publisher disconnected with result code " + str(rc) + ", reconnecting")
+
+    def fail_inflight_requests(self, error):
+        '''
+        将所有未确认的消息标记为失败
+        :return:
+        '''
+        with self.lock:
+            publish_request_list = list(self.inflight_request_dict.values())
+            self.inflight_request_dict.clear()
+        while True:
+            try:
+                publish_request_list.append(self.pending_queue.get_nowait())
+            except queue.Empty:
+                break
+        for publish_request in publish_request_list:
+            if not publish_request.future.done():
+                publish_request.future.set_exception(error)
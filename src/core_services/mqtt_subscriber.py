@@ -0,0 +1,202 @@
+import threading
+import collections
+import paho.mqtt.client as mqtt
+
+from common.mqtt_enum import CommonEnum
+from common.mqtt_enum import MQTTReturnCode
+from common.mqtt_enum import MQTTServerEnum
+from common.mqtt_enum import MQTTSubscriberEnum
+from common.mqtt_enum import MQTTTopicEnum
+from core_services.controller_metrics import MESSAGES_RECEIVED
+from core_services.controller_metrics import record_connection
+from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+
+DEVICE_ID_PLACEHOLDER = MQTTTopicEnum.DEVICE_ID_PLACEHOLDER.value
+SHARE_SUBSCRIPTION_PREFIX = MQTTTopicEnum.SHARE_SUBSCRIPTION_PREFIX.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
+
+
+def get_uplink_topic_filters(topic_template_list=MQTTTopicEnum.UPLINK_TOPIC_TEMPLATES.value, share_group=None,
+                             device_id_list=None):
+    '''
+    上行topic模板对应的通配符订阅，例如devices/{device_id}/up对应devices/+/up
+    指定share_group时使用共享订阅$share/{share_group}/devices/+/up，同组的订阅者之间每条消息只投递给其中一个
+    指定device_id_list时只订阅这些设备的上行topic，例如分片工作进程只订阅本分片的设备
+    :return: [topic_filter, ...]
+    '''
+    prefix = "" if not share_group else SHARE_SUBSCRIPTION_PREFIX + share_group + "/"
+    if device_id_list is None:
+        return [prefix + topic_template.replace(DEVICE_ID_PLACEHOLDER, "+") for topic_template in topic_template_list]
+    return [prefix + topic_template.replace(DEVICE_ID_PLACEHOLDER, device_id)
+            for topic_template in topic_template_list for device_id in device_id_list]
+
+
+def get_uplink_topic(device_id, topic_template=MQTTTopicEnum.UPLINK_TOPIC_TEMPLATES.value[0]):
+    return topic_template.replace(DEVICE_ID_PLACEHOLDER, device_id)
+
+
+def get_downlink_topic(device_id):
+    return MQTTTopicEnum.DOWNLINK_TOPIC_TEMPLATE.value.replace(DEVICE_ID_PLACEHOLDER, device_id)
+
+
+class TopicDeviceMatcher:
+    def __init__(self, topic_template_list=MQTTTopicEnum.UPLINK_TOPIC_TEMPLATES.value):
+        '''
+        从上行topic中取出设备ID，topic按层级与各模板逐层比较
+        :return:
+        '''
+        # [(层级数, 设备ID所在层级, [(层级, 固定值), ...]), ...]
+        self.pattern_list = []
+        for topic_template in topic_template_list:
+            level_list = topic_template.split("/")
+            self.pattern_list.append((len(level_list), level_list.index(DEVICE_ID_PLACEHOLDER),
+                                      [(index, level) for index, level in enumerate(level_list)
+                                       if level != DEVICE_ID_PLACEHOLDER]))
+
+    def get_device_id(self, topic):
+        '''
+        :return: 设备ID，topic不匹配任何模板时返回None
+        '''
+        level_list = topic.split("/")
+        for level_number, device_id_index, fixed_level_list in self.pattern_list:
+            if len(level_list) == level_number and \
+                    all(level_list[index] == level for index, level in fixed_level_list):
+                return level_list[device_id_index]
+        return None
+
+
+class MQTTSubscriber:
+    # 每个服务器只保留一个共享订阅者，key为(host, port, username, share_group, device_id_list)
+    subscriber_dict = {}
+    subscriber_dict_lock = threading.Lock()
+
+    def __init__(self, host, port, username=MQTTServerEnum.MQTT_SERVER_USERNAME.value,
+                 password=MQTTServerEnum.MQTT_SERVER_PASSWORD.value,
+                 topic_template_list=MQTTTopicEnum.UPLINK_TOPIC_TEMPLATES.value,
+                 qos=MQTTSubscriberEnum.SUBSCRIBE_QOS.value,
+                 max_pending_messages=MQTTSubscriberEnum.MAX_PENDING_MESSAGES.value, share_group=None,
+                 device_id_list=None):
+        '''
+        所有设备共用的MQTT订阅者：每个设备分组一个通配符订阅，收到的消息按topic中的设备ID分发
+        消息先缓存在内存中，由控制器按批取走，连接数与设备数量无关
+        多个控制器节点使用同一share_group时以共享订阅分摊上行消息，避免每条消息被每个节点重复处理
+        指定device_id_list时只订阅并接收这些设备的消息，其他设备的消息由其他进程处理
+        :return:
+        '''
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.max_pending_messages = max_pending_messages
+        self.topic_filter_list = get_uplink_topic_filters(topic_template_list, share_group, device_id_list)
+        self.device_id_set = None if device_id_list is None else frozenset(device_id_list)
+        self.topic_device_matcher = TopicDeviceMatcher(topic_template_list)
+        self.logger = Logger("MQTTSubscriber")
+        self.client = mqtt.Client()
+        self.client.username_pw_set(username, password)
+        self.client.reconnect_delay_set(MQTTSubscriberEnum.RECONNECT_MIN_DELAY.value,
+                                        MQTTSubscriberEnum.RECONNECT_MAX_DELAY.value)
+        self.client.on_connect = self.subscriber_connect_to_mqtt_server_status
+        self.client.on_message = self.subscriber_receive_message_from_mqtt_server
+        # 待取走的消息：(device_id, message)
+        self.pending_message_deque = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped_count = 0
+        self.connected_count = 0
+        self.started = False
+
+    @classmethod
+    def get_subscriber(cls, host, port, username=MQTTServerEnum.MQTT_SERVER_USERNAME.value,
+                       password=MQTTServerEnum.MQTT_SERVER_PASSWORD.value, share_group=None, device_id_list=None):
+        '''
+        获取指定服务器的共享订阅者，不存在时创建并启动
+        :return: subscriber
+        '''
+        subscriber_key = (host, port, username, share_group,
+                          None if device_id_list is None else tuple(sorted(device_id_list)))
+        with cls.subscriber_dict_lock:
+            subscriber = cls.subscriber_dict.get(subscriber_key)
+            if subscriber is None:
+                subscriber = cls(host, port, username, password, share_group=share_group,
+                                 device_id_list=device_id_list)
+                subscriber.start_subscriber()
+                cls.subscriber_dict[subscriber_key] = subscriber
+            return subscriber
+
+    @classmethod
+    def close_all_subscribers(cls):
+        with cls.subscriber_dict_lock:
+            subscriber_list = list(cls.subscriber_dict.values())
+            cls.subscriber_dict.clear()
+        for subscriber in subscriber_list:
+            subscriber.close_subscriber()
+
+    def start_subscriber(self):
+        '''
+        连接服务器并拉起网络循环，断开后由paho按退避间隔自动重连
+        :return:
+        '''
+        if self.started:
+            return
+        self.client.connect_async(self.host, self.port, CommonEnum.MQTT_TIMEOUT_ENUM.value)
+        self.client.loop_start()
+        self.started = True
+
+    def subscriber_connect_to_mqtt_server_status(self, client, userdata, flags, rc):
+        '''
+        连接成功后订阅所有设备分组的通配符topic，重连后也会重新订阅
+        :return:
+        '''
+        if str(rc) != MQTTReturnCode.CONNECTION_SUCCESS.value:
+            self.logger.error("Connection rejected, Connected with result code " + str(rc))
+            return
+        record_connection("MQTT", self.host + ":" + str(self.port), self.connected_count > 0)
+        self.connected_count += 1
+        client.subscribe([(topic_filter, self.qos) for topic_filter in self.topic_filter_list])
+        self.logger.info("subscriber topics: " + ",".join(self.topic_filter_list))
+
+    def subscriber_receive_message_from_mqtt_server(self, client, userdata, msg):
+        '''
+        按topic取出设备ID后缓存消息，在paho网络线程中执行，不能阻塞
+        :return:
+        '''
+        device_id = self.topic_device_matcher.get_device_id(msg.topic)
+        if device_id is None:
+            self.logger.error("unexpected mqtt topic: " + msg.topic)
+            return
+        # 服务器可能因为重叠的订阅投递其他设备的消息，不属于本订阅者的设备不处理
+        if self.device_id_set is not None and device_id not in self.device_id_set:
+            return
+        message = MESSAGE_TRACER.start_trace(msg.payload, "MQTT", device_id)
+        with self.condition:
+            if len(self.pending_message_deque) >= self.max_pending_messages:
+                self.dropped_count += 1
+                if self.dropped_count % 1000 == 1:
+                    self.logger.warning("mqtt subscriber to " + self.host + " is full, dropped " +
+                                        str(self.dropped_count) + " messages")
+                return
+            self.pending_message_deque.append((device_id, message))
+            if len(self.pending_message_deque) == 1:
+                self.condition.notify()
+        MESSAGES_RECEIVED.labels("MQTT", device_id).inc()
+
+    def drain_messages(self, max_batch_size=MQTTSubscriberEnum.MAX_BATCH_SIZE.value,
+                       timeout=MQTTSubscriberEnum.DRAIN_TIMEOUT.value):
+        '''
+        取走一批消息，没有消息时最多等待timeout
+        :return: [(device_id, message), ...]
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending_message_deque, timeout):
+                return []
+            pending_message_deque = self.pending_message_deque
+            return [pending_message_deque.popleft()
+                    for _ in range(min(max_batch_size, len(pending_message_deque)))]
+
+    def qsize(self):
+        return len(self.pending_message_deque)
+
+    def close_subscriber(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.started = False
@@ -0,0 +1,159 @@
+import os
+import json
+import threading
+import collections
+
+from common.controller_enum import RoutingTableEnum
+from common.exception import ConfigError
+from util.logger_manager_ment import Logger
+
+# receiver为None时转发给消息中携带的receiver
+RouteAction = collections.namedtuple("RouteAction", ["protocol", "command", "receiver"])
+
+WILDCARD = RoutingTableEnum.WILDCARD.value
+
+
+class RoutingTable:
+    def __init__(self, device_id_list, route_dict, source=""):
+        '''
+        编译后的只读路由表，由compile_routing_table创建，创建后不再修改，热加载时整体替换
+        :param device_id_list: 支持的设备ID
+        :param route_dict: {(device_id, command): (RouteAction, ...)}，device_id和command可以是通配符
+        '''
+        self.device_id_list = tuple(device_id_list)
+        self.device_id_set = frozenset(device_id_list)
+        self.route_dict = route_dict
+        self.source = source
+
+    @classmethod
+    def compile_routing_table(cls, device_id_list, command_map, source=""):
+        '''
+        将{device_id: {command: action或[action, ...]}}格式的路由规则编译为路由表
+        action为{"protocol": ..., "next_command": ..., "receivers": [...]}，receivers可选，用于转发给多个接收者
+        :return: RoutingTable
+        '''
+        route_dict = {}
+        for device_id, command_dict in command_map.items():
+            if not isinstance(command_dict, dict):
+                raise ConfigError("Routes of " + str(device_id) + " must be a dict!")
+            for received_command, action_info in command_dict.items():
+                action_info_list = action_info if isinstance(action_info, list) else [action_info]
+                action_list = []
+                for action in action_info_list:
+                    if not isinstance(action, dict) or "protocol" not in action or "next_command" not in action:
+                        raise ConfigError("Route " + str(device_id) + "/" + str(received_command) +
+                                          " needs protocol and next_command!")
+                    for receiver in action.get("receivers") or [None]:
+                        action_list.append(RouteAction(action["protocol"], action["next_command"], receiver))
+                route_dict[(device_id, received_command)] = tuple(action_list)
+        return cls(device_id_list, route_dict, source)
+
+    def is_supported_device(self, device_id):
+        return device_id in self.device_id_set
+
+    def get_route_actions(self, device_id, received_command):
+        '''
+        依次按(设备, 命令)、(设备, 任意命令)、(任意设备, 命令)、(任意设备, 任意命令)查找转发动作
+        :return: (RouteAction, ...)，没有匹配的规则时返回None
+        '''
+        route_dict = self.route_dict
+        route_actions = route_dict.get((device_id, received_command))
+        if route_actions is None:
+            route_actions = route_dict.get((device_id, WILDCARD))
+        if route_actions is None:
+            route_actions = route_dict.get((WILDCARD, received_command))
+        if route_actions is None:
+            route_actions = route_dict.get((WILDCARD, WILDCARD))
+        return route_actions
+
+    def get_symbols(self):
+        '''
+        路由表中出现的设备ID和命令，用于注册编解码器的符号表
+        :return:
+        '''
+        symbol_set = set(self.device_id_set)
+        for (device_id, received_command), route_actions in self.route_dict.items():
+            symbol_set.update((device_id, received_command))
+            for route_action in route_actions:
+                symbol_set.add(route_action.command)
+                if route_action.receiver is not None:
+                    symbol_set.add(route_action.receiver)
+        symbol_set.discard(WILDCARD)
+        return symbol_set
+
+
+class RoutingTableLoader:
+    def __init__(self, file_path, on_reload=None):
+        '''
+        从文件加载路由表，并在文件被修改后重新编译，编译失败时保留原路由表
+        文件格式为{"devices": [device_id, ...], "routes": {device_id: {command: action}}}
+        :param on_reload: 新路由表生效时的回调，参数为新的RoutingTable
+        '''
+        self.file_path = file_path
+        self.on_reload = on_reload
+        self.logger = Logger("RoutingTableLoader")
+        self.file_modified_time = None
+        self.watcher_thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def get_default_file_path():
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            RoutingTableEnum.ROUTING_TABLE_FILE_PATH.value)
+
+    def load_routing_table(self):
+        '''
+        读取并编译路由表文件
+        :return: RoutingTable
+        '''
+        self.file_modified_time = os.stat(self.file_path).st_mtime_ns
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as routing_file:
+                routing_config = json.load(routing_file)
+        except ValueError as e:
+            raise ConfigError("Invalid routing table file " + self.file_path + ": " + str(e))
+        if "devices" not in routing_config or "routes" not in routing_config:
+            raise ConfigError("Routing table file " + self.file_path + " needs devices and routes!")
+        return RoutingTable.compile_routing_table(routing_config["devices"], routing_config["routes"], self.file_path)
+
+    def reload_if_modified(self):
+        '''
+        文件修改时间变化时重新加载并回调on_reload
+        :return: 是否加载了新的路由表
+        '''
+        try:
+            if os.stat(self.file_path).st_mtime_ns == self.file_modified_time:
+                return False
+            routing_table = self.load_routing_table()
+        except (OSError, ConfigError) as e:
+            self.logger.error("reload routing table failed for " + str(e) + ", keep the current one")
+            return False
+        if self.on_reload is not None:
+            # 回调失败时（例如符号表已满）不替换路由表，也不能让异常结束监视线程
+            try:
+                self.on_reload(routing_table)
+            except Exception as e:
+                self.logger.error("apply reloaded routing table failed for " + str(e) + ", keep the current one")
+                return False
+        self.logger.info("routing table reloaded from " + self.file_path)
+        return True
+
+    def start_watcher_thread(self, interval=RoutingTableEnum.RELOAD_CHECK_INTERVAL.value):
+        '''
+        拉起后台线程定期检查路由表文件
+        :return:
+        '''
+        if self.watcher_thread is not None:
+            return
+        self.stop_event.clear()
+        self.watcher_thread = threading.Thread(target=self.watch_routing_table_file, args=(interval,),
+                                               name="routing-table-watcher", daemon=True)
+        self.watcher_thread.start()
+
+    def stop_watcher_thread(self):
+        self.stop_event.set()
+        self.watcher_thread = None
+
+    def watch_routing_table_file(self, interval):
+        while not self.stop_event.wait(interval):
+            self.reload_if_modified()
@@ -0,0 +1,233 @@
+from common.message_codec import MessageCodec
+from common.message_format import MessageWireFormatEnum
+from common.modbus_enum import ModbusRTUEnum
+from common.modbus_enum import ModbusSerialEnum
+from util.logger_manager_ment import Logger
+
+
+def build_modbus_crc16_table():
+    crc_table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        crc_table.append(crc)
+    return crc_table
+
+
+MODBUS_CRC16_TABLE = build_modbus_crc16_table()
+
+
+def modbus_crc16(data):
+    '''
+    计算Modbus RTU的CRC16校验值，data可以是bytes、bytearray或memoryview
+    :return: crc
+    '''
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ MODBUS_CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class SerialFrameParser(object):
+    def __init__(self, frame_mode=ModbusSerialEnum.FRAME_MODE.value,
+                 buffer_size=ModbusSerialEnum.RECEIVE_BUFFER_SIZE.value):
+        '''
+        串口流式帧解析器，串口数据直接读入可复用的缓冲区，在缓冲区中查找完整帧的边界，一旦收到完整帧立即返回
+        text模式下识别以TEXT_FRAME_DELIMITER结尾的文本消息和带长度前缀的二进制消息，rtu模式下按功能码和CRC16识别Modbus RTU帧
+        :param frame_mode: text或rtu
+        :param buffer_size: 缓冲区大小，需要大于单帧的最大长度
+        '''
+        self.frame_mode = frame_mode
+        self.buffer = bytearray(buffer_size)
+        self.buffer_view = memoryview(self.buffer)
+        # 缓冲区中[start_position, end_position)为尚未解析成帧的数据
+        self.start_position = 0
+        self.end_position = 0
+        # 文本帧已查找过分隔符的位置，下次从这里继续查找
+        self.search_position = 0
+        self.delimiter = ModbusSerialEnum.TEXT_FRAME_DELIMITER.value
+        self.dropped_byte_count = 0
+        # 超过缓冲区大小的帧被丢弃后，其余部分也要丢弃：二进制帧还剩的字节数，文本帧丢弃到下一个分隔符为止
+        self.discard_byte_count = 0
+        self.discarding_text_frame = False
+        self.logger = Logger("SerialFrameParser")
+
+    def read_from_serial(self, ser):
+        '''
+        从串口读取当前可读的全部数据，没有数据时按串口的timeout等待第一个字节
+        :return: 本次读取后得到的完整帧列表
+        '''
+        self.reserve_free_space()
+        read_size = min(max(ser.in_waiting, 1), len(self.buffer) - self.end_position)
+        read_length = ser.readinto(self.buffer_view[self.end_position:self.end_position + read_size])
+        if read_length:
+            self.end_position += read_length
+        return self.parse_frames()
+
+    def feed(self, data):
+        '''
+        写入其他来源的数据
+        :return: 完整帧列表
+        '''
+        frame_list = []
+        data_view = memoryview(data)
+        while len(data_view) > 0:
+            self.reserve_free_space()
+            copy_length = min(len(data_view), len(self.buffer) - self.end_position)
+            self.buffer_view[self.end_position:self.end_position + copy_length] = data_view[:copy_length]
+            self.end_position += copy_length
+            data_view = data_view[copy_length:]
+            frame_list.extend(self.parse_frames())
+        return frame_list
+
+    def reserve_free_space(self):
+        '''
+        缓冲区尾部空间不足时，将未解析的数据整体移动到缓冲区开头，缓冲区被一帧占满时丢弃
+        :return:
+        '''
+        if self.end_position < len(self.buffer):
+            return
+        if self.start_position == 0:
+            self.logger.error("serial frame exceeds buffer size, drop it")
+            if self.frame_mode == "rtu":
+                # rtu模式下按CRC逐字节重新同步，不需要跳过帧的其余部分
+                self.dropped_byte_count += self.end_position
+                self.end_position = self.search_position = 0
+            else:
+                self.start_discarding_frame()
+            return
+        pending_length = self.end_position - self.start_position
+        self.buffer[:pending_length] = self.buffer_view[self.start_position:self.end_position]
+        self.search_position -= self.start_position
+        self.start_position = 0
+        self.end_position = pending_length
+
+    def start_discarding_frame(self):
+        '''
+        丢弃占满缓冲区的文本帧或二进制帧，并记录该帧还有多少数据需要丢弃
+        文本帧保留末尾可能是分隔符前半部分的字节，避免漏掉跨两次读取的分隔符
+        :return:
+        '''
+        frame_length = None
+        if self.buffer[0] == MessageWireFormatEnum.BINARY_MAGIC.value:
+            frame_length = MessageCodec.get_binary_frame_length(self.buffer_view[:self.end_position])
+        if frame_length is not None:
+            self.discard_byte_count = frame_length - self.end_position
+            kept_length = 0
+        else:
+            self.discarding_text_frame = True
+            kept_length = len(self.delimiter) - 1
+            self.buffer[:kept_length] = self.buffer_view[self.end_position - kept_length:self.end_position]
+        self.dropped_byte_count += self.end_position - kept_length
+        self.end_position = kept_length
+        self.start_position = self.search_position = 0
+
+    def skip_discarded_frame(self):
+        '''
+        跳过被丢弃的帧的剩余数据
+        :return: 是否已跳过完毕，可以继续解析后面的帧
+        '''
+        if self.discard_byte_count:
+            skip_length = min(self.discard_byte_count, self.end_position - self.start_position)
+            self.discard_byte_count -= skip_length
+        else:
+            delimiter_position = self.buffer.find(self.delimiter, self.start_position, self.end_position)
+            if delimiter_position < 0:
+                skip_length = max(self.end_position - self.start_position - len(self.delimiter) + 1, 0)
+            else:
+                skip_length = delimiter_position + len(self.delimiter) - self.start_position
+                self.discarding_text_frame = False
+        self.dropped_byte_count += skip_length
+        self.start_position = self.search_position = self.start_position + skip_length
+        return not self.discard_byte_count and not self.discarding_text_frame
+
+    def parse_frames(self):
+        frame_list = []
+        if (self.discard_byte_count or self.discarding_text_frame) and not self.skip_discarded_frame():
+            return frame_list
+        while self.start_position < self.end_position:
+            if self.frame_mode == "rtu":
+                frame_length = self.find_rtu_frame_length()
+            else:
+                frame_length = self.find_text_frame_length()
+            if frame_length is None:
+                break
+            frame_end_position = self.start_position + frame_length
+            frame = bytes(self.buffer_view[self.start_position:frame_end_position])
+            self.start_position = self.search_position = frame_end_position
+            if self.frame_mode == "rtu":
+                frame_list.append(frame)
+                continue
+            if frame.endswith(self.delimiter):
+                frame = frame[:-len(self.delimiter)]
+            if frame.strip():
+                frame_list.append(frame)
+        if self.start_position == self.end_position:
+            self.start_position = self.end_position = self.search_position = 0
+        return frame_list
+
+    def find_text_frame_length(self):
+        '''
+        查找当前文本帧或二进制帧的长度
+        :return: 帧长度（包括分隔符），帧不完整时返回None
+        '''
+        available_length = self.end_position - self.start_position
+        if self.buffer[self.start_position] == MessageWireFormatEnum.BINARY_MAGIC.value:
+            frame_length = MessageCodec.get_binary_frame_length(
+                self.buffer_view[self.start_position:self.end_position])
+            if frame_length is None or frame_length > available_length:
+                return None
+            return frame_length
+        search_start = max(self.search_position - len(self.delimiter) + 1, self.start_position)
+        delimiter_position = self.buffer.find(self.delimiter, search_start, self.end_position)
+        if delimiter_position < 0:
+            self.search_position = self.end_position
+            return None
+        return delimiter_position + len(self.delimiter) - self.start_position
+
+    def find_rtu_frame_length(self):
+        '''
+        根据功能码推断RTU帧可能的长度并校验CRC，都不匹配时丢弃一个字节重新同步
+        :return: 帧长度，帧不完整时返回None
+        '''
+        while True:
+            available_length = self.end_position - self.start_position
+            if available_length < ModbusRTUEnum.MIN_FRAME_LENGTH.value:
+                return None
+            waiting_for_data = False
+            for frame_length in self.get_rtu_frame_length_candidates(available_length):
+                if frame_length > available_length:
+                    waiting_for_data = True
+                elif self.check_rtu_crc(frame_length):
+                    return frame_length
+            if waiting_for_data and available_length < ModbusRTUEnum.MAX_FRAME_LENGTH.value:
+                return None
+            # 当前位置不是合法帧的开头
+            self.start_position += 1
+            self.search_position = self.start_position
+            self.dropped_byte_count += 1
+
+    def get_rtu_frame_length_candidates(self, available_length):
+        function_code = self.buffer[self.start_position + 1]
+        if function_code & ModbusRTUEnum.EXCEPTION_FUNCTION_FLAG.value:
+            return [5]
+        if function_code in (1, 2, 3, 4):
+            # 响应帧：地址、功能码、字节数、数据、CRC；请求帧固定8字节
+            if available_length >= 3:
+                return [5 + self.buffer[self.start_position + 2], 8]
+            return [8]
+        if function_code in (5, 6):
+            return [8]
+        if function_code in (15, 16):
+            # 响应帧固定8字节；请求帧的第7个字节为数据字节数
+            if available_length >= 7:
+                return [8, 9 + self.buffer[self.start_position + 6]]
+            return [8, ModbusRTUEnum.MAX_FRAME_LENGTH.value]
+        # 未知功能码只能逐个长度尝试CRC
+        return list(range(ModbusRTUEnum.MIN_FRAME_LENGTH.value, ModbusRTUEnum.MAX_FRAME_LENGTH.value + 1))
+
+    def check_rtu_crc(self, frame_length):
+        crc_position = self.start_position + frame_length - 2
+        crc = self.buffer[crc_position] | (self.buffer[crc_position + 1] << 8)
+        return modbus_crc16(self.buffer_view[self.start_position:crc_position]) == crc
@@ -0,0 +1,252 @@
+import time
+import threading
+import collections
+import concurrent.futures
+import serial
+
+from common.exception import CommonError
+from common.modbus_enum import ModbusSerialEnum
+from common.modbus_enum import SerialPortEnum
+from core_services.controller_metrics import record_connection
+from util.logger_manager_ment import Logger
+
+
+def get_rtu_frame_gap(baudrate):
+    '''
+    Modbus RTU帧之间需要保持的静默时间
+    :return: 秒
+    '''
+    if baudrate > SerialPortEnum.RTU_FIXED_GAP_BAUDRATE.value:
+        return SerialPortEnum.RTU_FIXED_FRAME_GAP.value
+    return SerialPortEnum.RTU_FRAME_GAP_CHARACTERS.value * SerialPortEnum.RTU_CHARACTER_BITS.value / baudrate
+
+
+class SerialWriteRequest:
+    def __init__(self, data):
+        '''
+        待写入串口的单条消息，future在写入完成后完成
+        :return:
+        '''
+        self.data = data
+        self.future = concurrent.futures.Future()
+
+
+class SerialPort:
+    # 每个串口只打开一个句柄，key为串口位置
+    serial_port_dict = {}
+    serial_port_dict_lock = threading.Lock()
+
+    def __init__(self, serial_file_location, baudrate=ModbusSerialEnum.BAND_RATE_ENUM.value,
+                 timeout=ModbusSerialEnum.SERIAL_TIMEOUT_ENUM.value, write_timeout=SerialPortEnum.WRITE_TIMEOUT.value,
+                 frame_mode=ModbusSerialEnum.FRAME_MODE.value,
+                 write_queue_size=SerialPortEnum.WRITE_QUEUE_SIZE.value,
+                 max_coalesce_size=SerialPortEnum.MAX_COALESCE_SIZE.value,
+                 reopen_interval=SerialPortEnum.REOPEN_INTERVAL.value,
+                 max_reopen_interval=SerialPortEnum.MAX_REOPEN_INTERVAL.value):
+        '''
+        单个串口的持久化句柄，接收和发送共用同一个句柄
+        发送的消息先进入写队列，由写线程把积压的多条消息合并为一次写入；RTU模式下每帧单独写入并保证帧间静默时间
+        读写出现SerialException时关闭句柄，之后按指数退避重新打开
+        :return:
+        '''
+        self.serial_file_location = serial_file_location
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.frame_mode = frame_mode
+        self.write_queue_size = write_queue_size
+        self.max_coalesce_size = max_coalesce_size
+        self.reopen_interval = reopen_interval
+        self.max_reopen_interval = max_reopen_interval
+        self.logger = Logger("SerialPort")
+        self.ser = None
+        self.handle_lock = threading.Lock()
+        self.current_reopen_interval = reopen_interval
+        self.next_open_time = 0
+        self.frame_gap = get_rtu_frame_gap(baudrate) if frame_mode == "rtu" else 0
+        self.last_write_end_time = 0
+        self.write_request_deque = collections.deque()
+        self.write_condition = threading.Condition()
+        self.writer_thread = None
+        self.closed = False
+        self.opened_count = 0
+
+    @classmethod
+    def get_serial_port(cls, serial_file_location):
+        '''
+        获取指定位置的串口，不存在时创建
+        :return: serial_port
+        '''
+        with cls.serial_port_dict_lock:
+            serial_port = cls.serial_port_dict.get(serial_file_location)
+            if serial_port is None:
+                serial_port = cls(serial_file_location)
+                cls.serial_port_dict[serial_file_location] = serial_port
+            return serial_port
+
+    @classmethod
+    def close_all_serial_ports(cls):
+        with cls.serial_port_dict_lock:
+            serial_port_list = list(cls.serial_port_dict.values())
+            cls.serial_port_dict.clear()
+        for serial_port in serial_port_list:
+            serial_port.close_serial_port()
+
+    def get_handle(self):
+        '''
+        获取已打开的串口句柄，未打开时打开；处于重新打开的等待时间内时直接报错
+        :return: ser
+        '''
+        with self.handle_lock:
+            if self.ser is not None:
+                return self.ser
+            if self.closed:
+                raise serial.SerialException(self.serial_file_location + " is closed")
+            wait_time = self.next_open_time - time.monotonic()
+            if wait_time > 0:
+                raise serial.SerialException(self.serial_file_location + " will be reopened in " +
+                                             str(round(wait_time, 3)) + "s")
+            try:
+                self.ser = serial.Serial(port=self.serial_file_location, baudrate=self.baudrate, timeout=self.timeout,
+                                         write_timeout=self.write_timeout)
+            except serial.SerialException:
+                self.delay_reopen()
+                raise
+            self.current_reopen_interval = self.reopen_interval
+            self.logger.info("serial " + self.serial_file_location + " opened")
+            record_connection("Modbus", self.serial_file_location, self.opened_count > 0)
+            self.opened_count += 1
+            return self.ser
+
+    def wait_for_handle(self):
+        '''
+        获取串口句柄，打开失败时等待后重试，直到打开成功
+        :return: ser
+        '''
+        while True:
+            try:
+                return self.get_handle()
+            except serial.SerialException as e:
+                if self.closed:
+                    raise
+                self.logger.error("open serial " + self.serial_file_location + " failed for " + str(e))
+                time.sleep(max(self.next_open_time - time.monotonic(), self.reopen_interval))
+
+    def delay_reopen(self):
+        self.next_open_time = time.monotonic() + self.current_reopen_interval
+        self.current_reopen_interval = min(self.current_reopen_interval * 2, self.max_reopen_interval)
+
+    def handle_serial_error(self, ser, error):
+        '''
+        读写出现异常时关闭句柄，另一侧的读写随之失败，下次使用时重新打开
+        :return:
+        '''
+        with self.handle_lock:
+            if self.ser is not ser:
+                return
+            self.ser = None
+            self.delay_reopen()
+        self.logger.error("The serial " + self.serial_file_location + " is abnormal for " + str(error))
+        try:
+            ser.close()
+        except (OSError, serial.SerialException):
+            pass
+
+    def read_frames(self, frame_parser):
+        '''
+        从串口读取数据并切分出完整的帧，串口异常时等待重新打开
+        :return: 帧列表
+        '''
+        ser = self.wait_for_handle()
+        try:
+            return frame_parser.read_from_serial(ser)
+        except (OSError, serial.SerialException) as e:
+            self.handle_serial_error(ser, e)
+            return []
+
+    def write_frame(self, data):
+        '''
+        将一帧数据加入写队列
+        :return: future，写入完成后结果为写入的字节数
+        '''
+        write_request = SerialWriteRequest(data)
+        with self.write_condition:
+            if self.closed:
+                raise CommonError("serial " + self.serial_file_location + " is closed")
+            if len(self.write_request_deque) >= self.write_queue_size:
+                raise CommonError("write queue of serial " + self.serial_file_location + " is full")
+            self.write_request_deque.append(write_request)
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self.flush_write_queue, daemon=True,
+                                                      name="serial-writer-" + self.serial_file_location)
+                self.writer_thread.start()
+            self.write_condition.notify()
+        return write_request.future
+
+    def take_write_batch(self):
+        '''
+        取出下一批要写入的消息：文本模式下合并积压的消息直到MAX_COALESCE_SIZE，RTU模式下每次一帧
+        :return: [write_request, ...]，关闭后返回空列表
+        '''
+        with self.write_condition:
+            self.write_condition.wait_for(lambda: self.write_request_deque or self.closed)
+            if not self.write_request_deque:
+                return []
+            batch = [self.write_request_deque.popleft()]
+            if self.frame_gap:
+                return batch
+            batch_size = len(batch[0].data)
+            while self.write_request_deque and \
+                    batch_size + len(self.write_request_deque[0].data) <= self.max_coalesce_size:
+                write_request = self.write_request_deque.popleft()
+                batch_size += len(write_request.data)
+                batch.append(write_request)
+            return batch
+
+    def flush_write_queue(self):
+        '''
+        写线程：把写队列中的消息写入串口
+        :return:
+        '''
+        while True:
+            batch = self.take_write_batch()
+            if not batch:
+                return
+            ser = None
+            try:
+                ser = self.get_handle()
+                if self.frame_gap:
+                    gap_time = self.last_write_end_time + self.frame_gap - time.monotonic()
+                    if gap_time > 0:
+                        time.sleep(gap_time)
+                ser.write(batch[0].data if len(batch) == 1 else b"".join(request.data for request in batch))
+                if self.frame_gap:
+                    # 等待数据发送完毕，帧间静默时间从最后一个字节发出后开始计算
+                    ser.flush()
+                    self.last_write_end_time = time.monotonic()
+            except (OSError, serial.SerialException) as e:
+                # 写超时说明对端接收慢，串口本身仍可用，不需要重新打开
+                if ser is not None and not isinstance(e, serial.SerialTimeoutException):
+                    self.handle_serial_error(ser, e)
+                for write_request in batch:
+                    write_request.future.set_exception(e)
+                continue
+            for write_request in batch:
+                write_request.future.set_result(len(write_request.data))
+
+    def close_serial_port(self):
+        '''
+        停止写线程并关闭句柄，未写入的消息失败
+        :return:
+        '''
+        with self.write_condition:
+            self.closed = True
+            pending_request_list = list(self.write_request_deque)
+            self.write_request_deque.clear()
+            self.write_condition.notify_all()
+        for write_request in pending_request_list:
+            write_request.future.set_exception(CommonError("serial " + self.serial_file_location + " is closed"))
+        with self.handle_lock:
+            ser, self.ser = self.ser, None
+        if ser is not None:
+            ser.close()
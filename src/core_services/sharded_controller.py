@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+from common.controller_enum import ShardedControllerEnum
+from core_services.controller import Controller
+from util.consistent_hash import ConsistentHashRing
+from util.logger_manager_ment import Logger
+
+
+def run_controller_shard(shard_index, device_id_list):
+    '''
+    工作进程入口，每个分片进程只创建自己设备的channel和消息队列，与其他分片不共享任何状态
+    :return:
+    '''
+    # 监督进程通过SIGTERM停止工作进程，转换为正常退出，使atexit注册的清理（如关闭消息日志）得以执行
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    controller = Controller()
+    controller.logger = Logger("Actuator-shard" + str(shard_index))
+    controller.shard_index = shard_index
+    controller.device_id_list = device_id_list
+    # 各分片都连接同一个MQTT服务器，只订阅本分片的设备，否则每条上行消息会被每个分片各路由一次
+    controller.channel.mqtt_device_id_list = device_id_list
+    # 分片的设备由监督进程划分，热加载的路由表只更新路由规则，不在分片中为新增的设备拉起监听
+    controller.routing_table_loader.on_reload = controller.apply_routing_table
+    controller.start_monitor_channel_message()
+
+
+class ControllerShard:
+    def __init__(self, shard_index, device_id_list):
+        '''
+        单个分片的工作进程及其重启记录
+        :return:
+        '''
+        self.shard_index = shard_index
+        self.device_id_list = device_id_list
+        self.process = None
+        self.start_time = 0
+        self.restart_count = 0
+        self.restart_interval = ShardedControllerEnum.RESTART_INTERVAL.value
+        self.next_restart_time = 0
+
+
+class ShardedController(Controller):
+
+    def __init__(self, shard_number=ShardedControllerEnum.SHARD_NUMBER.value):
+        '''
+        多进程分片执行器，按一致性哈希将device_id_list划分到多个工作进程中，由当前进程监督并重启崩溃的工作进程
+        WebSocket服务器仍由当前进程通过start_server_process拉起
+        :return:
+        '''
+        super().__init__()
+        self.logger = Logger("ShardSupervisor")
+        self.shard_number = shard_number or os.cpu_count() or 1
+        # 使用spawn而不是fork，避免把监督进程中已经运行的线程状态复制到工作进程
+        self.process_context = multiprocessing.get_context("spawn")
+        self.shard_dict = {}
+        self.running = False
+
+    def partition_device_ids(self):
+        '''
+        按一致性哈希划分设备，分片数量变化时只有少量设备需要迁移
+        :return: {shard_index: [device_id, ...]}
+        '''
+        hash_ring = ConsistentHashRing(list(range(self.shard_number)),
+                                       ShardedControllerEnum.VIRTUAL_NODE_NUMBER.value)
+        return hash_ring.partition(self.device_id_list)
+
+    def start_monitor_channel_message(self):
+        '''
+        拉起所有分片的工作进程并持续监督
+        :return:
+        '''
+        for shard_index, device_id_list in sorted(self.partition_device_ids().items()):
+            shard = ControllerShard(shard_index, device_id_list)
+            self.shard_dict[shard_index] = shard
+            self.start_shard_process(shard)
+        self.running = True
+        try:
+            while self.running:
+                self.supervise_shards()
+                time.sleep(ShardedControllerEnum.SUPERVISE_INTERVAL.value)
+        finally:
+            self.stop_shards()
+
+    def start_shard_process(self, shard):
+        '''
+        拉起指定分片的工作进程
+        :return:
+        '''
+        shard.process = self.process_context.Process(target=run_controller_shard,
+                                                     args=(shard.shard_index, shard.device_id_list),
+                                                     name="controller-shard-" + str(shard.shard_index),
+                                                     daemon=True)
+        shard.process.start()
+        shard.start_time = time.monotonic()
+        self.logger.info("shard " + str(shard.shard_index) + " start working with devices: " +
+                         ",".join(shard.device_id_list))
+
+    def supervise_shards(self):
+        '''
+        检查工作进程是否存活，崩溃的进程按指数退避的时间间隔重启
+        :return:
+        '''
+        now = time.monotonic()
+        for shard in self.shard_dict.values():
+            if shard.process.is_alive():
+                continue
+            if shard.next_restart_time == 0:
+                if now - shard.start_time >= ShardedControllerEnum.STABLE_RUNNING_TIME.value:
+                    shard.restart_interval = ShardedControllerEnum.RESTART_INTERVAL.value
+                shard.next_restart_time = now + shard.restart_interval
+                self.logger.error("shard " + str(shard.shard_index) + " stopped running with exit code " +
+                                  str(shard.process.exitcode) + ", restart after " +
+                                  str(shard.restart_interval) + "s")
+                shard.restart_interval = min(shard.restart_interval * 2,
+                                             ShardedControllerEnum.MAX_RESTART_INTERVAL.value)
+            elif now >= shard.next_restart_time:
+                shard.next_restart_time = 0
+                shard.restart_count += 1
+                self.start_shard_process(shard)
+
+    def stop_shards(self):
+        '''
+        停止所有工作进程
+        :return:
+        '''
+        self.running = False
+        for shard in self.shard_dict.values():
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shard_dict.values():
+            if shard.process is not None:
+                shard.process.join()
+
+
+if __name__ == "__main__":
+    controller = ShardedController()
+    controller.start_server_process()
@@ -0,0 +1,141 @@
+import time
+import threading
+import collections
+
+from common.controller_enum import CircuitBreakerEnum
+from common.controller_enum import SupervisorEnum
+from core_services.controller_metrics import CIRCUIT_STATE
+from core_services.controller_metrics import LISTENER_RESTARTS
+from core_services.controller_metrics import LISTENER_UP
+from core_services.controller_metrics import METRICS_REGISTRY
+from util.backoff import ExponentialBackoff
+from util.circuit_breaker import CircuitBreaker
+from util.logger_manager_ment import Logger
+
+STARTING_STATE = SupervisorEnum.STARTING_STATE.value
+RUNNING_STATE = SupervisorEnum.RUNNING_STATE.value
+BACKOFF_STATE = SupervisorEnum.BACKOFF_STATE.value
+CIRCUIT_OPEN_STATE = SupervisorEnum.CIRCUIT_OPEN_STATE.value
+STOPPED_STATE = SupervisorEnum.STOPPED_STATE.value
+CIRCUIT_STATE_VALUE_DICT = {CircuitBreakerEnum.CLOSED_STATE.value: 0,
+                            CircuitBreakerEnum.HALF_OPEN_STATE.value: 1,
+                            CircuitBreakerEnum.OPEN_STATE.value: 2}
+
+
+class SupervisedListener:
+    def __init__(self, name, func, circuit_breaker=None):
+        '''
+        被监督的监听函数及其运行状态，circuit_breaker为监听的endpoint的熔断器，没有时为None
+        :return:
+        '''
+        self.name = name
+        self.func = func
+        self.circuit_breaker = circuit_breaker
+        self.state = STARTING_STATE
+        self.restart_count = 0
+        self.last_error = None
+        self.start_time = None
+        self.next_restart_time = None
+        self.backoff = ExponentialBackoff(SupervisorEnum.RESTART_MIN_DELAY.value,
+                                          SupervisorEnum.RESTART_MAX_DELAY.value,
+                                          SupervisorEnum.RESTART_BACKOFF_MULTIPLIER.value)
+        self.thread = None
+
+    def get_listener_status(self):
+        now = time.monotonic()
+        return {"state": self.state,
+                "restart_count": self.restart_count,
+                "last_error": None if self.last_error is None else str(self.last_error),
+                "uptime": round(now - self.start_time, 3) if self.state == RUNNING_STATE else 0,
+                "restart_in": round(max(0, self.next_restart_time - now), 3)
+                if self.next_restart_time is not None else None}
+
+
+class Supervisor:
+    def __init__(self):
+        '''
+        监听线程的监督者：每个监听函数运行在单独的线程中，异常退出后按带抖动的指数退避重新拉起，
+        所监听的endpoint熔断时暂停重启，直到熔断器允许试探；监听函数正常返回视为运行结束，不再重启
+        :return:
+        '''
+        self.logger = Logger("Supervisor")
+        self.listener_dict = collections.OrderedDict()
+        self.stop_event = threading.Event()
+        METRICS_REGISTRY.add_collect_callback(self.collect_supervisor_metrics)
+
+    def add_listener(self, name, func, circuit_breaker=None):
+        '''
+        添加并拉起一个监听函数
+        :return: listener
+        '''
+        listener = SupervisedListener(name, func, circuit_breaker)
+        self.listener_dict[name] = listener
+        listener.thread = threading.Thread(target=self.run_listener, args=(listener,), name="listener-" + name,
+                                           daemon=True)
+        listener.thread.start()
+        return listener
+
+    def run_listener(self, listener):
+        while not self.stop_event.is_set():
+            circuit_breaker = listener.circuit_breaker
+            if circuit_breaker is not None and not circuit_breaker.allow_request():
+                listener.state = CIRCUIT_OPEN_STATE
+                self.wait_for_restart(listener, circuit_breaker.get_remaining_open_time())
+                continue
+            listener.state = RUNNING_STATE
+            listener.start_time = time.monotonic()
+            listener.next_restart_time = None
+            try:
+                listener.func()
+            except Exception as e:
+                listener.last_error = e
+            else:
+                listener.state = STOPPED_STATE
+                self.logger.info(listener.name + " finished")
+                return
+            if circuit_breaker is not None:
+                circuit_breaker.record_failure()
+            if time.monotonic() - listener.start_time >= SupervisorEnum.STABLE_RUNNING_TIME.value:
+                listener.backoff.reset()
+            delay = listener.backoff.next_delay()
+            listener.restart_count += 1
+            LISTENER_RESTARTS.labels(listener.name).inc()
+            listener.state = BACKOFF_STATE
+            self.logger.error(listener.name + " stopped running for " + str(listener.last_error) +
+                              ", restart after " + str(round(delay, 2)) + "s")
+            self.wait_for_restart(listener, delay)
+        listener.state = STOPPED_STATE
+
+    def wait_for_restart(self, listener, delay):
+        listener.next_restart_time = time.monotonic() + delay
+        self.stop_event.wait(delay)
+
+    def get_listener_states(self):
+        '''
+        所有监听函数的运行状态以及各endpoint熔断器的状态
+        :return: {"listeners": {name: status}, "circuits": {name: state}}
+        '''
+        return {"listeners": {name: listener.get_listener_status()
+                              for name, listener in list(self.listener_dict.items())},
+                "circuits": CircuitBreaker.get_circuit_states()}
+
+    def join_listeners(self):
+        '''
+        等待所有监听线程结束
+        :return:
+        '''
+        for listener in list(self.listener_dict.values()):
+            listener.thread.join()
+
+    def stop_supervisor(self):
+        '''
+        不再重启监听函数，正在运行的监听函数不受影响
+        :return:
+        '''
+        self.stop_event.set()
+
+    def collect_supervisor_metrics(self):
+        for name, listener in list(self.listener_dict.items()):
+            LISTENER_UP.labels(name).set(1 if listener.state == RUNNING_STATE else 0)
+        for name, state in CircuitBreaker.get_circuit_states().items():
+            CIRCUIT_STATE.labels(name).set(CIRCUIT_STATE_VALUE_DICT[state])
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import bisect
+import socket
+import struct
+import threading
+import collections
+
+from common.channel_enum import TrafficCaptureEnum
+from common.exception import CommonError
+from util.logger_manager_ment import Logger
+
+# 文件格式：文件头 | 记录 ... | 索引 | 文件尾，进程异常退出时没有索引和文件尾，读取时顺序扫描到最后一条完整的记录
+# 文件头：MAGIC、元数据长度 | 元数据JSON
+FILE_MAGIC = b"CTLCAP01"
+META_LENGTH_STRUCT = struct.Struct("<I")
+# 记录：记录类型、序号、距录制开始的时间（秒）、负载长度 | 负载
+RECORD_HEADER_STRUCT = struct.Struct("<BQdI")
+INBOUND_RECORD = 1
+ROUTED_RECORD = 2
+# 接收记录的负载：消息是否为str | 协议 | 设备ID | 消息
+# 路由记录的负载：路由数量 | (是否已发送 | 协议 | 命令 | 接收者) ...
+FLAG_STRUCT = struct.Struct("<B")
+ROUTE_COUNT_STRUCT = struct.Struct("<H")
+STRING_LENGTH_STRUCT = struct.Struct("<H")
+# 索引项：时间、记录偏移；文件尾：索引偏移、记录数量、INDEX_MAGIC
+INDEX_ENTRY_STRUCT = struct.Struct("<dQ")
+TRAILER_STRUCT = struct.Struct("<QQ8s")
+INDEX_MAGIC = b"CTLCAPIX"
+
+# 接收记录的protocol、device_id、message有效，路由记录的route_list有效，为[(protocol, command, receiver, sent), ...]
+CaptureRecord = collections.namedtuple("CaptureRecord", ["record_type", "sequence", "timestamp", "protocol",
+                                                         "device_id", "message", "route_list"])
+
+
+class CapturedBytes(bytes):
+    '''
+    携带录制序号的bytes消息
+    '''
+    capture_sequence = None
+
+
+class CapturedStr(str):
+    '''
+    携带录制序号的str消息
+    '''
+    capture_sequence = None
+
+
+def attach_capture_sequence(message, sequence):
+    '''
+    将录制序号附加到消息上，路由后按序号写入路由记录
+    :return: message
+    '''
+    if hasattr(message, "__dict__"):
+        message.capture_sequence = sequence
+        return message
+    captured_message = CapturedStr(message) if isinstance(message, str) else CapturedBytes(message)
+    captured_message.capture_sequence = sequence
+    return captured_message
+
+
+def encode_string(text):
+    data = text.encode("utf-8")
+    return STRING_LENGTH_STRUCT.pack(len(data)) + data
+
+
+def decode_string(payload, offset):
+    '''
+    :return: (text, 下一个字段的偏移)
+    '''
+    length = STRING_LENGTH_STRUCT.unpack_from(payload, offset)[0]
+    offset += STRING_LENGTH_STRUCT.size
+    return bytes(payload[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def encode_inbound_payload(message, device_id, protocol_type):
+    is_text = isinstance(message, str)
+    return FLAG_STRUCT.pack(1 if is_text else 0) + encode_string(protocol_type) + encode_string(device_id) + \
+        (message.encode("utf-8") if is_text else bytes(message))
+
+
+def decode_inbound_payload(payload):
+    '''
+    :return: (protocol, device_id, message)
+    '''
+    is_text = FLAG_STRUCT.unpack_from(payload)[0]
+    protocol_type, offset = decode_string(payload, FLAG_STRUCT.size)
+    device_id, offset = decode_string(payload, offset)
+    message = bytes(payload[offset:])
+    return protocol_type, device_id, (message.decode("utf-8") if is_text else message)
+
+
+def encode_routed_payload(route_list, sent_list):
+    payload_list = [ROUTE_COUNT_STRUCT.pack(len(route_list))]
+    for (protocol_type, command, receiver), sent in zip(route_list, sent_list):
+        payload_list += [FLAG_STRUCT.pack(1 if sent else 0), encode_string(protocol_type), encode_string(command),
+                         encode_string(str(receiver))]
+    return b"".join(payload_list)
+
+
+def decode_routed_payload(payload):
+    '''
+    :return: [(protocol, command, receiver, sent), ...]
+    '''
+    route_count = ROUTE_COUNT_STRUCT.unpack_from(payload)[0]
+    offset = ROUTE_COUNT_STRUCT.size
+    route_list = []
+    for _ in range(route_count):
+        sent = FLAG_STRUCT.unpack_from(payload, offset)[0]
+        protocol_type, offset = decode_string(payload, offset + FLAG_STRUCT.size)
+        command, offset = decode_string(payload, offset)
+        receiver, offset = decode_string(payload, offset)
+        route_list.append((protocol_type, command, receiver, bool(sent)))
+    return route_list
+
+
+class TrafficCapture:
+    def __init__(self, file_path, index_interval=TrafficCaptureEnum.INDEX_INTERVAL.value,
+                 write_buffer_size=TrafficCaptureEnum.WRITE_BUFFER_SIZE.value,
+                 flush_interval=TrafficCaptureEnum.FLUSH_INTERVAL.value, clock=time.monotonic):
+        '''
+        流量录制：channel放入汇总队列的每条消息写入一条接收记录，并附加录制序号；
+        控制器路由并发送后按序号写入一条路由记录，包含每个转发的协议、命令、接收者以及是否已发送
+        两条记录的时间差即该消息在控制器中的处理耗时；每隔index_interval条记录写一条索引，关闭时写在文件末尾
+        记录在内存中缓冲，由后台线程定期写入文件，进程异常退出时最多丢失最近flush_interval内的记录
+        :return:
+        '''
+        self.file_path = file_path
+        self.index_interval = index_interval
+        self.write_buffer_size = write_buffer_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.logger = Logger("TrafficCapture")
+        self.capture_file = None
+        self.start_time = None
+        self.next_sequence = 1
+        self.record_count = 0
+        self.offset = 0
+        # [(timestamp, offset), ...]
+        self.index_entry_list = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+
+    def open_capture(self):
+        '''
+        新建录制文件并写入文件头，拉起定期写入文件的线程；文件已存在时抛出FileExistsError，不覆盖其他进程的录制
+        :return:
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+        meta_data = json.dumps({"version": 1, "start_time": time.time(), "host": socket.gethostname(),
+                                "pid": os.getpid(), "index_interval": self.index_interval}).encode()
+        self.capture_file = open(self.file_path, "xb", buffering=self.write_buffer_size)
+        header = FILE_MAGIC + META_LENGTH_STRUCT.pack(len(meta_data)) + meta_data
+        self.capture_file.write(header)
+        self.offset = len(header)
+        self.start_time = self.clock()
+        self.flush_thread = threading.Thread(target=self.flush_forever, name="traffic-capture", daemon=True)
+        self.flush_thread.start()
+        self.logger.info("capturing traffic to " + self.file_path)
+
+    def capture_inbound(self, message, device_id, protocol_type):
+        '''
+        写入接收记录
+        :return: 附加了录制序号的message
+        '''
+        payload = encode_inbound_payload(message, device_id, protocol_type)
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self.write_record(INBOUND_RECORD, sequence, payload)
+        return attach_capture_sequence(message, sequence)
+
+    def capture_routes(self, message, route_list, sent_list):
+        '''
+        写入路由记录，没有录制序号的消息（例如消息日志重放的消息）不记录
+        :return:
+        '''
+        sequence = getattr(message, "capture_sequence", None)
+        if sequence is None:
+            return
+        payload = encode_routed_payload(route_list, sent_list)
+        with self.lock:
+            self.write_record(ROUTED_RECORD, sequence, payload)
+
+    def write_record(self, record_type, sequence, payload):
+        # 在锁内取时间，文件中记录的时间单调递增，索引可以二分查找
+        if self.capture_file is None:
+            return
+        timestamp = self.clock() - self.start_time
+        if self.record_count % self.index_interval == 0:
+            self.index_entry_list.append((timestamp, self.offset))
+        record = RECORD_HEADER_STRUCT.pack(record_type, sequence, timestamp, len(payload)) + payload
+        self.capture_file.write(record)
+        self.offset += len(record)
+        self.record_count += 1
+
+    def flush_forever(self):
+        while not self.stop_event.wait(self.flush_interval):
+            with self.lock:
+                if self.capture_file is None:
+                    return
+                self.capture_file.flush()
+
+    def close_capture(self):
+        '''
+        写入索引和文件尾后关闭录制文件
+        :return:
+        '''
+        self.stop_event.set()
+        with self.lock:
+            if self.capture_file is None:
+                return
+            self.capture_file.write(b"".join(INDEX_ENTRY_STRUCT.pack(*index_entry)
+                                             for index_entry in self.index_entry_list))
+            self.capture_file.write(TRAILER_STRUCT.pack(self.offset, self.record_count, INDEX_MAGIC))
+            self.capture_file.close()
+            self.capture_file = None
+        self.logger.info("captured " + str(self.record_count) + " records to " + self.file_path)
+
+
+class TrafficCaptureReader:
+    def __init__(self, file_path):
+        '''
+        读取录制文件，有索引时按时间定位到附近的记录再顺序读取，没有索引时从头顺序读取
+        :return:
+        '''
+        self.file_path = file_path
+        self.capture_file = open(file_path, "rb")
+        if self.capture_file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            self.capture_file.close()
+            raise CommonError(file_path + " is not a traffic capture file")
+        meta_length = META_LENGTH_STRUCT.unpack(self.capture_file.read(META_LENGTH_STRUCT.size))[0]
+        self.meta_data = json.loads(self.capture_file.read(meta_length))
+        self.data_offset = self.capture_file.tell()
+        self.data_end = os.path.getsize(file_path)
+        self.record_count = None
+        # 索引的时间和偏移分开保存，便于二分查找
+        self.index_time_list = []
+        self.index_offset_list = []
+        self.read_index()
+
+    def read_index(self):
+        if self.data_end - self.data_offset < TRAILER_STRUCT.size:
+            return
+        self.capture_file.seek(self.data_end - TRAILER_STRUCT.size)
+        index_offset, record_count, index_magic = TRAILER_STRUCT.unpack(self.capture_file.read(TRAILER_STRUCT.size))
+        if index_magic != INDEX_MAGIC:
+            return
+        self.capture_file.seek(index_offset)
+        index_data = self.capture_file.read(self.data_end - TRAILER_STRUCT.size - index_offset)
+        for timestamp, offset in INDEX_ENTRY_STRUCT.iter_unpack(index_data):
+            self.index_time_list.append(timestamp)
+            self.index_offset_list.append(offset)
+        self.record_count = record_count
+        self.data_end = index_offset
+
+    def read_records(self, start_time=None, end_time=None):
+        '''
+        按写入顺序读取录制时间在[start_time, end_time)内的记录
+        :return: CaptureRecord的生成器
+        '''
+        offset = self.data_offset
+        if start_time is not None and self.index_time_list:
+            index = bisect.bisect_right(self.index_time_list, start_time) - 1
+            if index >= 0:
+                offset = self.index_offset_list[index]
+        self.capture_file.seek(offset)
+        while offset + RECORD_HEADER_STRUCT.size <= self.data_end:
+            record_type, sequence, timestamp, payload_length = \
+                RECORD_HEADER_STRUCT.unpack(self.capture_file.read(RECORD_HEADER_STRUCT.size))
+            payload = self.capture_file.read(payload_length)
+            offset += RECORD_HEADER_STRUCT.size + payload_length
+            # 异常退出时最后一条记录可能不完整
+            if len(payload) < payload_length or offset > self.data_end:
+                return
+            if end_time is not None and timestamp >= end_time:
+                return
+            if start_time is not None and timestamp < start_time:
+                continue
+            if record_type == INBOUND_RECORD:
+                protocol_type, device_id, message = decode_inbound_payload(payload)
+                yield CaptureRecord(record_type, sequence, timestamp, protocol_type, device_id, message, None)
+            elif record_type == ROUTED_RECORD:
+                yield CaptureRecord(record_type, sequence, timestamp, None, None, None,
+                                    decode_routed_payload(payload))
+
+    def close_reader(self):
+        self.capture_file.close()
@@ -0,0 +1,301 @@
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+
+from common.controller_enum import TrafficReplayEnum
+from core_services.controller import Controller
+from core_services.routing_table import RoutingTableLoader
+from core_services.traffic_capture import INBOUND_RECORD
+from core_services.traffic_capture import ROUTED_RECORD
+from core_services.traffic_capture import TrafficCaptureReader
+from core_services.traffic_capture import attach_capture_sequence
+from util.logger_manager_ment import Logger
+from util.tracing import calculate_percentile
+
+
+class DryRunChannelPool:
+    def __init__(self):
+        '''
+        回放时替代ChannelPool，不向设备发送，只按协议统计发送次数
+        :return:
+        '''
+        self.sent_counter = collections.Counter()
+        self.lock = threading.Lock()
+
+    def call_with_channel(self, protocol_type, endpoint, func_name, *args, **kwargs):
+        with self.lock:
+            self.sent_counter[protocol_type] += 1
+        return True
+
+    def start_maintenance_thread(self):
+        pass
+
+
+class TrafficReplayer:
+    def __init__(self, controller, capture_reader, speed=TrafficReplayEnum.SPEED.value,
+                 idle_timeout=TrafficReplayEnum.IDLE_TIMEOUT.value, clock=time.perf_counter):
+        '''
+        流量回放：把录制文件中的接收记录按录制时的时间间隔（除以speed）重新放入控制器的汇总队列，speed为0时不等待，
+        由控制器的处理线程按正常流程路由，把每条消息的路由结果与录制的路由记录比较，并统计回放的吞吐和耗时
+        回放时替代控制器的流量录制，接收和路由记录都交给回放器
+        :return:
+        '''
+        self.controller = controller
+        self.capture_reader = capture_reader
+        self.speed = speed
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.logger = Logger("TrafficReplayer")
+        # 录制序号 -> 接收记录
+        self.recorded_inbound_dict = collections.OrderedDict()
+        # 录制序号 -> 路由记录
+        self.recorded_routed_dict = {}
+        # 录制序号 -> 放入汇总队列的时间
+        self.inject_time_dict = {}
+        # 录制序号 -> (路由结果, 路由完成的时间)
+        self.replayed_route_dict = {}
+        self.condition = threading.Condition()
+
+    def capture_inbound(self, message, device_id, protocol_type):
+        '''
+        回放的消息在放入队列前已经附加了录制时的序号，保持不变
+        :return: message
+        '''
+        return message
+
+    def capture_routes(self, message, route_list, sent_list):
+        sequence = getattr(message, "capture_sequence", None)
+        if sequence is None:
+            return
+        with self.condition:
+            self.replayed_route_dict[sequence] = ([(protocol_type, command, str(receiver))
+                                                   for protocol_type, command, receiver in route_list], self.clock())
+            self.condition.notify()
+
+    def run_replay(self, start_time=None, end_time=None, dry_run=True):
+        '''
+        回放录制时间在[start_time, end_time)内的消息，等待控制器处理完成
+        dry_run时不向设备发送，所有设备视为在线，只比较路由结果
+        :return: 回放结果
+        '''
+        controller = self.controller
+        channel = controller.channel
+        controller.traffic_capture = self
+        channel.traffic_capture = self
+        if dry_run:
+            channel.channel_pool = DryRunChannelPool()
+            controller.device_presence.track_devices({}, {})
+        threading.Thread(target=controller.process_received_command, name="replay-command-processor",
+                         daemon=True).start()
+        replay_start_time = self.clock()
+        first_timestamp = None
+        for record in self.capture_reader.read_records(start_time, end_time):
+            if record.record_type == ROUTED_RECORD:
+                self.recorded_routed_dict[record.sequence] = record
+                continue
+            if record.record_type != INBOUND_RECORD:
+                continue
+            self.recorded_inbound_dict[record.sequence] = record
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            if self.speed:
+                delay = replay_start_time + (record.timestamp - first_timestamp) / self.speed - self.clock()
+                if delay > 0:
+                    time.sleep(delay)
+            channel.message_queue.wait_until_writable(record.device_id)
+            self.inject_time_dict[record.sequence] = self.clock()
+            channel.put_received_message(attach_capture_sequence(record.message, record.sequence),
+                                         record.device_id, record.protocol)
+        self.wait_for_routes()
+        return self.get_replay_result(replay_start_time, dry_run)
+
+    def wait_for_routes(self):
+        '''
+        等待所有回放的消息都有路由结果，重复或被丢弃的消息没有路由结果，超过idle_timeout没有新结果时结束
+        :return:
+        '''
+        with self.condition:
+            routed_count = len(self.replayed_route_dict)
+            while routed_count < len(self.inject_time_dict):
+                self.condition.wait(self.idle_timeout)
+                if len(self.replayed_route_dict) == routed_count:
+                    self.logger.warning(str(len(self.inject_time_dict) - routed_count) +
+                                        " replayed messages were not routed")
+                    return
+                routed_count = len(self.replayed_route_dict)
+
+    def compare_routes(self):
+        '''
+        逐条比较录制和回放的路由结果，只比较协议、命令和接收者，不比较是否发送成功
+        :return: {"compared", "matched", "mismatched", "missing", "extra", "examples"}
+        '''
+        comparison = collections.OrderedDict([("compared", 0), ("matched", 0), ("mismatched", 0), ("missing", 0),
+                                              ("extra", 0), ("examples", [])])
+        for sequence, inbound_record in self.recorded_inbound_dict.items():
+            routed_record = self.recorded_routed_dict.get(sequence)
+            recorded_route_list = None if routed_record is None else \
+                [tuple(route[:3]) for route in routed_record.route_list]
+            replayed_route_list = self.replayed_route_dict.get(sequence, (None, None))[0]
+            if recorded_route_list is None and replayed_route_list is None:
+                continue
+            comparison["compared"] += 1
+            if recorded_route_list == replayed_route_list:
+                comparison["matched"] += 1
+                continue
+            if replayed_route_list is None:
+                comparison["missing"] += 1
+            elif recorded_route_list is None:
+                comparison["extra"] += 1
+            else:
+                comparison["mismatched"] += 1
+            if len(comparison["examples"]) < TrafficReplayEnum.MAX_MISMATCH_EXAMPLES.value:
+                comparison["examples"].append({"sequence": sequence, "device_id": inbound_record.device_id,
+                                               "protocol": inbound_record.protocol,
+                                               "message": str(inbound_record.message),
+                                               "recorded": recorded_route_list, "replayed": replayed_route_list})
+        return comparison
+
+    def get_replay_result(self, replay_start_time, dry_run):
+        '''
+        :return: {"capture", "speed", "dry_run", "messages", "routing", "replay", "recorded", "sent"}
+        '''
+        replayed_latency_list = []
+        last_route_time = replay_start_time
+        with self.condition:
+            replayed_route_list = list(self.replayed_route_dict.items())
+        for sequence, (_, route_time) in replayed_route_list:
+            replayed_latency_list.append(route_time - self.inject_time_dict[sequence])
+            last_route_time = max(last_route_time, route_time)
+        recorded_latency_list = []
+        first_timestamp = last_timestamp = None
+        for sequence, inbound_record in self.recorded_inbound_dict.items():
+            if first_timestamp is None:
+                first_timestamp = last_timestamp = inbound_record.timestamp
+            routed_record = self.recorded_routed_dict.get(sequence)
+            if routed_record is not None:
+                recorded_latency_list.append(routed_record.timestamp - inbound_record.timestamp)
+                last_timestamp = max(last_timestamp, routed_record.timestamp)
+        channel_pool = self.controller.channel.channel_pool
+        return {"capture": self.capture_reader.file_path,
+                "speed": self.speed,
+                "dry_run": dry_run,
+                "messages": len(self.recorded_inbound_dict),
+                "routing": self.compare_routes(),
+                "replay": summarize_latency(replayed_latency_list, last_route_time - replay_start_time),
+                "recorded": summarize_latency(recorded_latency_list, last_timestamp - first_timestamp
+                                              if first_timestamp is not None else 0),
+                "sent": dict(channel_pool.sent_counter) if isinstance(channel_pool, DryRunChannelPool) else None}
+
+
+def summarize_latency(latency_list, duration):
+    '''
+    吞吐为完成路由的消息数除以从第一条消息进入到最后一条消息完成的时间，耗时为每条消息从进入队列到完成路由和发送
+    :return: {"routed", "duration_s", "throughput_msgs_per_s", "latency_ms"}
+    '''
+    sorted_latency_list = sorted(latency_list)
+    latency_ms = {"p50": calculate_percentile(sorted_latency_list, 0.5),
+                  "p99": calculate_percentile(sorted_latency_list, 0.99),
+                  "p999": calculate_percentile(sorted_latency_list, 0.999),
+                  "max": sorted_latency_list[-1] if sorted_latency_list else None,
+                  "mean": sum(sorted_latency_list) / len(sorted_latency_list) if sorted_latency_list else None}
+    return {"routed": len(sorted_latency_list),
+            "duration_s": round(duration, 6),
+            "throughput_msgs_per_s": round(len(sorted_latency_list) / duration, 3) if duration > 0 else None,
+            "latency_ms": {key: None if value is None else round(value * 1000, 3)
+                           for key, value in latency_ms.items()}}
+
+
+def compare_summaries(current_summary, baseline_summary):
+    '''
+    两次回放（或回放与录制）之间的吞吐和耗时差异，正数表示当前更大
+    :return: {"throughput_msgs_per_s": {...}, "latency_ms": {key: {...}}}
+    '''
+    def get_delta(current_value, baseline_value):
+        if current_value is None or baseline_value is None:
+            return {"baseline": baseline_value, "current": current_value, "delta": None, "delta_pct": None}
+        return {"baseline": baseline_value, "current": current_value,
+                "delta": round(current_value - baseline_value, 3),
+                "delta_pct": round((current_value - baseline_value) * 100 / baseline_value, 2)
+                if baseline_value else None}
+    return {"throughput_msgs_per_s": get_delta(current_summary["throughput_msgs_per_s"],
+                                               baseline_summary["throughput_msgs_per_s"]),
+            "latency_ms": {key: get_delta(current_summary["latency_ms"][key], baseline_summary["latency_ms"][key])
+                           for key in current_summary["latency_ms"]}}
+
+
+def format_replay_result(replay_result):
+    routing = replay_result["routing"]
+    line_list = ["capture: " + replay_result["capture"] + ", speed: " +
+                 (str(replay_result["speed"]) + "x" if replay_result["speed"] else "max") +
+                 ", messages: " + str(replay_result["messages"]),
+                 "routing: compared %d, matched %d, mismatched %d, missing %d, extra %d" %
+                 (routing["compared"], routing["matched"], routing["mismatched"], routing["missing"],
+                  routing["extra"])]
+    for example in routing["examples"]:
+        line_list.append("  #%d %s/%s recorded %s replayed %s" % (example["sequence"], example["protocol"],
+                                                                  example["device_id"], example["recorded"],
+                                                                  example["replayed"]))
+    line_list += ["", "%-10s %10s %12s %10s %10s %10s %10s" % ("", "routed", "msgs/s", "p50_ms", "p99_ms",
+                                                              "p999_ms", "max_ms")]
+    for name in ("recorded", "baseline", "replay"):
+        summary = replay_result.get(name)
+        if summary is None:
+            continue
+        latency_ms = summary["latency_ms"]
+        line_list.append("%-10s %10s %12s %10s %10s %10s %10s" % (
+            name, summary["routed"], summary["throughput_msgs_per_s"], latency_ms["p50"], latency_ms["p99"],
+            latency_ms["p999"], latency_ms["max"]))
+    delta = replay_result["delta"]
+    line_list.append("throughput delta vs " + replay_result["delta_against"] + ": " +
+                     str(delta["throughput_msgs_per_s"]["delta_pct"]) + "%, p99 latency delta: " +
+                     str(delta["latency_ms"]["p99"]["delta"]) + " ms")
+    return "\n".join(line_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a traffic capture through the controller and compare "
+                                                 "routing, throughput and latency")
+    parser.add_argument("capture", help="capture file written by the controller's traffic capture")
+    parser.add_argument("--speed", type=float, default=TrafficReplayEnum.SPEED.value,
+                        help="time compression factor, 0 replays as fast as the controller accepts messages")
+    parser.add_argument("--start", type=float, help="replay messages captured from this second of the capture on")
+    parser.add_argument("--end", type=float, help="replay messages captured before this second of the capture")
+    parser.add_argument("--routing-table", help="routing table file to replay against, defaults to the controller's")
+    parser.add_argument("--baseline", help="replay result json of another build to report deltas against")
+    parser.add_argument("--send", action="store_true",
+                        help="really send routed messages through the channels instead of a dry run")
+    parser.add_argument("--output", help="write the full result as json to this file")
+    parser.add_argument("--json", action="store_true", help="print the full result as json")
+    args = parser.parse_args()
+    controller = Controller()
+    if args.routing_table:
+        routing_table_loader = RoutingTableLoader(args.routing_table, controller.apply_routing_table)
+        controller.apply_routing_table(routing_table_loader.load_routing_table())
+    capture_reader = TrafficCaptureReader(args.capture)
+    try:
+        replay_result = TrafficReplayer(controller, capture_reader, args.speed).run_replay(
+            args.start, args.end, dry_run=not args.send)
+    finally:
+        capture_reader.close_reader()
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            replay_result["baseline"] = json.load(baseline_file)["replay"]
+        replay_result["delta_against"] = "baseline"
+    else:
+        replay_result["delta_against"] = "recorded"
+    replay_result["delta"] = compare_summaries(replay_result["replay"], replay_result[replay_result["delta_against"]])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(replay_result, output_file, indent=2)
+    print(json.dumps(replay_result, indent=2) if args.json else format_replay_result(replay_result))
+    sys.stdout.flush()
+    routing = replay_result["routing"]
+    if routing["mismatched"] or routing["missing"] or routing["extra"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
 import queue
 import asyncio
+import threading
 import websockets
 
-from common.message_format import MessageFormatEnum
+from common.channel_enum import MessageQueueEnum
+from common.message_codec import MessageCodec
+from common.tracing_enum import TracingEnum
+from common.websocket_enum import WebsocketClientEnum
+from common.websocket_enum import WebsocketHubEnum
+from core_services.controller_metrics import MESSAGES_SENT
+from core_services.controller_metrics import record_connection
+from core_services.websocket_client import WebSocketClient
+from core_services.websocket_hub import WebSocketHub
 from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+from util.tracing import mark_stage
+
+DROPPED_STAGE = TracingEnum.DROPPED_STAGE.value
+SUBSCRIBE_FIELD_NAME = WebsocketHubEnum.SUBSCRIBE_FIELD_NAME.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
 
 
 class WebSocketChannel:
@@ -16,75 +31,136 @@ class WebSocketChannel:
         self.port = port
         self.device_id_list = ["A"]
         self.logger = Logger("WebSocketChannel")
-        self.websocket_message_queue = queue.Queue()
+        self.websocket_message_queue = queue.Queue(maxsize=MessageQueueEnum.CHANNEL_QUEUE_SIZE.value)
+        self.message_codec = MessageCodec.get_default_codec()
+        # 同一监听地址的服务器和channel共用一个路由中心
+        self.websocket_hub = WebSocketHub.get_hub(host, port)
+        self.receive_stopped_event = threading.Event()
+        self.connected_count = 0
 
-    async def receive_message_and_reply(self, websocket):
+    async def websocket_server_receive_message_from_device(self, device_id):
         """
-        接收从客户端发来的消息并处理，再回复客户端。
+        在同一进程内订阅服务器路由中心中指定设备的上行消息，一直运行直到被取消
+        服务器不在当前进程中运行时通过持久连接远程订阅
         """
-        while True:
-            try:
-                recv_message = await websocket.recv()
-                self.logger.info("server receive message: " + recv_message)
-                await websocket.send("The server has received you message: " + recv_message)
-                return recv_message
-            except websockets.ConnectionClosed as e:
-                self.logger.info(e)
-                break
+        self.websocket_hub.subscribe(device_id, self.put_received_message)
+        self.logger.info("websocket monitor subscribes " + device_id)
+        try:
+            await self.receive_message_from_remote_hub(device_id)
+            await asyncio.Future()
+        finally:
+            self.websocket_hub.unsubscribe(device_id, self.put_received_message)
 
-    async def websocket_server_receive_message_from_device(self, device_id):
+    async def receive_message_from_remote_hub(self, device_id):
         """
-        持续监听含有特定device id的接收消息
+        当前进程中的路由中心没有运行时（例如分片工作进程），向服务器发送"subscribe: {device_id}"订阅设备的上行消息，
+        连接断开后按指数退避重连；当前进程中的路由中心开始服务后返回，改由进程内订阅接收，不会重复放入队列
         """
-        while True:
+        uri = "ws://" + self.host + ":" + str(self.port)
+        reconnect_interval = WebsocketClientEnum.RECONNECT_INTERVAL.value
+        while not self.websocket_hub.is_serving() and not self.receive_stopped_event.is_set():
             try:
-                async with websockets.connect("ws://" + self.host + ":" + str(self.port)) as websocket:
-                    recv_message = await websocket.recv()
-                    message_list = recv_message.splitlines()
-                    received_element_list = [content.split(": ", maxsplit=1)[1] for content in message_list]
-                    header = received_element_list[MessageFormatEnum.RECEIVING_HEADER_POSITION.value]
-                    if device_id == header:
-                        self.websocket_message_queue.put(recv_message)
-                        self.logger.info("websocket_message_queue newly adds: " + recv_message)
-            except websockets.ConnectionClosed as e:
-                self.logger.info(e)
+                async with websockets.connect(uri, ping_interval=WebsocketClientEnum.PING_INTERVAL.value,
+                                              ping_timeout=WebsocketClientEnum.PING_TIMEOUT.value) as websocket:
+                    await websocket.send(SUBSCRIBE_FIELD_NAME + ": " + device_id)
+                    # 服务器先回复订阅结果，之后才推送订阅后的上行消息
+                    await websocket.recv()
+                    record_connection("WebSocket", uri, self.connected_count > 0)
+                    self.connected_count += 1
+                    reconnect_interval = WebsocketClientEnum.RECONNECT_INTERVAL.value
+                    self.logger.info("websocket monitor subscribes " + device_id + " from " + uri)
+                    async for message in websocket:
+                        if self.websocket_hub.is_serving() or self.receive_stopped_event.is_set():
+                            break
+                        self.put_received_message(MESSAGE_TRACER.start_trace(message, "WebSocket", device_id))
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                self.logger.error("websocket monitor of " + device_id + " to " + uri + " failed for " + str(e))
+            if self.websocket_hub.is_serving() or self.receive_stopped_event.is_set():
                 break
+            await asyncio.sleep(reconnect_interval)
+            reconnect_interval = min(reconnect_interval * 2, WebsocketClientEnum.MAX_RECONNECT_INTERVAL.value)
 
-    async def send_message_to_websocket_server(self, command, receiver_device_id):
+    def put_received_message(self, message):
         """
-        向服务器端发送消息
+        路由中心推送消息的回调，在服务器的事件循环中执行，队列满时丢弃消息而不阻塞服务器
         """
         try:
-            async with websockets.connect("ws://" + self.host + ":" + str(self.port)) as websocket:
-                message = f"command: {command}\r\nprotocol: WebSocket\r\nreceiver: {receiver_device_id}"
-                await websocket.send(message)
-                recv_message = await websocket.recv()
-                self.logger.info("receive message from server :" + recv_message)
-                await websocket.close(reason="exit")  # 关闭本次连接
-                return True
-        except ConnectionRefusedError as e:
-            self.logger.error(e)
+            self.websocket_message_queue.put_nowait(message)
+        except queue.Full:
+            self.logger.error("websocket_message_queue is full, drop message: " + str(message))
+            mark_stage(message, DROPPED_STAGE)
+            MESSAGE_TRACER.finish_trace(message)
+
+    async def send_message_to_websocket_server(self, command, receiver_device_id):
+        """
+        向服务器端发送消息，服务器在当前进程中运行时直接推送给设备连接
+        """
+        if self.websocket_hub.is_serving():
+            return self.send_message_through_local_hub(command, receiver_device_id)
+        message = self.message_codec.encode_message(command, "WebSocket", receiver_device_id)
+        delivered = await WebSocketClient.get_client(self.host, self.port).send_message_async(message)
+        self.record_remote_send_result(receiver_device_id, delivered)
+        return delivered
+
+    def send_message_through_local_hub(self, command, receiver_device_id):
+        """
+        通过当前进程中的路由中心推送给设备连接，不建立新的连接
+        """
+        message = self.message_codec.encode_message(command, "WebSocket", receiver_device_id)
+        if not self.websocket_hub.send_to_device(receiver_device_id, message):
+            self.logger.error(receiver_device_id + " is not connected to websocket hub")
             return False
+        MESSAGES_SENT.labels("WebSocket", receiver_device_id).inc()
+        return True
 
     async def start_websocket_server(self):
         """
         启动服务器进程保持一直运行
         """
-        async with websockets.serve(self.receive_message_and_reply, self.host, self.port):
-            await asyncio.Future()
+        await self.websocket_hub.serve_forever()
+
+    def asyncio_run_websocket_server(self):
+        """
+        在当前线程中运行事件循环并启动服务器，一直运行
+        """
+        asyncio.run(self.start_websocket_server())
 
     def asyncio_run_send_message_to_websocket_server(self, command, receiver_device_id):
         """
-        异步运行发送信息的函数
+        同步发送信息，服务器在当前进程中运行时直接推送，否则通过持久化连接发送，都不需要为每次发送运行事件循环
         """
-        asyncio.run(self.send_message_to_websocket_server(command, receiver_device_id))
+        if self.websocket_hub.is_serving():
+            return self.send_message_through_local_hub(command, receiver_device_id)
+        message = self.message_codec.encode_message(command, "WebSocket", receiver_device_id)
+        delivered = WebSocketClient.get_client(self.host, self.port).send_message(message)
+        self.record_remote_send_result(receiver_device_id, delivered)
+        return delivered
+
+    def record_remote_send_result(self, receiver_device_id, delivered):
+        if delivered:
+            MESSAGES_SENT.labels("WebSocket", receiver_device_id).inc()
+        else:
+            self.logger.error(receiver_device_id + " is not connected to websocket server")
 
     def asyncio_run_receive_message_from_device(self, device_id):
         """
-        异步运行接收信息的函数
+        订阅指定设备的上行消息并阻塞，路由中心在服务器的事件循环中推送消息，不需要单独运行事件循环
+        服务器不在当前进程中运行时，在当前线程中运行事件循环远程订阅
         """
         self.logger.info("websocket monitor start!")
-        asyncio.run(self.websocket_server_receive_message_from_device(device_id))
+        self.websocket_hub.subscribe(device_id, self.put_received_message)
+        try:
+            if not self.websocket_hub.is_serving():
+                asyncio.run(self.receive_message_from_remote_hub(device_id))
+            self.receive_stopped_event.wait()
+        finally:
+            self.websocket_hub.unsubscribe(device_id, self.put_received_message)
+
+    def close_channel(self):
+        """
+        停止接收消息
+        """
+        self.receive_stopped_event.set()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+import websockets
+
+from common.exception import CommonError
+from common.websocket_enum import WebsocketClientEnum
+from common.websocket_enum import WebsocketEnum
+from common.websocket_enum import WebsocketHubEnum
+from core_services.controller_metrics import record_connection
+from core_services.websocket_hub import add_correlation_id
+from core_services.websocket_hub import split_correlation_id
+from util.logger_manager_ment import Logger
+
+UNDELIVERED_PREFIX = WebsocketHubEnum.UNDELIVERED_FIELD_NAME.value + ":"
+
+
+class WebSocketClient:
+    # 每个服务器只保留一个持久化连接，key为(host, port)
+    client_dict = {}
+    client_dict_lock = threading.Lock()
+
+    def __init__(self, host, port, ping_interval=WebsocketClientEnum.PING_INTERVAL.value,
+                 ping_timeout=WebsocketClientEnum.PING_TIMEOUT.value,
+                 reconnect_interval=WebsocketClientEnum.RECONNECT_INTERVAL.value,
+                 max_reconnect_interval=WebsocketClientEnum.MAX_RECONNECT_INTERVAL.value,
+                 max_inflight_requests=WebsocketClientEnum.MAX_INFLIGHT_REQUESTS.value):
+        '''
+        到WebSocket服务器的持久化客户端连接，连接和心跳运行在独立线程的事件循环中，断开后自动重连
+        多条消息复用同一个连接，每条消息带一个关联编号，按编号把服务器的回复交给对应的future，
+        每条消息只需要发送一帧，不再每次握手建立连接
+        :return:
+        '''
+        self.host = host
+        self.port = port
+        self.uri = "ws://" + host + ":" + str(port)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect_interval = reconnect_interval
+        self.max_reconnect_interval = max_reconnect_interval
+        self.logger = Logger("WebSocketClient")
+        self.loop = None
+        self.loop_thread = None
+        self.websocket = None
+        self.connected_event = None
+        self.connection_task = None
+        self.correlation_id_counter = itertools.count(1)
+        # 已发出等待回复的消息，key为关联编号
+        self.inflight_future_dict = {}
+        self.inflight_semaphore = threading.BoundedSemaphore(max_inflight_requests)
+        self.started_event = threading.Event()
+        self.closed = False
+        self.connected_count = 0
+
+    @classmethod
+    def get_client(cls, host, port):
+        '''
+        获取指定服务器的持久化连接，不存在时创建并启动
+        :return: client
+        '''
+        client_key = (host, port)
+        with cls.client_dict_lock:
+            client = cls.client_dict.get(client_key)
+            if client is None:
+                client = cls(host, port)
+                client.start_client()
+                cls.client_dict[client_key] = client
+            return client
+
+    @classmethod
+    def close_all_clients(cls):
+        with cls.client_dict_lock:
+            client_list = list(cls.client_dict.values())
+            cls.client_dict.clear()
+        for client in client_list:
+            client.close_client()
+
+    def start_client(self):
+        '''
+        拉起事件循环线程并开始连接
+        :return:
+        '''
+        self.loop_thread = threading.Thread(target=self.run_loop, name="websocket-client-" + self.uri, daemon=True)
+        self.loop_thread.start()
+        self.started_event.wait()
+
+    def run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connected_event = asyncio.Event()
+        self.connection_task = self.loop.create_task(self.keep_connection())
+        self.started_event.set()
+        try:
+            self.loop.run_until_complete(self.connection_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def close_client(self):
+        '''
+        断开连接并停止事件循环，等待回复的消息全部失败
+        :return:
+        '''
+        self.closed = True
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.connection_task.cancel)
+        if self.loop_thread is not None:
+            self.loop_thread.join()
+        self.fail_inflight_requests(CommonError("websocket client to " + self.uri + " closed"))
+
+    def is_connected(self):
+        websocket = self.websocket
+        return websocket is not None and websocket.open
+
+    async def keep_connection(self):
+        '''
+        保持连接：连接断开或失败后按指数退避重连
+        :return:
+        '''
+        reconnect_interval = self.reconnect_interval
+        while True:
+            try:
+                async with websockets.connect(self.uri, ping_interval=self.ping_interval,
+                                              ping_timeout=self.ping_timeout) as websocket:
+                    self.websocket = websocket
+                    self.connected_event.set()
+                    self.logger.info("websocket client connected to " + self.uri)
+                    record_connection("WebSocket", self.uri, self.connected_count > 0)
+                    self.connected_count += 1
+                    reconnect_interval = self.reconnect_interval
+                    await self.read_replies(websocket)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                self.logger.error("websocket client to " + self.uri + " failed for " + str(e))
+            finally:
+                self.websocket = None
+                self.connected_event.clear()
+            # 连接断开时已发出的消息不会再收到回复
+            self.fail_inflight_requests(CommonError("websocket connection to " + self.uri + " lost"))
+            await asyncio.sleep(reconnect_interval)
+            reconnect_interval = min(reconnect_interval * 2, self.max_reconnect_interval)
+
+    async def read_replies(self, websocket):
+        async for reply in websocket:
+            correlation_id, reply_body = split_correlation_id(reply)
+            future = self.inflight_future_dict.pop(correlation_id, None)
+            if future is not None:
+                self.complete_request(future, result=not reply_body.startswith(UNDELIVERED_PREFIX))
+
+    def fail_inflight_requests(self, error):
+        inflight_future_dict, self.inflight_future_dict = self.inflight_future_dict, {}
+        for future in inflight_future_dict.values():
+            self.complete_request(future, error=error)
+
+    @staticmethod
+    def complete_request(future, result=None, error=None):
+        '''
+        设置消息的结果，调用方可能已经在其他线程超时取消
+        :return:
+        '''
+        try:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    async def send_frame(self, message, future, timeout):
+        '''
+        在客户端事件循环中发送一帧，未连接时等待重连
+        :return:
+        '''
+        try:
+            await asyncio.wait_for(self.connected_event.wait(), timeout)
+            # 等待连接期间调用方已经超时放弃
+            if future.done():
+                return
+            correlation_id = str(next(self.correlation_id_counter))
+            self.inflight_future_dict[correlation_id] = future
+            await self.websocket.send(add_correlation_id(correlation_id, message))
+        except Exception as e:
+            if future.done():
+                return
+            self.discard_request(future)
+            self.complete_request(future, error=CommonError("send to " + self.uri + " failed for " + repr(e)))
+
+    def discard_request(self, future):
+        '''
+        不再等待某条消息的回复，在客户端事件循环中调用
+        :return:
+        '''
+        for correlation_id, inflight_future in list(self.inflight_future_dict.items()):
+            if inflight_future is future:
+                del self.inflight_future_dict[correlation_id]
+                break
+
+    def release_inflight_slot(self, future):
+        self.inflight_semaphore.release()
+
+    def cancel_request(self, future):
+        future.cancel()
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.discard_request, future)
+
+    def submit_message(self, message, timeout):
+        '''
+        将消息交给客户端事件循环发送，等待回复的消息过多时阻塞
+        :return: concurrent.futures.Future，结果为服务器是否已把消息投递给设备
+        '''
+        if not self.inflight_semaphore.acquire(timeout=timeout):
+            raise CommonError("too many inflight messages to " + self.uri)
+        return self.create_request(message, timeout)
+
+    def create_request(self, message, timeout):
+        if self.closed:
+            self.inflight_semaphore.release()
+            raise CommonError("websocket client to " + self.uri + " is closed")
+        future = concurrent.futures.Future()
+        # 无论收到回复、失败还是超时取消，future完成时归还名额
+        future.add_done_callback(self.release_inflight_slot)
+        asyncio.run_coroutine_threadsafe(self.send_frame(message, future, timeout), self.loop)
+        return future
+
+    def send_message(self, message, timeout=WebsocketEnum.WEBSOCKET_TIMEOUT_ENUM.value):
+        '''
+        同步发送，阻塞到收到服务器回复
+        :return: 服务器是否已把消息投递给设备
+        '''
+        future = self.submit_message(message, timeout)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.cancel_request(future)
+            raise CommonError("wait for reply from " + self.uri + " timeout")
+
+    async def send_message_async(self, message, timeout=WebsocketEnum.WEBSOCKET_TIMEOUT_ENUM.value):
+        '''
+        异步发送，可以在任意事件循环中await
+        :return: 服务器是否已把消息投递给设备
+        '''
+        if self.inflight_semaphore.acquire(blocking=False):
+            future = self.create_request(message, timeout)
+        else:
+            # 等待回复的消息过多时，放到默认线程池中等待名额，不阻塞调用方的事件循环
+            future = await asyncio.get_running_loop().run_in_executor(None, self.submit_message, message, timeout)
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            self.cancel_request(future)
+            raise CommonError("wait for reply from " + self.uri + " timeout")
@@ -0,0 +1,300 @@
+import asyncio
+import threading
+import concurrent.futures
+import websockets
+
+from common.exception import DeviceCommandError
+from common.message_codec import MessageCodec
+from common.websocket_enum import WebsocketHubEnum
+from core_services.controller_metrics import MESSAGES_RECEIVED
+from util.logger_manager_ment import Logger
+from util.tracing import MessageTracer
+
+REGISTER_FIELD_NAME = WebsocketHubEnum.REGISTER_FIELD_NAME.value
+SUBSCRIBE_FIELD_NAME = WebsocketHubEnum.SUBSCRIBE_FIELD_NAME.value
+SUBSCRIBE_ALL = WebsocketHubEnum.SUBSCRIBE_ALL.value
+CORRELATION_FIELD_NAME = WebsocketHubEnum.CORRELATION_FIELD_NAME.value
+DELIVERED_FIELD_NAME = WebsocketHubEnum.DELIVERED_FIELD_NAME.value
+UNDELIVERED_FIELD_NAME = WebsocketHubEnum.UNDELIVERED_FIELD_NAME.value
+MESSAGE_TRACER = MessageTracer.get_default_tracer()
+
+
+def add_correlation_id(correlation_id, message):
+    '''
+    在消息前加一行关联编号
+    :return: message
+    '''
+    prefix = CORRELATION_FIELD_NAME + ": " + str(correlation_id) + "\r\n"
+    return prefix.encode() + message if isinstance(message, bytes) else prefix + message
+
+
+def split_correlation_id(message):
+    '''
+    拆出消息第一行的关联编号
+    :return: (correlation_id, message)，不带关联编号时correlation_id为None
+    '''
+    prefix = CORRELATION_FIELD_NAME + ":"
+    if isinstance(message, bytes):
+        if not message.startswith(prefix.encode()):
+            return None, message
+        first_line, _, rest = message.partition(b"\r\n")
+        return first_line[len(prefix):].decode().strip(), rest
+    if not message.startswith(prefix):
+        return None, message
+    first_line, _, rest = message.partition("\r\n")
+    return first_line[len(prefix):].strip(), rest
+
+
+class WebSocketSession:
+    def __init__(self, websocket, send_queue_size):
+        '''
+        服务器上的一个客户端连接，发给该连接的消息先进入发送队列，由独立的写协程按顺序发出，
+        一个连接发送慢不会阻塞其他连接
+        :return:
+        '''
+        self.websocket = websocket
+        self.device_id = None
+        # 该连接作为订阅者订阅的设备ID
+        self.subscription_list = []
+        self.send_queue = asyncio.Queue(maxsize=send_queue_size)
+        self.dropped_count = 0
+        self.writer_task = None
+
+    def enqueue_message(self, message):
+        '''
+        消息加入发送队列，必须在服务器的事件循环中调用
+        :return: 是否入队成功
+        '''
+        try:
+            self.send_queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped_count += 1
+            return False
+
+    async def write_messages(self):
+        while True:
+            message = await self.send_queue.get()
+            try:
+                await self.websocket.send(message)
+            except websockets.ConnectionClosed:
+                break
+
+
+class WebSocketHub:
+    # 每个监听地址只有一个路由中心，key为(host, port)
+    hub_dict = {}
+    hub_dict_lock = threading.Lock()
+
+    def __init__(self, host, port, send_queue_size=WebsocketHubEnum.SEND_QUEUE_SIZE.value):
+        '''
+        WebSocket服务器的路由中心：设备在持久连接上登记一次自身的ID，
+        设备的上行消息推送给订阅该设备的进程内回调和远程订阅者，下行消息通过设备连接的发送队列推送给设备
+        控制器在同一进程内直接订阅，不再通过回环连接轮询服务器
+        :return:
+        '''
+        self.host = host
+        self.port = port
+        self.send_queue_size = send_queue_size
+        self.logger = Logger("WebSocketHub")
+        self.message_codec = MessageCodec.get_default_codec()
+        self.loop = None
+        self.server = None
+        # device_id -> 设备连接
+        self.device_session_dict = {}
+        # device_id -> (callback, ...)，写时复制，推送消息时不需要加锁
+        self.subscriber_dict = {}
+        self.subscriber_lock = threading.Lock()
+        self.stopped_future = concurrent.futures.Future()
+
+    @classmethod
+    def get_hub(cls, host, port):
+        '''
+        获取指定监听地址的路由中心，不存在时创建；订阅可以在服务器启动前进行
+        :return: hub
+        '''
+        hub_key = (host, port)
+        with cls.hub_dict_lock:
+            hub = cls.hub_dict.get(hub_key)
+            if hub is None:
+                hub = cls(host, port)
+                cls.hub_dict[hub_key] = hub
+            return hub
+
+    async def start_hub(self):
+        '''
+        在当前事件循环中开始监听
+        :return:
+        '''
+        self.loop = asyncio.get_running_loop()
+        if self.stopped_future.done():
+            self.stopped_future = concurrent.futures.Future()
+        self.server = await websockets.serve(self.handle_connection, self.host, self.port)
+        self.logger.info("websocket hub listening on " + self.host + ":" + str(self.port))
+
+    async def serve_forever(self):
+        '''
+        开始监听并一直运行，退出时关闭所有连接
+        :return:
+        '''
+        await self.start_hub()
+        try:
+            await self.server.wait_closed()
+        finally:
+            self.server.close()
+            self.server = None
+            self.loop = None
+            self.stopped_future.set_result(True)
+
+    def stop_hub(self):
+        '''
+        停止监听，可以在任意线程调用
+        :return:
+        '''
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.server.close)
+
+    def is_serving(self):
+        server = self.server
+        return server is not None and server.is_serving()
+
+    def subscribe(self, device_id, callback):
+        '''
+        订阅设备的上行消息，device_id为SUBSCRIBE_ALL时订阅所有设备；callback在服务器的事件循环中调用，不能阻塞
+        :return:
+        '''
+        with self.subscriber_lock:
+            self.subscriber_dict[device_id] = self.subscriber_dict.get(device_id, ()) + (callback,)
+
+    def unsubscribe(self, device_id, callback):
+        with self.subscriber_lock:
+            callback_tuple = tuple(registered_callback for registered_callback in self.subscriber_dict.get(device_id, ())
+                                   if registered_callback != callback)
+            if callback_tuple:
+                self.subscriber_dict[device_id] = callback_tuple
+            else:
+                self.subscriber_dict.pop(device_id, None)
+
+    def publish_upstream(self, device_id, message):
+        '''
+        将设备的上行消息推送给所有订阅者
+        :return:
+        '''
+        MESSAGES_RECEIVED.labels("WebSocket", device_id).inc()
+        message = MESSAGE_TRACER.start_trace(message, "WebSocket", device_id)
+        for callback in self.subscriber_dict.get(device_id, ()) + self.subscriber_dict.get(SUBSCRIBE_ALL, ()):
+            try:
+                callback(message)
+            except Exception as e:
+                self.logger.error("websocket subscriber of " + str(device_id) + " failed for " + str(e))
+
+    def send_to_device(self, device_id, message):
+        '''
+        向已登记的设备推送下行消息，可以在任意线程调用
+        :return: 设备当前是否在线
+        '''
+        loop = self.loop
+        if loop is None or device_id not in self.device_session_dict:
+            return False
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            return self.enqueue_to_device(device_id, message)
+        loop.call_soon_threadsafe(self.enqueue_to_device, device_id, message)
+        return True
+
+    def enqueue_to_device(self, device_id, message):
+        session = self.device_session_dict.get(device_id)
+        if session is None:
+            return False
+        if not session.enqueue_message(message):
+            if session.dropped_count % 1000 == 1:
+                self.logger.warning("send queue of " + device_id + " is full, dropped " +
+                                    str(session.dropped_count) + " messages")
+            return False
+        return True
+
+    async def handle_connection(self, websocket):
+        '''
+        服务器处理单个连接：读取该连接上的所有消息，连接断开时注销登记和订阅
+        :return:
+        '''
+        session = WebSocketSession(websocket, self.send_queue_size)
+        session.writer_task = asyncio.ensure_future(session.write_messages())
+        try:
+            async for message in websocket:
+                self.handle_message(session, message)
+        except websockets.ConnectionClosed as e:
+            self.logger.info(e)
+        finally:
+            session.writer_task.cancel()
+            if session.device_id is not None and self.device_session_dict.get(session.device_id) is session:
+                del self.device_session_dict[session.device_id]
+                self.logger.info("device " + session.device_id + " disconnected from websocket hub")
+            for device_id in session.subscription_list:
+                self.unsubscribe(device_id, session.enqueue_message)
+
+    def handle_message(self, session, message):
+        if session.device_id is not None:
+            self.publish_upstream(session.device_id, message)
+            return
+        control_field, control_value = self.parse_control_message(message)
+        if control_field == REGISTER_FIELD_NAME:
+            self.register_device(session, control_value)
+            session.enqueue_message("registered: " + control_value)
+            return
+        if control_field == SUBSCRIBE_FIELD_NAME:
+            self.subscribe(control_value, session.enqueue_message)
+            session.subscription_list.append(control_value)
+            session.enqueue_message("subscribed: " + control_value)
+            return
+        correlation_id, message = split_correlation_id(message)
+        try:
+            device_message = self.message_codec.decode_message(message)
+        except DeviceCommandError as e:
+            self.logger.error("Invalid message: " + str(e))
+            return
+        if device_message.header is not None:
+            self.register_device(session, device_message.header)
+            self.publish_upstream(device_message.header, message)
+            return
+        # 不带header的消息是发给设备的下行消息，回复投递结果
+        result_field = DELIVERED_FIELD_NAME if self.enqueue_to_device(device_message.receiver, message) \
+            else UNDELIVERED_FIELD_NAME
+        reply = result_field + ": " + str(device_message.receiver)
+        if correlation_id is not None:
+            reply = CORRELATION_FIELD_NAME + ": " + correlation_id + "\r\n" + reply
+        session.enqueue_message(reply)
+
+    @staticmethod
+    def parse_control_message(message):
+        '''
+        解析登记和订阅消息
+        :return: (field, value)，不是登记或订阅消息时返回(None, None)
+        '''
+        if not isinstance(message, str) or "\n" in message:
+            return None, None
+        field, separator, value = message.partition(":")
+        field = field.strip()
+        if not separator or field not in (REGISTER_FIELD_NAME, SUBSCRIBE_FIELD_NAME) or not value.strip():
+            return None, None
+        return field, value.strip()
+
+    def register_device(self, session, device_id):
+        previous_session = self.device_session_dict.get(device_id)
+        if previous_session is not None and previous_session is not session:
+            self.logger.warning("device " + device_id + " registered again, replace the previous connection")
+        session.device_id = device_id
+        self.device_session_dict[device_id] = session
+        self.logger.info("device " + device_id + " registered to websocket hub")
+
+    def get_hub_stats(self):
+        '''
+        各在线设备连接发送队列的深度和丢弃数量
+        :return: {device_id: {...}}
+        '''
+        return {device_id: {"depth": session.send_queue.qsize(), "dropped": session.dropped_count}
+                for device_id, session in list(self.device_session_dict.items())}
@@ -0,0 +1,57 @@
+import unittest
+
+from common.message_codec import MessageCodec
+from core_services.message_dedup import MessageDeduplicator
+from util.ttl_cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_refresh_on_hit_extends_ttl(self):
+        clock = FakeClock()
+        ttl_cache = TTLCache(10, 1, clock=clock)
+        self.assertFalse(ttl_cache.check_and_add("a"))
+        for _ in range(3):
+            clock.now += 0.6
+            self.assertTrue(ttl_cache.check_and_add("a"))
+
+    def test_first_seen_ttl_is_not_extended(self):
+        clock = FakeClock()
+        ttl_cache = TTLCache(10, 1, clock=clock, refresh_on_hit=False)
+        self.assertFalse(ttl_cache.check_and_add("a"))
+        clock.now += 0.6
+        self.assertTrue(ttl_cache.check_and_add("a"))
+        clock.now += 0.6
+        self.assertFalse(ttl_cache.check_and_add("a"))
+
+
+class MessageDeduplicatorTest(unittest.TestCase):
+    def test_content_is_keyed_by_sender(self):
+        message_deduplicator = MessageDeduplicator(dedup_by_content=True)
+        message = "header: A\r\ncommand: template1\r\nprotocol: MQTT\r\nreceiver: B"
+        self.assertFalse(message_deduplicator.is_duplicate(message))
+        self.assertTrue(message_deduplicator.is_duplicate(message.encode()))
+        self.assertFalse(message_deduplicator.is_duplicate(message.replace("header: A", "header: C")))
+
+    def test_binary_message_id(self):
+        message_codec = MessageCodec(["A", "B", "template1"])
+        message_deduplicator = MessageDeduplicator()
+        first = message_codec.encode_binary_message("template1", "MQTT", "B", header="A", message_id="42")
+        self.assertEqual(MessageCodec.get_message_id(first)[1], MessageCodec.split_binary_fields(first)[4])
+        self.assertFalse(message_deduplicator.is_duplicate(first))
+        self.assertTrue(message_deduplicator.is_duplicate(first))
+        other = message_codec.encode_binary_message("template1", "MQTT", "B", header="A", message_id="43")
+        self.assertFalse(message_deduplicator.is_duplicate(other))
+        # 不识别message_id标记的解码方式仍能解出原有字段
+        self.assertEqual(message_codec.decode_message(first)[:4], ("A", "template1", "MQTT", "B"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from common.exception import DeviceCommandError
+from core_services.routing_table import RoutingTableLoader
+
+ROUTES = {"A": {"template1": {"protocol": "MQTT", "next_command": "template2"}}}
+
+
+class RoutingTableReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "routing_table.json")
+        self.write_routing_table(["A"])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_routing_table(self, device_id_list):
+        with open(self.file_path, "w", encoding="utf-8") as routing_file:
+            json.dump({"devices": device_id_list, "routes": ROUTES}, routing_file)
+        # 保证修改时间变化，不依赖文件系统的时间精度
+        modified_time = os.stat(self.file_path).st_mtime_ns + 1000000000
+        os.utime(self.file_path, ns=(modified_time, modified_time))
+
+    def test_failed_reload_callback_keeps_watching(self):
+        applied_list = []
+
+        def on_reload(routing_table):
+            if "B" in routing_table.device_id_set:
+                raise DeviceCommandError("Too many symbols for binary message format!")
+            applied_list.append(routing_table.device_id_list)
+
+        loader = RoutingTableLoader(self.file_path, on_reload)
+        loader.load_routing_table()
+        self.write_routing_table(["A", "B"])
+        self.assertFalse(loader.reload_if_modified())
+        self.write_routing_table(["A", "C"])
+        self.assertTrue(loader.reload_if_modified())
+        self.assertEqual(applied_list, [("A", "C")])
+
+
+if __name__ == "__main__":
+    unittest.main()
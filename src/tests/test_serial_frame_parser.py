@@ -0,0 +1,42 @@
+import unittest
+
+from common.message_codec import MessageCodec
+from common.modbus_enum import ModbusSerialEnum
+from core_services.serial_frame_parser import SerialFrameParser
+
+DELIMITER = ModbusSerialEnum.TEXT_FRAME_DELIMITER.value
+
+
+class SerialFrameParserOverflowTest(unittest.TestCase):
+    def test_oversized_text_frame_is_dropped_entirely(self):
+        parser = SerialFrameParser("text", buffer_size=32)
+        frame_list = parser.feed(b"a" * 32 + b"cccccccc" + DELIMITER + b"next" + DELIMITER)
+        self.assertEqual(frame_list, [b"next"])
+        self.assertEqual(parser.dropped_byte_count, 40 + len(DELIMITER))
+
+    def test_oversized_text_frame_split_across_reads(self):
+        parser = SerialFrameParser("text", buffer_size=32)
+        frame_list = []
+        for chunk in (b"a" * 20, b"b" * 20, b"c" * 6 + DELIMITER[:2], DELIMITER[2:] + b"next", DELIMITER):
+            frame_list.extend(parser.feed(chunk))
+        self.assertEqual(frame_list, [b"next"])
+
+    def test_oversized_binary_frame_is_skipped_by_length(self):
+        message_codec = MessageCodec()
+        binary_frame = message_codec.encode_binary_message("c" * 40, "Modbus", "A", header="A")
+        parser = SerialFrameParser("text", buffer_size=32)
+        frame_list = parser.feed(binary_frame + b"next" + DELIMITER)
+        self.assertEqual(frame_list, [b"next"])
+        self.assertEqual(parser.dropped_byte_count, len(binary_frame))
+
+    def test_frames_within_buffer_are_unaffected(self):
+        parser = SerialFrameParser("text", buffer_size=32)
+        frame_list = []
+        for _ in range(10):
+            frame_list.extend(parser.feed(b"frame" + DELIMITER))
+        self.assertEqual(frame_list, [b"frame"] * 10)
+        self.assertEqual(parser.dropped_byte_count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import random
+
+
+class ExponentialBackoff(object):
+    def __init__(self, min_delay, max_delay, multiplier=2, random_func=random.random):
+        '''
+        带随机抖动的指数退避：第n次等待的上限为min_delay * multiplier ** n，不超过max_delay，
+        实际等待时间在上限的一半到全部之间随机，避免大量客户端在服务恢复时同时重连
+        :return:
+        '''
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.random_func = random_func
+        self.attempt_count = 0
+
+    def next_delay(self):
+        '''
+        计算下一次重试前的等待时间
+        :return: 等待时间（秒）
+        '''
+        delay = min(self.max_delay, self.min_delay * self.multiplier ** min(self.attempt_count, 64))
+        self.attempt_count += 1
+        return delay / 2 + delay / 2 * self.random_func()
+
+    def reset(self):
+        self.attempt_count = 0
@@ -0,0 +1,122 @@
+import time
+import threading
+
+from common.controller_enum import CircuitBreakerEnum
+from util.backoff import ExponentialBackoff
+from util.logger_manager_ment import Logger
+
+CLOSED_STATE = CircuitBreakerEnum.CLOSED_STATE.value
+HALF_OPEN_STATE = CircuitBreakerEnum.HALF_OPEN_STATE.value
+OPEN_STATE = CircuitBreakerEnum.OPEN_STATE.value
+
+
+class CircuitBreaker(object):
+    # 每个endpoint一个熔断器，发送和监听共用，key为名称
+    circuit_breaker_dict = {}
+    circuit_breaker_dict_lock = threading.Lock()
+
+    def __init__(self, name, failure_threshold=CircuitBreakerEnum.FAILURE_THRESHOLD.value,
+                 open_time=CircuitBreakerEnum.OPEN_TIME.value, max_open_time=CircuitBreakerEnum.MAX_OPEN_TIME.value,
+                 enabled=CircuitBreakerEnum.CIRCUIT_BREAKER_ENABLED.value, clock=time.monotonic):
+        '''
+        熔断器：连续失败failure_threshold次后断开，断开期间拒绝请求；断开时间到后进入半开状态放行一次试探，
+        试探成功时闭合，失败时重新断开且断开时间按指数退避增加
+        :return:
+        '''
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_backoff = ExponentialBackoff(open_time, max_open_time)
+        self.enabled = enabled
+        self.clock = clock
+        self.logger = Logger("CircuitBreaker")
+        self.state = CLOSED_STATE
+        self.failure_count = 0
+        # 断开状态下为重新放行的时间，半开状态下为试探超时后允许再次试探的时间
+        self.retry_time = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_circuit_breaker(cls, name):
+        '''
+        获取指定endpoint的熔断器，不存在时创建
+        :return: circuit_breaker
+        '''
+        circuit_breaker = cls.circuit_breaker_dict.get(name)
+        if circuit_breaker is not None:
+            return circuit_breaker
+        with cls.circuit_breaker_dict_lock:
+            circuit_breaker = cls.circuit_breaker_dict.get(name)
+            if circuit_breaker is None:
+                circuit_breaker = cls(name)
+                cls.circuit_breaker_dict[name] = circuit_breaker
+            return circuit_breaker
+
+    @classmethod
+    def get_circuit_states(cls):
+        '''
+        所有熔断器的当前状态
+        :return: {name: state}
+        '''
+        return {name: circuit_breaker.state for name, circuit_breaker in list(cls.circuit_breaker_dict.items())}
+
+    def allow_request(self):
+        '''
+        判断当前是否允许访问该endpoint，半开状态下只有第一次调用会被放行
+        :return:
+        '''
+        if self.state == CLOSED_STATE:
+            return True
+        with self.lock:
+            if self.state == CLOSED_STATE:
+                return True
+            now = self.clock()
+            if now < self.retry_time:
+                return False
+            if self.state == OPEN_STATE:
+                self.state = HALF_OPEN_STATE
+                self.logger.info("circuit " + self.name + " half open, probing")
+            # 试探一直没有结果时，经过一个断开时间后允许再次试探
+            self.retry_time = now + self.open_backoff.min_delay
+            return True
+
+    def get_remaining_open_time(self):
+        '''
+        距离允许下一次试探的时间
+        :return: 秒，闭合时为0
+        '''
+        if self.state == CLOSED_STATE:
+            return 0
+        return max(0, self.retry_time - self.clock())
+
+    def record_success(self):
+        if self.state == CLOSED_STATE and self.failure_count == 0:
+            return
+        with self.lock:
+            if self.state != CLOSED_STATE:
+                self.logger.info("circuit " + self.name + " closed")
+            self.state = CLOSED_STATE
+            self.failure_count = 0
+            self.open_backoff.reset()
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.failure_count += 1
+            # 断开前已经发出的请求失败时不再延长断开时间
+            if self.state == OPEN_STATE or \
+                    (self.state == CLOSED_STATE and self.failure_count < self.failure_threshold):
+                return
+            open_time = self.open_backoff.next_delay()
+            self.retry_time = self.clock() + open_time
+            self.state = OPEN_STATE
+            self.logger.warning("circuit " + self.name + " opened after " + str(self.failure_count) +
+                                " failures, retry after " + str(round(open_time, 2)) + "s")
+
+
+def get_endpoint_circuit_breaker(protocol, endpoint):
+    '''
+    获取协议endpoint的熔断器，名称为protocol/endpoint，endpoint与连接指标中的一致
+    :return: circuit_breaker
+    '''
+    return CircuitBreaker.get_circuit_breaker(protocol + "/" + endpoint)
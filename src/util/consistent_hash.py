@@ -0,0 +1,46 @@
+import bisect
+import hashlib
+
+from common.exception import ConfigError
+
+
+class ConsistentHashRing(object):
+    def __init__(self, node_list, virtual_node_number=160):
+        '''
+        一致性哈希环，每个节点在环上对应多个虚拟节点，节点增减时只会迁移少量key
+        :param node_list: 节点列表，节点需要能被str()转换为唯一的字符串
+        :param virtual_node_number: 每个节点的虚拟节点数量
+        '''
+        if not node_list:
+            raise ConfigError("ConsistentHashRing needs at least one node!")
+        self.virtual_node_number = virtual_node_number
+        ring_point_list = []
+        for node in node_list:
+            for index in range(virtual_node_number):
+                ring_point_list.append((self.hash_key(str(node) + "#" + str(index)), node))
+        ring_point_list.sort(key=lambda ring_point: ring_point[0])
+        self.ring_hash_list = [ring_point[0] for ring_point in ring_point_list]
+        self.ring_node_list = [ring_point[1] for ring_point in ring_point_list]
+
+    @staticmethod
+    def hash_key(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get_node(self, key):
+        '''
+        获取key所属的节点，即环上顺时针方向的第一个虚拟节点
+        '''
+        index = bisect.bisect(self.ring_hash_list, self.hash_key(str(key)))
+        if index == len(self.ring_hash_list):
+            index = 0
+        return self.ring_node_list[index]
+
+    def partition(self, key_list):
+        '''
+        将key列表按所属节点分组
+        :return: {node: [key, ...]}
+        '''
+        node_key_dict = {}
+        for key in key_list:
+            node_key_dict.setdefault(self.get_node(key), []).append(key)
+        return node_key_dict
@@ -1,52 +1,228 @@
 import time
 import os
+import sys
+import atexit
+import threading
+import collections
 
 from common.exception import CommonError
+from common.log_enum import LogEnum
+from common.log_enum import LogLevelEnum
+
+# 级别判断在每次调用日志时执行，枚举取值较慢，预先取出
+DEBUG_LEVEL_VALUE = LogLevelEnum.debug.value
+INFO_LEVEL_VALUE = LogLevelEnum.info.value
+WARNING_LEVEL_VALUE = LogLevelEnum.warning.value
+ERROR_LEVEL_VALUE = LogLevelEnum.error.value
+
+
+class LogWriter(object):
+    writer = None
+    writer_lock = threading.Lock()
+
+    def __init__(self, queue_size=LogEnum.QUEUE_SIZE.value, drop_policy=LogEnum.DROP_POLICY.value,
+                 log_to_file=LogEnum.LOG_TO_FILE.value):
+        '''
+        后台日志写入线程，调用方只把日志记录放入有界队列，格式化、打印和写文件都在后台线程中批量完成
+        队列满时按drop_policy丢弃日志，保证记录日志永远不会阻塞消息转发
+        队列使用deque，入队不需要加锁和唤醒写入线程，写入线程空闲时按FLUSH_INTERVAL轮询
+        '''
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.record_queue = collections.deque(maxlen=queue_size if drop_policy == "drop_old" else None)
+        self.log_to_file = log_to_file
+        self.dropped_record_count = 0
+        self.log_dir = None
+        self.log_file = None
+        self.log_file_day = None
+        self.log_file_index = 0
+        self.log_file_size = 0
+        self.cached_second = None
+        self.cached_time_text = ""
+        self.stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.write_records, name="log-writer", daemon=True)
+        self.writer_thread.start()
+
+    @classmethod
+    def get_writer(cls):
+        writer = cls.writer
+        if writer is None:
+            with cls.writer_lock:
+                if cls.writer is None:
+                    cls.writer = cls()
+                    atexit.register(cls.writer.close_writer)
+                writer = cls.writer
+        return writer
+
+    @classmethod
+    def reset_after_fork(cls):
+        '''
+        fork出的子进程中没有父进程的写入线程，丢弃继承来的写入器，首次记录日志时重新创建
+        '''
+        cls.writer = None
+        cls.writer_lock = threading.Lock()
+
+    def put_record(self, record):
+        if len(self.record_queue) >= self.queue_size:
+            # 计数只用于提示，多线程下不精确也没有关系
+            self.dropped_record_count += 1
+            if self.drop_policy != "drop_old":
+                return
+        self.record_queue.append(record)
+
+    def write_records(self):
+        batch_size = LogEnum.BATCH_SIZE.value
+        flush_interval = LogEnum.FLUSH_INTERVAL.value
+        while not self.stop_event.is_set():
+            if not self.record_queue:
+                self.stop_event.wait(flush_interval)
+                continue
+            record_list = self.pop_records(batch_size)
+            self.write_batch(record_list)
+
+    def pop_records(self, batch_size=None):
+        record_list = []
+        pop_record = self.record_queue.popleft
+        while batch_size is None or len(record_list) < batch_size:
+            try:
+                record_list.append(pop_record())
+            except IndexError:
+                break
+        return record_list
+
+    def write_batch(self, record_list):
+        msg_list = [self.format_record(*record) for record in record_list]
+        if self.dropped_record_count:
+            dropped_record_count, self.dropped_record_count = self.dropped_record_count, 0
+            msg_list.append(self.format_time(time.time()) + " Logger warning  " + str(dropped_record_count) +
+                            " log records dropped because the log queue is full")
+        text = "\n".join(msg_list) + "\n"
+        try:
+            Logger.record_msg_to_console(text[:-1])
+            if self.log_to_file:
+                self.write_to_file(text)
+        except Exception as e:
+            sys.stderr.write("write log failed for " + str(e) + "\n")
+
+    def format_time(self, timestamp):
+        '''
+        同一秒内的日志复用格式化好的时间
+        '''
+        second = int(timestamp)
+        if second != self.cached_second:
+            self.cached_second = second
+            self.cached_time_text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return self.cached_time_text
+
+    def format_record(self, timestamp, name, log_level, args, kwargs):
+        '''
+        根据配置的输出格式拼接日志
+        '''
+        msg = "".join([" " + str(context) for context in args])
+        if kwargs:
+            msg = msg + "".join([" " + str(context) for context in kwargs])
+        return self.format_time(timestamp) + " " + name + " " + log_level + " " + msg
+
+    def write_to_file(self, text):
+        '''
+        写入已打开的日志文件，日期变化或文件超过大小上限时切换到新文件
+        '''
+        if self.log_dir is None:
+            try:
+                self.log_dir = Logger.find_log_dir()
+            except CommonError:
+                self.log_to_file = False
+                return
+        day = time.strftime("%m%d", time.localtime(self.cached_second))
+        if self.log_file is None or day != self.log_file_day or self.log_file_size >= LogEnum.MAX_FILE_SIZE.value:
+            self.open_log_file(day)
+        self.log_file.write(text)
+        self.log_file.flush()
+        self.log_file_size += len(text)
+
+    def open_log_file(self, day):
+        if self.log_file is not None:
+            self.log_file.close()
+        if day != self.log_file_day:
+            self.log_file_day = day
+            self.log_file_index = 0
+        elif self.log_file_size >= LogEnum.MAX_FILE_SIZE.value:
+            self.log_file_index += 1
+        while True:
+            suffix = "" if self.log_file_index == 0 else "." + str(self.log_file_index)
+            log_file_path = os.path.join(self.log_dir, "app-" + day + suffix + ".log")
+            if not os.path.exists(log_file_path) or os.path.getsize(log_file_path) < LogEnum.MAX_FILE_SIZE.value:
+                break
+            self.log_file_index += 1
+        self.log_file = open(log_file_path, "a", encoding="utf-8")
+        self.log_file_size = self.log_file.tell()
+
+    def close_writer(self):
+        '''
+        写出队列中剩余的日志并关闭文件
+        '''
+        self.stop_event.set()
+        self.writer_thread.join(timeout=LogEnum.FLUSH_INTERVAL.value * 2)
+        record_list = self.pop_records()
+        if record_list or self.dropped_record_count:
+            self.write_batch(record_list)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LogWriter.reset_after_fork)
 
 
 class Logger(object):
+    log_level_value = LogLevelEnum[LogEnum.LOG_LEVEL.value].value
+
     def __init__(self, name):
         '''
         通用日志记录类，logging模块在多线程下会出现多次打印日志的问题，故简单写个日志记录类
+        日志由LogWriter在后台线程中异步写出，调用方只负责入队
         :param name:
         '''
         if not name:
             raise CommonError("Please Input Logger Name!")
         self.name = name
 
+    @classmethod
+    def set_log_level(cls, log_level):
+        cls.log_level_value = LogLevelEnum[log_level].value
+
+    @classmethod
+    def is_enabled_for(cls, log_level):
+        '''
+        调用方需要拼接开销较大的日志时，可以先判断级别
+        '''
+        return LogLevelEnum[log_level].value >= cls.log_level_value
+
     def info(self, *args, **kwargs):
-        self.record_log('info', args, kwargs)
+        if self.log_level_value <= INFO_LEVEL_VALUE:
+            self.record_log('info', args, kwargs)
 
     def warning(self, *args, **kwargs):
-        self.record_log('warning', args, kwargs)
+        if self.log_level_value <= WARNING_LEVEL_VALUE:
+            self.record_log('warning', args, kwargs)
 
     def error(self, *args, **kwargs):
-        self.record_log('error', args, kwargs)
+        if self.log_level_value <= ERROR_LEVEL_VALUE:
+            self.record_log('error', args, kwargs)
 
     def debug(self, *args, **kwargs):
-        self.record_log('debug', args, kwargs)
-
-    def record_log(self, level, *args, **kwargs):
-        msg = ""
-        for value in args:
-            if len(value) > 0 :
-                if isinstance(value, list):
-                    msg = msg + ",".join(value)
-                else:
-                    for context in value:
-                        msg = msg + " " + str(context)
-        if kwargs:
-            msg = msg + str(kwargs)
-        self.write_log(level, msg)
+        if self.log_level_value <= DEBUG_LEVEL_VALUE:
+            self.record_log('debug', args, kwargs)
 
-    def write_log(self, log_level, msg):
+    def record_log(self, level, args, kwargs):
         '''
-        根据配置的输出格式来打印日志
+        只记录时间和参数，消息的拼接延迟到后台线程中
         '''
-        time_now = time.strftime('%Y-%m-%d %H:%M:%S')
-        log_prefix = time_now + " " + self.name
-        msg = log_prefix + " " + log_level + " " + msg
-        self.record_msg_to_console(msg)
+        LogWriter.get_writer().put_record((time.time(), self.name, level, args, kwargs))
+
+    def write_log(self, log_level, msg):
+        self.record_log(log_level, (msg,), {})
 
     @staticmethod
     def record_msg_to_console(msg):
@@ -59,18 +235,19 @@ class Logger(object):
         '''
         记录日志到文件
         '''
-        log_file_path = self._find_log_path() + "/log/app-" + time.strftime("%m%d") + ".log"
+        log_file_path = self.find_log_dir() + "/app-" + time.strftime("%m%d") + ".log"
         with open(log_file_path, "a", encoding="utf-8") as logfile:
             logfile.write(msg + "\n")
             logfile.flush()
 
-    def _find_log_path(self):
+    @staticmethod
+    def find_log_dir():
         cur_dir = os.getcwd()
         while True:
             if cur_dir == "/" or cur_dir.endswith(":\\"):
                 break
             log_path = os.path.join(cur_dir, 'log')
             if os.path.exists(log_path):
-                return cur_dir
+                return log_path
             cur_dir = os.path.dirname(cur_dir)
-        raise CommonError("Please call inside source root directory")
\ No newline at end of file
+        raise CommonError("Please call inside source root directory")
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+from common.metrics_enum import MetricsEnum
+from util.logger_manager_ment import Logger
+
+
+def format_label_text(label_names, label_values):
+    if not label_names:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                          for name, value in zip(label_names, label_values)) + "}"
+
+
+def format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class NoopMetric(object):
+    '''
+    关闭监控时使用的空指标，labels返回自身，所有记录操作都不做任何事
+    '''
+    def labels(self, *label_values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NOOP_METRIC = NoopMetric()
+
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get_samples(self, name, label_text):
+        return [(name, label_text, self.value)]
+
+
+class GaugeChild(CounterChild):
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 每个桶单独计数，输出时再累加
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+
+    def get_samples(self, name, label_text):
+        with self.lock:
+            bucket_counts = list(self.bucket_counts)
+            total = self.sum
+        sample_list = []
+        cumulative_count = 0
+        prefix = label_text[:-1] + "," if label_text else "{"
+        for upper_bound, count in zip(list(self.buckets) + [float("inf")], bucket_counts):
+            cumulative_count += count
+            sample_list.append((name + "_bucket", prefix + 'le="' + format_number(upper_bound) + '"}',
+                                cumulative_count))
+        sample_list.append((name + "_sum", label_text, total))
+        sample_list.append((name + "_count", label_text, cumulative_count))
+        return sample_list
+
+
+class Metric(object):
+    def __init__(self, name, documentation, metric_type, label_names, child_factory):
+        '''
+        一个带标签的指标，labels按标签值返回对应的子指标，子指标按标签值缓存
+        :return:
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.child_factory = child_factory
+        self.child_dict = {}
+        self.child_lock = threading.Lock()
+        if not self.label_names:
+            self.default_child = self.labels()
+            # 没有标签的指标直接调用子指标的方法
+            for method_name in ("inc", "dec", "set", "observe"):
+                if hasattr(self.default_child, method_name):
+                    setattr(self, method_name, getattr(self.default_child, method_name))
+
+    def labels(self, *label_values):
+        child = self.child_dict.get(label_values)
+        if child is None:
+            with self.child_lock:
+                child = self.child_dict.get(label_values)
+                if child is None:
+                    if len(label_values) != len(self.label_names):
+                        raise ValueError(self.name + " requires labels " + ",".join(self.label_names))
+                    child = self.child_factory()
+                    self.child_dict[label_values] = child
+        return child
+
+    def get_samples(self):
+        sample_list = []
+        for label_values, child in list(self.child_dict.items()):
+            sample_list.extend(child.get_samples(self.name, format_label_text(self.label_names, label_values)))
+        return sample_list
+
+
+class MetricsRegistry(object):
+    default_registry = None
+    default_registry_lock = threading.Lock()
+
+    def __init__(self, enabled=MetricsEnum.METRICS_ENABLED.value):
+        '''
+        指标注册表，创建计数器、仪表和直方图，并以Prometheus文本格式或JSON快照输出
+        关闭时创建的都是空指标；仪表类指标可以注册采集回调，在输出前才计算，不占用热点路径
+        :return:
+        '''
+        self.enabled = enabled
+        self.metric_dict = {}
+        self.collect_callback_list = []
+        self.lock = threading.Lock()
+        self.logger = Logger("Metrics")
+        self.http_server = None
+        self.snapshot_thread = None
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def get_default_registry(cls):
+        '''
+        获取进程内共享的指标注册表
+        :return: registry
+        '''
+        with cls.default_registry_lock:
+            if cls.default_registry is None:
+                cls.default_registry = cls()
+            return cls.default_registry
+
+    def register_metric(self, name, documentation, metric_type, label_names, child_factory):
+        if not self.enabled:
+            return NOOP_METRIC
+        with self.lock:
+            metric = self.metric_dict.get(name)
+            if metric is None:
+                metric = Metric(name, documentation, metric_type, label_names, child_factory)
+                self.metric_dict[name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register_metric(name, documentation, "counter", label_names, CounterChild)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register_metric(name, documentation, "gauge", label_names, GaugeChild)
+
+    def histogram(self, name, documentation, label_names=(), buckets=MetricsEnum.DEFAULT_BUCKETS.value):
+        buckets = tuple(sorted(buckets))
+        return self.register_metric(name, documentation, "histogram", label_names,
+                                    lambda: HistogramChild(buckets))
+
+    def add_collect_callback(self, callback):
+        '''
+        注册采集回调，每次输出指标前调用，用于更新队列深度等仪表
+        :return:
+        '''
+        if self.enabled:
+            self.collect_callback_list.append(callback)
+
+    def collect(self):
+        '''
+        调用采集回调并返回所有指标的样本
+        :return: [(metric, [(sample_name, label_text, value), ...]), ...]
+        '''
+        for callback in list(self.collect_callback_list):
+            try:
+                callback()
+            except Exception as e:
+                self.logger.error("metrics collect callback failed for " + str(e))
+        with self.lock:
+            metric_list = sorted(self.metric_dict.values(), key=lambda metric: metric.name)
+        return [(metric, metric.get_samples()) for metric in metric_list]
+
+    def generate_text(self):
+        '''
+        Prometheus文本格式
+        :return: text
+        '''
+        line_list = []
+        for metric, sample_list in self.collect():
+            line_list.append("# HELP " + metric.name + " " + metric.documentation)
+            line_list.append("# TYPE " + metric.name + " " + metric.metric_type)
+            for sample_name, label_text, value in sample_list:
+                line_list.append(sample_name + label_text + " " + format_number(value))
+        return "\n".join(line_list) + "\n"
+
+    def get_snapshot(self):
+        '''
+        JSON快照：{metric_name: {label_text: value}}，直方图的样本按_bucket/_sum/_count分别列出
+        :return: dict
+        '''
+        snapshot = {}
+        for metric, sample_list in self.collect():
+            for sample_name, label_text, value in sample_list:
+                snapshot.setdefault(sample_name, {})[label_text] = value
+        return {"timestamp": time.time(), "metrics": snapshot}
+
+    def start_http_server(self, host=MetricsEnum.HTTP_HOST.value, port=MetricsEnum.HTTP_PORT.value):
+        '''
+        在后台线程中提供HTTP指标接口
+        :return: 实际监听的端口，未启动时返回None
+        '''
+        if not self.enabled or not port or self.http_server is not None:
+            return None
+        # 只在启动HTTP接口时导入，不开启时不增加启动耗时
+        import http.server
+        registry = self
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != MetricsEnum.HTTP_PATH.value:
+                    self.send_error(404)
+                    return
+                body = registry.generate_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.http_server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        except OSError as e:
+            self.logger.error("start metrics http server on " + host + ":" + str(port) + " failed for " + str(e))
+            return None
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, name="metrics-http", daemon=True).start()
+        listen_port = self.http_server.server_address[1]
+        self.logger.info("metrics http server listening on " + host + ":" + str(listen_port))
+        return listen_port
+
+    def start_snapshot_thread(self, snapshot_file_path, interval=MetricsEnum.SNAPSHOT_INTERVAL.value):
+        '''
+        定期把指标快照写入文件，先写临时文件再替换，读取方不会读到写了一半的文件
+        :return:
+        '''
+        if not self.enabled or not interval or self.snapshot_thread is not None:
+            return
+        self.snapshot_thread = threading.Thread(target=self.write_snapshots, args=(snapshot_file_path, interval),
+                                                name="metrics-snapshot", daemon=True)
+        self.snapshot_thread.start()
+
+    def write_snapshots(self, snapshot_file_path, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.write_snapshot(snapshot_file_path)
+            except OSError as e:
+                self.logger.error("write metrics snapshot failed for " + str(e))
+
+    def write_snapshot(self, snapshot_file_path):
+        temp_file_path = snapshot_file_path + ".tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(self.get_snapshot(), snapshot_file)
+        os.replace(temp_file_path, snapshot_file_path)
+
+    def stop_exporters(self):
+        self.stop_event.set()
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
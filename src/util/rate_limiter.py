@@ -0,0 +1,38 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=time.monotonic):
+        '''
+        令牌桶限速：每秒产生rate个令牌，最多积累burst个
+        reserve预约令牌而不阻塞，返回需要等待的时间，调用方可以自己安排在之后执行
+        :return:
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last_time = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        预约一个令牌
+        :return: 需要等待的时间（秒），有可用令牌时为0
+        '''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        '''
+        阻塞直到拿到一个令牌
+        :return:
+        '''
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
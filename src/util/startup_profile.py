@@ -0,0 +1,198 @@
+import sys
+import json
+import time
+import argparse
+import resource
+import importlib
+import contextlib
+import collections
+import importlib.abc
+
+
+class ProfilingLoader(object):
+    def __init__(self, loader, profiler, module_name):
+        '''
+        包装模块原本的loader，统计模块创建和执行（即导入）的耗时，其他属性都转给原loader
+        :return:
+        '''
+        self.loader = loader
+        self.profiler = profiler
+        self.module_name = module_name
+
+    def create_module(self, spec):
+        with self.profiler.profile_import(self.module_name):
+            return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        with self.profiler.profile_import(self.module_name):
+            self.loader.exec_module(module)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ProfilingFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, profiler):
+        '''
+        放在sys.meta_path最前面，由后面的finder查找模块，再把找到的loader换成ProfilingLoader
+        :return:
+        '''
+        self.profiler = profiler
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = ProfilingLoader(spec.loader, self.profiler, fullname)
+        return spec
+
+
+class StartupProfiler(object):
+    default_profiler = None
+
+    def __init__(self, clock=time.perf_counter):
+        '''
+        启动耗时分析：开启后统计之后导入的每个模块的耗时，以及用profile_stage标记的初始化步骤的耗时
+        模块的自身耗时不含其导入的其他模块，只在单线程启动时准确
+        :return:
+        '''
+        self.clock = clock
+        self.enabled = False
+        self.start_time = None
+        self.finder = ProfilingFinder(self)
+        # module -> [自身耗时, 累计耗时]
+        self.import_time_dict = collections.OrderedDict()
+        # 正在导入的模块的子模块累计耗时
+        self.import_stack = []
+        self.stage_list = []
+
+    @classmethod
+    def get_default_profiler(cls):
+        if cls.default_profiler is None:
+            cls.default_profiler = cls()
+        return cls.default_profiler
+
+    def enable(self):
+        '''
+        开始统计，只有之后首次导入的模块会被统计
+        :return:
+        '''
+        if self.enabled:
+            return
+        self.enabled = True
+        self.start_time = self.clock()
+        sys.meta_path.insert(0, self.finder)
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        sys.meta_path.remove(self.finder)
+
+    @contextlib.contextmanager
+    def profile_import(self, module_name):
+        start_time = self.clock()
+        self.import_stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed_time = self.clock() - start_time
+            child_time = self.import_stack.pop()
+            if self.import_stack:
+                self.import_stack[-1] += elapsed_time
+            import_time = self.import_time_dict.setdefault(module_name, [0.0, 0.0])
+            import_time[0] += elapsed_time - child_time
+            import_time[1] += elapsed_time
+
+    @contextlib.contextmanager
+    def profile_stage(self, stage_name):
+        start_time = self.clock()
+        try:
+            yield
+        finally:
+            self.stage_list.append((stage_name, self.clock() - start_time))
+
+    def get_report(self, top_module_number=None):
+        '''
+        汇总统计结果，第三方库按顶层包合计，便于看出各协议依赖库的导入成本
+        :return: {"total_ms", "max_rss_kb", "stages", "packages", "modules"}
+        '''
+        module_list = sorted(self.import_time_dict.items(), key=lambda item: item[1][0], reverse=True)
+        package_time_dict = collections.defaultdict(float)
+        for module_name, (self_time, _) in module_list:
+            package_time_dict[module_name.split(".")[0]] += self_time
+        return {"total_ms": round((self.clock() - self.start_time) * 1000, 3) if self.start_time is not None else 0,
+                "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "stages": [{"stage": stage_name, "ms": round(stage_time * 1000, 3)}
+                           for stage_name, stage_time in self.stage_list],
+                "packages": [{"package": package_name, "self_ms": round(package_time * 1000, 3)}
+                             for package_name, package_time in sorted(package_time_dict.items(),
+                                                                       key=lambda item: item[1], reverse=True)],
+                "modules": [{"module": module_name, "self_ms": round(self_time * 1000, 3),
+                             "cumulative_ms": round(cumulative_time * 1000, 3)}
+                            for module_name, (self_time, cumulative_time) in module_list[:top_module_number]]}
+
+
+def profile_stage(stage_name):
+    '''
+    标记一个初始化步骤，未开启启动耗时分析时不做任何事
+    :return: context manager
+    '''
+    profiler = StartupProfiler.default_profiler
+    if profiler is None or not profiler.enabled:
+        return contextlib.nullcontext()
+    return profiler.profile_stage(stage_name)
+
+
+def format_report(report):
+    line_list = ["total: %.3f ms, max rss: %d KB" % (report["total_ms"], report["max_rss_kb"]), "",
+                 "%-48s %12s" % ("stage", "ms")]
+    for stage in report["stages"]:
+        line_list.append("%-48s %12.3f" % (stage["stage"], stage["ms"]))
+    line_list += ["", "%-48s %12s" % ("package", "self_ms")]
+    for package in report["packages"]:
+        line_list.append("%-48s %12.3f" % (package["package"], package["self_ms"]))
+    line_list += ["", "%-48s %12s %14s" % ("module", "self_ms", "cumulative_ms")]
+    for module in report["modules"]:
+        line_list.append("%-48s %12.3f %14.3f" % (module["module"], module["self_ms"], module["cumulative_ms"]))
+    return "\n".join(line_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="report import and initialization time of controller startup")
+    parser.add_argument("--controller", choices=("threaded", "async"), default="threaded",
+                        help="controller to construct")
+    parser.add_argument("--protocol", action="append", default=[],
+                        help="also create a channel of this protocol, may be given several times")
+    parser.add_argument("--top", type=int, default=20, help="number of slowest modules to report")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+    # 以-m运行时本模块是__main__，控制器中的profile_stage来自以util.startup_profile导入的另一个模块对象
+    startup_profile = importlib.import_module("util.startup_profile")
+    profile_stage = startup_profile.profile_stage
+    profiler = startup_profile.StartupProfiler.get_default_profiler()
+    profiler.enable()
+    with profile_stage("import " + args.controller + " controller"):
+        if args.controller == "async":
+            controller_class = importlib.import_module("core_services.async_controller").AsyncController
+        else:
+            controller_class = importlib.import_module("core_services.controller").Controller
+    with profile_stage("create " + args.controller + " controller"):
+        controller = controller_class()
+    for protocol_type in args.protocol:
+        with profile_stage("create " + protocol_type + " channel"):
+            controller.channel.create_channel(protocol_type, **controller.channel.get_channel_endpoint(protocol_type))
+    profiler.disable()
+    report = profiler.get_report(args.top)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
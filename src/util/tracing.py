@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import collections
+
+from common.tracing_enum import TracingEnum
+from util.logger_manager_ment import Logger
+
+
+class TraceContext(object):
+    def __init__(self, trace_id, protocol, device_id, stage):
+        '''
+        单条消息的追踪上下文，按顺序记录消息经过的各阶段及其单调时钟时间
+        :return:
+        '''
+        self.trace_id = trace_id
+        self.protocol = protocol
+        self.device_id = device_id
+        self.start_wall_time = time.time()
+        self.stage_list = [(stage, time.monotonic())]
+        self.finished = False
+
+    def mark(self, stage):
+        self.stage_list.append((stage, time.monotonic()))
+
+    def to_dict(self):
+        start_time = self.stage_list[0][1]
+        return {"trace_id": self.trace_id, "protocol": self.protocol, "device": self.device_id,
+                "start_time": self.start_wall_time,
+                "stages": [{"stage": stage, "offset_ms": round((stage_time - start_time) * 1000, 4)}
+                           for stage, stage_time in self.stage_list]}
+
+
+class TracedBytes(bytes):
+    '''
+    携带追踪上下文的bytes消息，对编解码和队列来说与普通bytes相同
+    '''
+    trace_context = None
+
+
+class TracedStr(str):
+    '''
+    携带追踪上下文的str消息
+    '''
+    trace_context = None
+
+
+def mark_stage(message, stage):
+    '''
+    为被采样的消息记录一个阶段，没有追踪上下文的消息直接返回
+    :return:
+    '''
+    trace_context = getattr(message, "trace_context", None)
+    if trace_context is not None:
+        trace_context.mark(stage)
+
+
+class MessageTracer(object):
+    default_tracer = None
+    default_tracer_lock = threading.Lock()
+
+    def __init__(self, enabled=TracingEnum.TRACING_ENABLED.value, sample_interval=TracingEnum.SAMPLE_INTERVAL.value,
+                 ring_buffer_size=TracingEnum.RING_BUFFER_SIZE.value):
+        '''
+        消息链路追踪：接收时按间隔采样，被采样的消息换成携带追踪上下文的同值对象在队列之间传递，
+        各阶段打点记录时间，转发结束后完成的追踪进入环形缓冲区，可以导出为JSON
+        :return:
+        '''
+        self.enabled = enabled and sample_interval > 0
+        self.sample_interval = sample_interval
+        self.message_counter = itertools.count()
+        self.trace_id_counter = itertools.count(1)
+        self.trace_deque = collections.deque(maxlen=ring_buffer_size)
+        self.logger = Logger("Tracing")
+        self.dump_thread = None
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def get_default_tracer(cls):
+        '''
+        获取进程内共享的追踪器
+        :return: tracer
+        '''
+        with cls.default_tracer_lock:
+            if cls.default_tracer is None:
+                cls.default_tracer = cls()
+            return cls.default_tracer
+
+    def start_trace(self, message, protocol, device_id):
+        '''
+        消息接收时调用，被采样时返回携带追踪上下文的消息，否则原样返回
+        :return: message
+        '''
+        if not self.enabled or next(self.message_counter) % self.sample_interval:
+            return message
+        if isinstance(message, bytes):
+            traced_message = TracedBytes(message)
+        elif isinstance(message, str):
+            traced_message = TracedStr(message)
+        else:
+            return message
+        traced_message.trace_context = TraceContext(next(self.trace_id_counter), protocol, device_id,
+                                                    TracingEnum.RECEIVE_STAGE.value)
+        return traced_message
+
+    def finish_trace(self, message):
+        '''
+        消息处理结束，追踪进入环形缓冲区
+        :return:
+        '''
+        trace_context = getattr(message, "trace_context", None)
+        if trace_context is None or trace_context.finished:
+            return
+        trace_context.finished = True
+        self.trace_deque.append(trace_context)
+
+    def get_traces(self):
+        return [trace_context.to_dict() for trace_context in list(self.trace_deque)]
+
+    def dump_traces(self, trace_file_path):
+        '''
+        将环形缓冲区中的追踪写入JSON文件，先写临时文件再替换
+        :return: 写入的追踪数量
+        '''
+        trace_list = self.get_traces()
+        temp_file_path = trace_file_path + ".tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as trace_file:
+            json.dump({"sample_interval": self.sample_interval, "traces": trace_list}, trace_file)
+        os.replace(temp_file_path, trace_file_path)
+        return len(trace_list)
+
+    def start_dump_thread(self, trace_file_path, interval=TracingEnum.DUMP_INTERVAL.value):
+        '''
+        定期将追踪写入文件
+        :return:
+        '''
+        if not self.enabled or not interval or self.dump_thread is not None:
+            return
+        self.dump_thread = threading.Thread(target=self.dump_traces_forever, args=(trace_file_path, interval),
+                                            name="trace-dump", daemon=True)
+        self.dump_thread.start()
+
+    def dump_traces_forever(self, trace_file_path, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.dump_traces(trace_file_path)
+            except OSError as e:
+                self.logger.error("dump message traces failed for " + str(e))
+
+    def stop_dump_thread(self):
+        self.stop_event.set()
+
+
+def calculate_percentile(sorted_value_list, percentile):
+    if not sorted_value_list:
+        return None
+    return sorted_value_list[min(len(sorted_value_list) - 1, int(len(sorted_value_list) * percentile))]
+
+
+def summarize_traces(trace_list):
+    '''
+    按相邻阶段统计耗时，例如receive->channel_dequeue，以及从接收到最后一个阶段的总耗时
+    :return: {"trace_count": n, "stages": {"a->b": {"count", "mean_ms", "p50_ms", "p99_ms", "max_ms"}, ...}}
+    '''
+    duration_dict = collections.OrderedDict()
+    for trace in trace_list:
+        stage_list = trace["stages"]
+        for previous_stage, stage in zip(stage_list, stage_list[1:]):
+            duration_dict.setdefault(previous_stage["stage"] + "->" + stage["stage"], []).append(
+                stage["offset_ms"] - previous_stage["offset_ms"])
+        if len(stage_list) > 1:
+            duration_dict.setdefault("total", []).append(stage_list[-1]["offset_ms"])
+    stage_summary_dict = collections.OrderedDict()
+    for stage_name, duration_list in duration_dict.items():
+        duration_list.sort()
+        stage_summary_dict[stage_name] = {"count": len(duration_list),
+                                          "mean_ms": round(sum(duration_list) / len(duration_list), 4),
+                                          "p50_ms": round(calculate_percentile(duration_list, 0.5), 4),
+                                          "p99_ms": round(calculate_percentile(duration_list, 0.99), 4),
+                                          "max_ms": round(duration_list[-1], 4)}
+    return {"trace_count": len(trace_list), "stages": stage_summary_dict}
+
+
+def format_summary(summary):
+    line_list = ["traces: " + str(summary["trace_count"]),
+                 "%-32s %8s %10s %10s %10s %10s" % ("stage", "count", "mean_ms", "p50_ms", "p99_ms", "max_ms")]
+    for stage_name, stage_summary in summary["stages"].items():
+        line_list.append("%-32s %8d %10.4f %10.4f %10.4f %10.4f" % (
+            stage_name, stage_summary["count"], stage_summary["mean_ms"], stage_summary["p50_ms"],
+            stage_summary["p99_ms"], stage_summary["max_ms"]))
+    return "\n".join(line_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize per-stage latency of dumped message traces")
+    parser.add_argument("trace_file", help="json file written by MessageTracer.dump_traces")
+    parser.add_argument("--protocol", help="only summarize traces received through this protocol")
+    parser.add_argument("--device", help="only summarize traces received from this device")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+    with open(args.trace_file, "r", encoding="utf-8") as trace_file:
+        trace_list = json.load(trace_file)["traces"]
+    trace_list = [trace for trace in trace_list if (args.protocol is None or trace["protocol"] == args.protocol) and
+                  (args.device is None or trace["device"] == args.device)]
+    summary = summarize_traces(trace_list)
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
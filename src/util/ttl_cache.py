@@ -0,0 +1,61 @@
+import time
+import threading
+import collections
+
+
+class TTLCache(object):
+    def __init__(self, max_size, ttl, clock=time.monotonic, refresh_on_hit=True):
+        '''
+        有界的LRU/TTL集合：key在ttl秒内没有再次出现时过期，超过max_size时淘汰最久未出现的key
+        所有key的ttl相同，按最后一次出现的时间排序后过期顺序与淘汰顺序一致，查询、加入和过期清理都是均摊O(1)
+        :param max_size: 最多保留的key数量
+        :param ttl: key的有效时间（秒）
+        :param refresh_on_hit: 为False时key从第一次出现起计算有效期，重复出现不延长，持续重复的key到期后会再次被放行
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.refresh_on_hit = refresh_on_hit
+        # key -> 最后一次（refresh_on_hit为False时为第一次）出现的时间，按时间升序排列
+        self.seen_time_dict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def check_and_add(self, key):
+        '''
+        记录key出现一次
+        :return: key在有效期内已经出现过时返回True
+        '''
+        now = self.clock()
+        with self.lock:
+            self.expire(now)
+            seen = key in self.seen_time_dict
+            if seen:
+                if self.refresh_on_hit:
+                    self.seen_time_dict[key] = now
+                    self.seen_time_dict.move_to_end(key)
+                return True
+            self.seen_time_dict[key] = now
+            if len(self.seen_time_dict) > self.max_size:
+                self.seen_time_dict.popitem(last=False)
+            return False
+
+    def expire(self, now):
+        seen_time_dict = self.seen_time_dict
+        deadline = now - self.ttl
+        while seen_time_dict:
+            key, seen_time = next(iter(seen_time_dict.items()))
+            if seen_time > deadline:
+                return
+            del seen_time_dict[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            self.expire(self.clock())
+            return key in self.seen_time_dict
+
+    def __len__(self):
+        return len(self.seen_time_dict)
+
+    def clear(self):
+        with self.lock:
+            self.seen_time_dict.clear()